@@ -8,20 +8,21 @@ import numpy as np
 import time
 
 from utils import normalize
+from feature_store import FeatureShardStore
 import faiss
 
+SEARCH_BLOCK_SIZE = 65536 # The number of features to score against the queries at a time
+MAX_INDEX_SEARCH_K = 2048 # Larger k are searched exactly (an approximate index visits almost all features for such k)
+
+# Persistent index for each bucket (saved next to the feature shards)
+#   flat: exact search (same result as the brute-force search without an index)
+#   ivfpq: approximate search, recall/latency knob is nprobe (number of inverted lists to visit)
+#   hnsw: approximate search, recall/latency knob is efSearch (size of the search queue)
+INDEX_TYPES = ['flat', 'ivfpq', 'hnsw']
+
 def _path_iterator_for_numpy(paths, mapping):
     # mapping is the selected indices to return
-    cur_count = 0
-    for path in paths:
-        with open(path, 'rb') as f:
-            matrix = np.load(f)
-        new_count = cur_count + matrix.shape[0]
-        cur_mapping = list(filter(lambda x : x < new_count and x >= cur_count, mapping))
-        relative_cur_mapping = [i - cur_count for i in cur_mapping]
-        curr_matrix = matrix[relative_cur_mapping]
-        cur_count = new_count
-        yield curr_matrix
+    return FeatureShardStore(paths).iter_selected(mapping)
 
 def aggregate_for_numpy(paths, mapping):
     """Return a numpy matrix of selected features indicated by mapping
@@ -31,21 +32,7 @@ def aggregate_for_numpy(paths, mapping):
         Returns:
             total_matrix (a single matrix with size (len(mapping) x feature_dim))
     """
-    total_matrix = None
-    cur_count = 0
-    for path in paths:
-        with open(path, 'rb') as f:
-            matrix = np.load(f)
-        new_count = cur_count + matrix.shape[0]
-        cur_mapping = list(filter(lambda x : x < new_count and x >= cur_count, mapping))
-        relative_cur_mapping = [i - cur_count for i in cur_mapping]
-        curr_matrix = matrix[relative_cur_mapping]
-        if type(total_matrix) == type(None):
-            total_matrix = curr_matrix
-        else:
-            total_matrix = np.concatenate((total_matrix, curr_matrix), axis=0)
-        cur_count = new_count
-    return total_matrix
+    return FeatureShardStore(paths).take(mapping)
 
 def aggregate_for_lists(lists, mapping):
     """Return a list of selected features indicated by mapping (similar to aggregate for numpy)
@@ -69,26 +56,13 @@ def aggregate_for_lists(lists, mapping):
 def _get_total_feature_length(paths):
     """Returns the total size of all features (distributed in multiple paths)
     """
-    feature_count = 0
-    for path in paths:
-        with open(path, 'rb') as f:
-            matrix = np.load(f)
-        feature_count += matrix.shape[0]
-    return feature_count
-
-def _chunk_iterator(length, chunk_size):
-    """Generator for lists ([0,...,length] splitted to [chunk_size] chunks)
-    """
-    lst = list(range(length))
-    for i0 in range(0, length, chunk_size):
-        yield lst[i0:i0 + chunk_size]
+    return len(FeatureShardStore(paths))
 
-def _remove_multiple_indices_at_once(lst, removed_indices):
-    mapped_removed_indices = [lst[j] for j in removed_indices]
-    
-    for ele in sorted(removed_indices, reverse=True):  
-        del lst[ele]
-    return lst, mapped_removed_indices
+def _block_iterator_for_numpy(paths, block_size=SEARCH_BLOCK_SIZE):
+    """Generator for consecutive row blocks (of at most block_size rows) of all features
+    (distributed in multiple paths)
+    """
+    return FeatureShardStore(paths).iter_blocks(block_size)
 
 class _ResultHeap:
     """Accumulate query results from a sliced dataset. The final result will
@@ -145,15 +119,189 @@ def knn_ground_truth(xq, db_iterator, k):
 
     return rh.D, rh.I
 
+class _TopKAccumulator:
+    """Accumulate the exact top-k (largest inner product) results of a dataset
+    streamed block by block. Unlike _ResultHeap, k is not limited by the faiss
+    (GPU) heap size. The final result will be in self.D, self.I, sorted by
+    decreasing score (ties broken by smaller index)."""
+
+    def __init__(self, nq, k):
+        " nq: number of query vectors, k: number of results per query "
+        self.I = np.zeros((nq, 0), dtype='int64')
+        self.D = np.zeros((nq, 0), dtype='float32')
+        self.nq, self.k = nq, k
+
+    def add_result(self, D, I):
+        """D, I (nq x n) do not need to be in a particular order"""
+        if self.k == 0:
+            return
+        D = np.concatenate((self.D, D), axis=1)
+        I = np.concatenate((self.I, I), axis=1)
+        if D.shape[1] > self.k:
+            kept = np.argpartition(D, D.shape[1] - self.k, axis=1)[:, -self.k:]
+            kept_D = np.take_along_axis(D, kept, axis=1)
+            kept_I = np.take_along_axis(I, kept, axis=1)
+            # argpartition keeps an arbitrary subset of the scores tied with the k-th score.
+            # Re-select the rows where a tied score is left out by sorting on (score, index).
+            kth_D = kept_D.min(axis=1, keepdims=True)
+            rows = np.flatnonzero((D == kth_D).sum(axis=1) > (kept_D == kth_D).sum(axis=1))
+            if len(rows) > 0:
+                order = np.lexsort((I[rows], -D[rows]), axis=1)[:, :self.k]
+                kept_D[rows] = np.take_along_axis(D[rows], order, axis=1)
+                kept_I[rows] = np.take_along_axis(I[rows], order, axis=1)
+            D, I = kept_D, kept_I
+        self.D, self.I = D, I
+
+    def finalize(self):
+        order = np.argsort(self.I, axis=1)
+        self.D = np.take_along_axis(self.D, order, axis=1)
+        self.I = np.take_along_axis(self.I, order, axis=1)
+        order = np.argsort(-self.D, axis=1, kind='stable')
+        self.D = np.take_along_axis(self.D, order, axis=1)
+        self.I = np.take_along_axis(self.I, order, axis=1)
+
+def knn_exact(xq, db_iterator, k):
+    """Computes the exact KNN (inner product) search results for a dataset that
+    possibly does not fit in RAM, in a single pass over the iterator that returns
+    it block by block. Any k is supported (the result is the same as repeatedly
+    calling knn_ground_truth and removing the found neighbors).
+    """
+    D, I, _, _ = knn_exact_top_bottom(xq, db_iterator, k, bottom_k=0)
+    return D, I
+
+def knn_exact_top_bottom(xq, db_iterator, k, bottom_k=0):
+    """Same as knn_exact, but also computes the bottom_k (smallest inner product)
+    results of all nq queries in the same pass (one (nq x d) matrix product per block).
+    The bottom scores are negated, i.e., the same as searching with -xq.
+    """
+    nq, d = xq.shape
+    topk = _TopKAccumulator(nq, k)
+    bottomk = _TopKAccumulator(nq, bottom_k) if bottom_k > 0 else None
+
+    i0 = 0
+    for xbi in db_iterator:
+        ni = xbi.shape[0]
+        D = xq.dot(xbi.T)
+        I = np.broadcast_to(np.arange(i0, i0 + ni, dtype='int64'), D.shape)
+        topk.add_result(D, I)
+        if bottomk:
+            bottomk.add_result(-D, I)
+        i0 += ni
+
+    topk.finalize()
+    if bottomk:
+        bottomk.finalize()
+        return topk.D, topk.I, bottomk.D, bottomk.I
+    else:
+        return topk.D, topk.I, None, None
+
+
+def build_faiss_index(feature_store, index_type, nlist=None, pq_m=64, hnsw_m=32, block_size=SEARCH_BLOCK_SIZE):
+    """Build an inner product faiss index over all features of a FeatureShardStore
+        Args:
+            index_type (one of INDEX_TYPES)
+            nlist (number of inverted lists for ivfpq, default is 4 x sqrt(number of features))
+            pq_m (number of sub-quantizers for ivfpq, must divide the feature dim)
+            hnsw_m (number of neighbors per node for hnsw)
+    """
+    d = feature_store.dim
+    if index_type == 'flat':
+        index = faiss.IndexFlatIP(d)
+    elif index_type == 'hnsw':
+        index = faiss.IndexHNSWFlat(d, hnsw_m, faiss.METRIC_INNER_PRODUCT)
+    elif index_type == 'ivfpq':
+        if nlist == None:
+            nlist = int(4 * np.sqrt(len(feature_store)))
+        nlist = max(1, min(nlist, len(feature_store) // 39))
+        quantizer = faiss.IndexFlatIP(d)
+        index = faiss.IndexIVFPQ(quantizer, d, nlist, pq_m, 8, faiss.METRIC_INNER_PRODUCT)
+        train_size = min(len(feature_store), max(256 * nlist, 65536))
+        train_indices = np.sort(np.random.default_rng(0).choice(len(feature_store), train_size, replace=False))
+        start = time.time()
+        index.train(np.ascontiguousarray(feature_store.take(train_indices), dtype=np.float32))
+        print(f"{time.time()-start:.4f} seconds for training {index_type} index (nlist={nlist}) with {train_size} features.")
+    else:
+        raise NotImplementedError()
+
+    start = time.time()
+    for xbi in feature_store.iter_blocks(block_size):
+        index.add(np.ascontiguousarray(xbi, dtype=np.float32))
+    print(f"{time.time()-start:.4f} seconds for adding {index.ntotal} features to {index_type} index.")
+    return index
+
+def save_faiss_index(index, index_location):
+    faiss.write_index(index, index_location)
+    print(f"Saved faiss index at {index_location}")
+
+def load_faiss_index(index_location, search_param=None):
+    """Load a saved faiss index, and set the recall/latency knob (nprobe for ivfpq, efSearch for hnsw)
+    """
+    index = faiss.read_index(index_location)
+    print(f"Loaded faiss index from {index_location}")
+    if search_param != None:
+        if isinstance(index, faiss.IndexHNSW):
+            index.hnsw.efSearch = search_param
+        elif isinstance(index, faiss.IndexIVF):
+            index.nprobe = search_param
+    return index
+
+def knn_index(xq, index, k):
+    """Search a loaded faiss index. The returned rows may contain fewer than k results (padded with index -1)
+    for approximate indices (e.g., ivfpq with few inverted lists visited).
+    """
+    return index.search(np.ascontiguousarray(xq, dtype=np.float32), k)
+
+def _to_python_lists(D, I, start_idx=0, end_idx=None):
+    # convert numpy float/int array to python float/int list (and drop missing results)
+    valid = I >= 0
+    D, I = D[valid][start_idx:end_idx], I[valid][start_idx:end_idx]
+    return [float(num) for num in D], [int(idx) for idx in I]
 
 class KNearestFaissFeatureChunks():
-    def __init__(self, clip_features_normalized_paths, model, preprocess, device='cpu'):
+    def __init__(self, clip_features_normalized_paths, model, preprocess, device='cpu', feature_store=None, index_location=None, search_param=None):
+        """If index_location is None, then perform exact search over the feature shards.
+        Otherwise the saved faiss index (see build_faiss_index) is lazily loaded and used for search.
+        """
         self.clip_features_normalized_paths = clip_features_normalized_paths
-        self.total_feature_num = _get_total_feature_length(self.clip_features_normalized_paths)
+        if feature_store == None:
+            feature_store = FeatureShardStore(self.clip_features_normalized_paths)
+        self.feature_store = feature_store
+        self.total_feature_num = len(self.feature_store)
         print(f"Current chunk has {self.total_feature_num} features")
         self.model = model
         self.preprocess = preprocess
         self.device = device
+        self.index_location = index_location
+        self.search_param = search_param
+        self.index = None
+
+    def get_index(self):
+        if self.index == None:
+            self.index = load_faiss_index(self.index_location, search_param=self.search_param)
+        return self.index
+
+    def search(self, features, k, bottom_k=0):
+        """Return the top k (and bottom_k) results of features, using the faiss index if available
+        """
+        if self.index_location == None or max(k, bottom_k) > MAX_INDEX_SEARCH_K:
+            return knn_exact_top_bottom(features, self.feature_store.iter_blocks(SEARCH_BLOCK_SIZE), k, bottom_k=bottom_k)
+        D, I = self.search_index(features, k)
+        if bottom_k > 0:
+            bottom_D, bottom_I = self.search_index(-features, bottom_k)
+            return D, I, bottom_D, bottom_I
+        else:
+            return D, I, None, None
+
+    def search_index(self, features, k):
+        """Return the top k results of features using the faiss index.
+        The queries with fewer than k results from the index are searched exactly, so all rows have k results.
+        """
+        D, I = knn_index(features, self.get_index(), k)
+        short_queries = np.nonzero((I < 0).any(axis=1))[0]
+        if len(short_queries) > 0:
+            print(f"{len(short_queries)} of {len(features)} queries have fewer than {k} results from the index. Search them exactly.")
+            D[short_queries], I[short_queries] = knn_exact(features[short_queries], self.feature_store.iter_blocks(SEARCH_BLOCK_SIZE), k)
+        return D, I
     
     def grab_bottom_query_indices(self, query, start_idx=0, end_idx=2000):
         start = time.time()
@@ -173,6 +321,35 @@ class KNearestFaissFeatureChunks():
         print(f"{end_feature-start:.4f} for querying {query}. {end_search-end_feature} for computing KNN.")
         return D[start_idx:end_idx], indices[start_idx:end_idx], normalize_text_feature
         
+    def grab_top_bottom_query_indices(self, queries, start_idx=0, end_idx=2000, bottom_end_idx=0):
+        """Retrieve for all queries at once: The text features are computed in a single forward pass and
+        the top (and bottom if bottom_end_idx > 0) indices of every query are found in a single sweep over the features.
+        Returns two dictionaries (query -> the same tuple as grab_top_query_indices/grab_bottom_query_indices)
+        """
+        start = time.time()
+        normalize_text_features = self.get_normalized_text_features(queries)
+        end_feature = time.time()
+        top_k = min(end_idx, self.total_feature_num)
+        bottom_k = min(bottom_end_idx, self.total_feature_num)
+        D, I, bottom_D, bottom_I = self.search(normalize_text_features, top_k, bottom_k=bottom_k)
+        end_search = time.time()
+        print(f"{end_feature-start:.4f} for querying {len(queries)} queries. {end_search-end_feature} for computing KNN.")
+        top_results, bottom_results = {}, {}
+        for q_idx, query in enumerate(queries):
+            top_results[query] = _to_python_lists(D[q_idx], I[q_idx], start_idx, end_idx) + \
+                                 (normalize_text_features[q_idx:q_idx+1],)
+            if bottom_k > 0:
+                bottom_results[query] = _to_python_lists(bottom_D[q_idx], bottom_I[q_idx], start_idx, bottom_end_idx) + \
+                                        (-normalize_text_features[q_idx:q_idx+1],)
+        return top_results, bottom_results
+
+    def get_normalized_text_features(self, queries=["a cat"]):
+        # Encode a list of queries in a single forward pass
+        with torch.no_grad():
+            text = clip.tokenize(queries).to(self.device)
+            text_features = self.model.encode_text(text).cpu().numpy()
+        return normalize(text_features.astype(np.float32))
+
     def get_normalized_text_feature(self, query="a cat"):
         with torch.no_grad():
             text = clip.tokenize([query]).to(self.device)
@@ -194,26 +371,12 @@ class KNearestFaissFeatureChunks():
         return normalize(image_feature.astype(np.float32))
 
     def k_nearest(self, feature, k=4):
-        chunk_iter = _chunk_iterator(k, 2048) # process every 2048 indices
-        all_D, all_I = [], []
-        
-        mapping = list(range(self.total_feature_num))
-        for chunk in chunk_iter:
-            start = time.time()
-            size_chunk = len(chunk)
-            D, I = knn_ground_truth(
-                       feature,
-                       _path_iterator_for_numpy(self.clip_features_normalized_paths, mapping),
-                       size_chunk
-                   )
-            end_search = time.time()
-            all_D += list(D[0])
-            print(f"{end_search-start:.4f} seconds for searching.")
-            mapping, removed_indices = _remove_multiple_indices_at_once(mapping, list(I[0]))
-            end_remove = time.time()
-            print(f"{end_remove-start:.4f} seconds for one iteration.")
-            all_I += removed_indices
-        all_D = [float(num) for num in all_D] # convert numpy float array to python float list
+        start = time.time()
+        k = min(k, self.total_feature_num)
+        D, I, _, _ = self.search(feature, k)
+        end_search = time.time()
+        print(f"{end_search-start:.4f} seconds for searching.")
+        all_D, all_I = _to_python_lists(D[0], I[0])
         return all_D, all_I
     
     def k_nearest_meta(self, flickr_accessor, feature, k=4):
@@ -0,0 +1,206 @@
+# Memory-mapped access to the CLIP feature shards saved by prepare_dataset.py
+# Each bucket folder has features_<model>.json (the chunks of metadata and paths to the shards).
+# We additionally keep a small manifest (features_<model>_manifest.json) with the row count, dim and dtype
+# of every shard, so the shards can be opened lazily with mmap_mode='r' and only the needed rows are read.
+# The shards are assembled from a FeatureBlockStore, which keeps the extracted features keyed on photo ID.
+# The precomputed features of a training dataset (train.py) are saved with save_split_arrays as one contiguous matrix,
+# so the training loaders are index views of it instead of pickled lists of (feature, label).
+import os
+import numpy as np
+
+from utils import load_json, save_as_json, save_as_json_atomic, save_numpy_atomic
+
+FEATURE_TYPES = ['original', 'normalized']
+
+def get_manifest_location(main_save_location):
+    """Return the manifest path next to features_<model>.json
+    """
+    return os.path.splitext(main_save_location)[0] + "_manifest.json"
+
+def _get_shard_info(path):
+    # Only the header of the .npy file is read
+    matrix = np.load(path, mmap_mode='r')
+    return {
+        'path' : path,
+        'num_rows' : int(matrix.shape[0]),
+        'dim' : int(matrix.shape[1]),
+        'dtype' : str(matrix.dtype),
+    }
+
+def save_manifest(main_save_location, path_dict_list):
+    """Save (and return) the manifest of all feature shards listed in path_dict_list
+    """
+    manifest = {feature_type : [_get_shard_info(path_dict[feature_type]) for path_dict in path_dict_list]
+                for feature_type in FEATURE_TYPES}
+    manifest_location = get_manifest_location(main_save_location)
+    save_as_json(manifest_location, manifest)
+    print(f"Saved feature manifest at {manifest_location}")
+    return manifest
+
+def load_manifest(main_save_location):
+    return load_json(get_manifest_location(main_save_location))
+
+class FeatureShardStore():
+    """Wrap around a list of saved numpy feature matrices (shards) in order to access them as a single matrix.
+    Shards are memory-mapped lazily, so nothing is read before rows are requested.
+    """
+    def __init__(self, paths, shard_infos=None):
+        if shard_infos == None:
+            shard_infos = [_get_shard_info(path) for path in paths]
+        assert [info['path'] for info in shard_infos] == list(paths)
+        self.paths = list(paths)
+        self.row_counts = [info['num_rows'] for info in shard_infos]
+        self.offsets = np.cumsum([0] + self.row_counts)
+        self.dim = shard_infos[0]['dim'] if len(shard_infos) > 0 else None
+        self.dtype = np.dtype(shard_infos[0]['dtype']) if len(shard_infos) > 0 else np.dtype('float32')
+        self._shards = [None for _ in self.paths]
+
+    @classmethod
+    def from_manifest(cls, main_save_location, feature_type='normalized'):
+        """Return None if the manifest does not exist
+        """
+        manifest = load_manifest(main_save_location)
+        if manifest == None:
+            return None
+        shard_infos = manifest[feature_type]
+        return cls([info['path'] for info in shard_infos], shard_infos=shard_infos)
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def shard(self, shard_idx):
+        if type(self._shards[shard_idx]) == type(None):
+            self._shards[shard_idx] = np.load(self.paths[shard_idx], mmap_mode='r')
+        return self._shards[shard_idx]
+
+    def iter_blocks(self, block_size):
+        """Generator for consecutive row blocks (of at most block_size rows) of all shards
+        """
+        for shard_idx in range(len(self.paths)):
+            matrix = self.shard(shard_idx)
+            for i0 in range(0, matrix.shape[0], block_size):
+                yield np.asarray(matrix[i0:i0 + block_size])
+
+    def iter_selected(self, mapping):
+        """Generator for the selected rows (indicated by mapping) of each shard.
+        Rows are grouped by shard (in shard order) and keep the order of mapping within a shard.
+        """
+        mapping = np.asarray(mapping, dtype=np.int64).reshape(-1)
+        mapping = mapping[(mapping >= 0) & (mapping < len(self))]
+        shard_ids = np.searchsorted(self.offsets, mapping, side='right') - 1
+        for shard_idx in range(len(self.paths)):
+            relative_mapping = mapping[shard_ids == shard_idx] - self.offsets[shard_idx]
+            if len(relative_mapping) == 0:
+                yield np.zeros((0, self.dim), dtype=self.dtype)
+                continue
+            # Read the rows in increasing order (sequential access on the memory map)
+            sorted_rows, inverse = np.unique(relative_mapping, return_inverse=True)
+            yield np.asarray(self.shard(shard_idx)[sorted_rows])[inverse.reshape(-1)]
+
+    def take(self, mapping):
+        """Return a numpy matrix of selected features indicated by mapping (same order as iter_selected)
+        """
+        return np.concatenate(list(self.iter_selected(mapping)), axis=0)
+
+class FeatureBlockStore():
+    """An append-only store of extracted features keyed on photo ID.
+    Features are appended in blocks (block_<j>.npy + block_<j>_ids.json). A block is committed only once its
+    list of IDs is saved (after the features), so a crash loses at most the block that was being extracted.
+    """
+    def __init__(self, folder):
+        self.folder = folder
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        self.block_names = []
+        self.id_to_location = {} # key is photo ID, value is (block index, row)
+        self.next_block_number = 0
+        for file_name in sorted(os.listdir(self.folder)):
+            if not file_name.endswith("_ids.json"):
+                continue
+            block_name = file_name[:-len("_ids.json")]
+            self.next_block_number = max(self.next_block_number, int(block_name[len("block_"):]) + 1)
+            ids = load_json(os.path.join(self.folder, file_name))
+            if ids == None or not os.path.exists(self._get_block_path(block_name)):
+                continue
+            for row, ID in enumerate(ids):
+                self.id_to_location[ID] = (len(self.block_names), row)
+            self.block_names.append(block_name)
+        self._blocks = {}
+
+    def _get_block_path(self, block_name):
+        return os.path.join(self.folder, block_name + ".npy")
+
+    def _get_ids_path(self, block_name):
+        return os.path.join(self.folder, block_name + "_ids.json")
+
+    def __contains__(self, ID):
+        return ID in self.id_to_location
+
+    def __len__(self):
+        return len(self.id_to_location)
+
+    def add_block(self, ids, features):
+        assert len(ids) == features.shape[0]
+        block_name = f"block_{self.next_block_number:06d}"
+        self.next_block_number += 1
+        save_numpy_atomic(self._get_block_path(block_name), features)
+        save_as_json_atomic(self._get_ids_path(block_name), list(ids)) # commit
+        for row, ID in enumerate(ids):
+            self.id_to_location[ID] = (len(self.block_names), row)
+        self.block_names.append(block_name)
+
+    def block(self, block_idx):
+        if not block_idx in self._blocks:
+            self._blocks[block_idx] = np.load(self._get_block_path(self.block_names[block_idx]), mmap_mode='r')
+        return self._blocks[block_idx]
+
+    def take(self, ids):
+        """Return a numpy matrix of the features of ids (in the same order)
+        """
+        locations = np.array([self.id_to_location[ID] for ID in ids], dtype=np.int64).reshape(-1, 2)
+        first_block = self.block(0)
+        features = np.zeros((len(ids), first_block.shape[1]), dtype=first_block.dtype)
+        for block_idx in np.unique(locations[:, 0]):
+            selected = locations[:, 0] == block_idx
+            features[selected] = self.block(block_idx)[locations[selected, 1]]
+        return features
+
+def get_split_arrays_json_location(folder):
+    return os.path.join(folder, 'split_arrays.json')
+
+def has_split_arrays(folder):
+    return os.path.exists(get_split_arrays_json_location(folder))
+
+def save_split_arrays(folder, features_dict):
+    """Save the precomputed features of a training dataset (see train.make_features_dict), i.e.,
+    features_dict[b_idx][split] is a list of (feature, label), as a single features.npy and labels.npy.
+    Each bucket and split is a range of rows (saved in split_arrays.json, last).
+    """
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    features, labels, ranges = [], [], []
+    num_rows = 0
+    for b_idx in sorted(list(features_dict.keys())):
+        split_ranges = {}
+        for split in features_dict[b_idx]:
+            items = features_dict[b_idx][split]
+            split_ranges[split] = [num_rows, num_rows + len(items)]
+            features += [np.asarray(feature, dtype=np.float32) for feature, _ in items]
+            labels += [int(label) for _, label in items]
+            num_rows += len(items)
+        ranges.append({'bucket' : b_idx, 'splits' : split_ranges})
+    save_numpy_atomic(os.path.join(folder, 'features.npy'), np.stack(features))
+    save_numpy_atomic(os.path.join(folder, 'labels.npy'), np.array(labels, dtype=np.int64))
+    save_as_json_atomic(get_split_arrays_json_location(folder), ranges) # commit
+    print(f"Saved {num_rows} features at {folder}")
+
+def load_split_arrays(folder, mmap_mode=None):
+    """Return (features, labels, ranges) saved by save_split_arrays, where ranges[b_idx][split] = (start, end), or None if not saved
+    """
+    ranges = load_json(get_split_arrays_json_location(folder))
+    if ranges == None:
+        return None
+    features = np.load(os.path.join(folder, 'features.npy'), mmap_mode=mmap_mode)
+    labels = np.load(os.path.join(folder, 'labels.npy'), mmap_mode=mmap_mode)
+    ranges = {entry['bucket'] : {split : tuple(entry['splits'][split]) for split in entry['splits']} for entry in ranges}
+    return features, labels, ranges
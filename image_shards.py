@@ -0,0 +1,220 @@
+# Pack images into large tar shards (WebDataset-style), so that training and feature extraction read them sequentially
+# instead of opening millions of small files scattered over thousands of folders.
+# A shard folder has:
+#   shard_<k>.tar : SAMPLES_PER_SHARD samples, each stored as <key>.<ext> (the original image bytes) and <key>.cls (the label, optional)
+#   shard_<k>.json : the list of (key, image path, label) packed in shard_<k>.tar (to check a shard before reusing it after a crash)
+#   shards.json : the list of shards with their number of samples (saved last, i.e., marks the folder as complete)
+# ImageShardDataset streams the samples from the shards (with a shuffle buffer). The samples (in shard order) are split in
+# contiguous ranges between the distributed ranks and then the DataLoader workers, so every worker reads its range sequentially.
+# Examples:
+#   A bucket of prepare_dataset.py: pack_bucket(bucket_dict[i], get_image_shard_folder(folder_path))
+#   A CLEAR split (list of (path, label)): pack_labeled_images(samples, shard_folder), then training_utils.make_shard_loader(shard_folder, ...)
+import os
+import io
+import random
+import tarfile
+import torch
+from PIL import Image
+
+from utils import load_json, save_as_json_atomic
+from metadata_store import get_bucket_metadata
+
+SAMPLES_PER_SHARD = 10000
+SHUFFLE_BUFFER_SIZE = 10000 # The number of decoded-to-be samples kept in memory per worker for shuffling
+
+def get_image_shard_folder(folder_path):
+    return os.path.join(folder_path, 'image_shards')
+
+def get_shards_json_location(shard_folder):
+    return os.path.join(shard_folder, 'shards.json')
+
+def _add_member(tar, name, content):
+    tarinfo = tarfile.TarInfo(name)
+    tarinfo.size = len(content)
+    tar.addfile(tarinfo, io.BytesIO(content))
+
+def _write_shard(shard_path, shard_samples):
+    tmp_path = shard_path + ".tmp"
+    with tarfile.open(tmp_path, 'w') as tar:
+        for key, path, label in shard_samples:
+            with open(path, 'rb') as f:
+                _add_member(tar, f"{key}{os.path.splitext(path)[1]}", f.read())
+            if label != None:
+                _add_member(tar, f"{key}.cls", str(label).encode('utf-8'))
+    os.replace(tmp_path, shard_path)
+
+def _get_shard_samples_location(shard_path):
+    return os.path.splitext(shard_path)[0] + ".json"
+
+def pack_image_shards(samples, shard_folder, samples_per_shard=SAMPLES_PER_SHARD):
+    """Pack a list of (key, image path, label or None) in shards (in the same order) and return the shards dictionary.
+    Keys must be unique and must not contain '.'. The shards already saved (e.g., before a crash) are not packed again,
+    unless the number of samples has changed (or, for a shard saved before a crash, its samples have changed).
+    """
+    shards_json_location = get_shards_json_location(shard_folder)
+    shards_dict = load_json(shards_json_location)
+    if shards_dict != None:
+        if shards_dict['num_samples'] == len(samples):
+            return shards_dict
+        # e.g., more images are downloaded for this bucket
+        print(f"Repack {shard_folder} ({shards_dict['num_samples']} -> {len(samples)} images)")
+        os.remove(shards_json_location)
+        for shard in shards_dict['shards']:
+            for path in [shard['path'], _get_shard_samples_location(shard['path'])]:
+                if os.path.exists(path):
+                    os.remove(path)
+    if not os.path.exists(shard_folder):
+        os.makedirs(shard_folder)
+    shards = []
+    for shard_idx, i0 in enumerate(range(0, len(samples), samples_per_shard)):
+        shard_path = os.path.join(shard_folder, f"shard_{shard_idx:05d}.tar")
+        shard_samples = samples[i0:i0 + samples_per_shard]
+        # Reuse a shard saved before a crash only if it has the same samples (saved after the shard)
+        shard_samples_location = _get_shard_samples_location(shard_path)
+        saved_samples = load_json(shard_samples_location) if os.path.exists(shard_path) else None
+        if saved_samples != [list(sample) for sample in shard_samples]:
+            _write_shard(shard_path, shard_samples)
+            save_as_json_atomic(shard_samples_location, shard_samples)
+            print(f"Packed {len(shard_samples)} images at {shard_path}")
+        shards.append({'path' : shard_path, 'num_samples' : len(shard_samples)})
+    shards_dict = {
+        'shards' : shards,
+        'num_samples' : len(samples),
+        'has_labels' : len(samples) > 0 and samples[0][2] != None,
+    }
+    save_as_json_atomic(shards_json_location, shards_dict) # commit
+    return shards_dict
+
+def pack_bucket(bucket_dict_i, shard_folder, samples_per_shard=SAMPLES_PER_SHARD, meta_list=None):
+    """Pack the images of a bucket (see prepare_dataset.save_bucket_dict) keyed by photo ID, in bucket order
+    meta_list is the metadata of the bucket with at least ID, IMG_DIR and IMG_PATH (loaded from the metadata store if None)
+    """
+    if meta_list == None:
+        meta_list = get_bucket_metadata(bucket_dict_i, columns=['ID', 'IMG_DIR', 'IMG_PATH'])
+    samples = [(meta['ID'], os.path.join(meta['IMG_DIR'], meta['IMG_PATH']), None) for meta in meta_list]
+    return pack_image_shards(samples, shard_folder, samples_per_shard=samples_per_shard)
+
+def pack_labeled_images(samples, shard_folder, samples_per_shard=SAMPLES_PER_SHARD):
+    """Pack a CLEAR dataset split, i.e., a list of (image path, label) as in training_utils.SimpleDataset (keyed by position)
+    """
+    samples = [(f"{i:09d}", path, label) for i, (path, label) in enumerate(samples)]
+    return pack_image_shards(samples, shard_folder, samples_per_shard=samples_per_shard)
+
+def iter_shard(shard_path, start=0, end=None):
+    """Generator for (key, image bytes, label or None) of the samples start to end (excluded) of a tar shard (read sequentially).
+    The samples before start are skipped without reading their content.
+    """
+    key, content, label = None, None, None
+    sample_idx = -1
+    with tarfile.open(shard_path, 'r') as tar:
+        for tarinfo in tar:
+            member_key, ext = tarinfo.name.split(".", 1)
+            if member_key != key:
+                if key != None and sample_idx >= start:
+                    yield key, content, label
+                sample_idx += 1
+                if end != None and sample_idx >= end:
+                    return
+                key, content, label = member_key, None, None
+            if sample_idx < start:
+                continue
+            data = tar.extractfile(tarinfo).read()
+            if ext == 'cls':
+                label = int(data.decode('utf-8'))
+            else:
+                content = data
+    if key != None and sample_idx >= start:
+        yield key, content, label
+
+class ImageShardDataset(torch.utils.data.IterableDataset):
+    """Stream (image, label) (or (image, key) if return_key) from the shards of pack_image_shards.
+    With shuffle, the order of the shards is shuffled (call set_epoch() before each epoch) and the samples go through a shuffle buffer.
+    The samples (in shard order) are split in contiguous ranges between the ranks, and then between the DataLoader workers of each rank.
+    Every rank gets the same number of samples, and every worker yields a multiple of batch_size samples, so with drop_last=True
+    all ranks run the same number of batches (at most batch_size - 1 samples per rank and the last num_samples % world_size are skipped).
+    If keys is not None, only the samples with these keys are decoded, and every sample is read (by exactly one worker).
+    """
+    def __init__(self, shard_folder, transform, shuffle=False, shuffle_buffer_size=SHUFFLE_BUFFER_SIZE, keys=None, return_key=False, rank=0, world_size=1, seed=0, batch_size=1):
+        self.shards_dict = load_json(get_shards_json_location(shard_folder))
+        if self.shards_dict == None:
+            raise FileNotFoundError(f"{shard_folder} is not packed yet")
+        self.shards = self.shards_dict['shards']
+        self.transform = transform
+        self.shuffle = shuffle
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.keys = keys
+        self.return_key = return_key
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.batch_size = batch_size
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        # The number of samples per rank (approximate if keys is not None)
+        if self.keys != None:
+            return len(self.keys)
+        num_samples_per_rank = self.shards_dict['num_samples'] // self.world_size
+        return num_samples_per_rank // self.batch_size * self.batch_size
+
+    def _get_worker_range(self, rank, worker_id, num_workers):
+        # Return the range [start, end) of the samples (in shard order) read by a worker of a rank
+        num_samples = self.shards_dict['num_samples']
+        if self.keys != None:
+            rank_start = rank * num_samples // self.world_size
+            rank_size = (rank + 1) * num_samples // self.world_size - rank_start
+            return rank_start + worker_id * rank_size // num_workers, rank_start + (worker_id + 1) * rank_size // num_workers
+        # The full batches of a rank are split between its workers, the same way for all ranks
+        rank_size = num_samples // self.world_size
+        num_batches = rank_size // self.batch_size
+        worker_batches = [num_batches // num_workers + (1 if w < num_batches % num_workers else 0) for w in range(num_workers)]
+        start = rank * rank_size + sum(worker_batches[:worker_id]) * self.batch_size
+        return start, start + worker_batches[worker_id] * self.batch_size
+
+    def _iter_raw(self):
+        worker_info = torch.utils.data.get_worker_info()
+        num_workers = worker_info.num_workers if worker_info != None else 1
+        worker_id = worker_info.id if worker_info != None else 0
+        order = list(range(len(self.shards)))
+        if self.shuffle:
+            random.Random(self.seed + self.epoch).shuffle(order)
+        start, end = self._get_worker_range(self.rank, worker_id, num_workers)
+        shard_start = 0
+        for shard_idx in order:
+            shard_end = shard_start + self.shards[shard_idx]['num_samples']
+            if shard_start < end and start < shard_end:
+                for sample in iter_shard(self.shards[shard_idx]['path'], max(start - shard_start, 0), min(end, shard_end) - shard_start):
+                    if self.keys != None and not sample[0] in self.keys:
+                        continue
+                    yield sample
+            shard_start = shard_end
+
+    def _decode(self, sample):
+        key, content, label = sample
+        image = Image.open(io.BytesIO(content)).convert('RGB')
+        image = self.transform(image)
+        if self.return_key:
+            return image, key
+        return image, label if label != None else 0
+
+    def __iter__(self):
+        if not self.shuffle:
+            for sample in self._iter_raw():
+                yield self._decode(sample)
+            return
+        worker_info = torch.utils.data.get_worker_info()
+        rng = random.Random(self.seed + self.epoch * 1000003 + self.rank * 1009 + (worker_info.id if worker_info != None else 0))
+        buffer = []
+        for sample in self._iter_raw():
+            if len(buffer) < self.shuffle_buffer_size:
+                buffer.append(sample)
+                continue
+            idx = rng.randrange(len(buffer))
+            buffer[idx], sample = sample, buffer[idx]
+            yield self._decode(sample)
+        rng.shuffle(buffer)
+        for sample in buffer:
+            yield self._decode(sample)
@@ -0,0 +1,75 @@
+# Content-addressed storage of the downloaded images, keyed on the MD5 hash of the downloaded bytes
+# Each distinct image is saved once at <img_dir>/objects/<first two hex digits>/<md5>, and all other paths of this image are hardlinks:
+#   <save_folder>/<folder_idx>/images/<ID>.<EXT> (see yfcc_download.py), for every ID with this HASH_VALUE and every save folder
+#   the per-class folders of a dataset (see prepare_concepts.py) and the mturk folders
+# The downloaded bytes (e.g., a resized image) may not match HASH_VALUE in YFCC100M, so the images are looked up before
+# downloading via an index from HASH_VALUE to the MD5 of the downloaded bytes: <img_dir>/objects/index/<index_name>/<first two hex digits>/<HASH_VALUE>
+# The index is separate per index_name (the size option), since the downloaded bytes of the same HASH_VALUE differ between sizes.
+# So re-uploads of the same image are downloaded and stored once, and materializing a dataset does not copy any image.
+import os
+import hashlib
+import threading
+
+from utils import link_or_copy
+
+def get_image_store_folder(img_dir):
+    return os.path.join(img_dir, 'objects')
+
+class ImageStore():
+    """A folder of image files named by their MD5 hash. The files are never modified once saved.
+    Images can also be found by a key (HASH_VALUE) if saved with put(content, key=key).
+    """
+    def __init__(self, store_folder, index_name='original'):
+        self.store_folder = store_folder
+        self.index_folder = os.path.join(store_folder, 'index', index_name)
+        if not os.path.exists(self.store_folder):
+            os.makedirs(self.store_folder)
+
+    def get_path(self, hash_value):
+        return os.path.join(self.store_folder, hash_value[:2], hash_value)
+
+    def _get_index_path(self, key):
+        return os.path.join(self.index_folder, key[:2], key)
+
+    def _save(self, path, content):
+        # A temporary file per thread, since duplicates may be downloaded at the same time
+        folder = os.path.dirname(path)
+        if not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}_{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    def resolve(self, key):
+        """Return the MD5 hash of the stored image saved with key, or None if there is none
+        """
+        if key == None:
+            return None
+        index_path = self._get_index_path(key)
+        if not os.path.exists(index_path):
+            return None
+        with open(index_path, 'r') as f:
+            hash_value = f.read().strip()
+        if not os.path.exists(self.get_path(hash_value)):
+            return None
+        return hash_value
+
+    def __contains__(self, key):
+        return self.resolve(key) != None
+
+    def put(self, content, key=None):
+        """Save content (if not yet in the store) and return its MD5 hash. If key is not None, it is indexed to this hash.
+        """
+        hash_value = hashlib.md5(content).hexdigest()
+        path = self.get_path(hash_value)
+        if not os.path.exists(path):
+            self._save(path, content)
+        if key != None and self.resolve(key) != hash_value:
+            self._save(self._get_index_path(key), hash_value.encode())
+        return hash_value
+
+    def link(self, hash_value, img_path):
+        """Make img_path a hardlink to the stored image with hash_value
+        """
+        link_or_copy(self.get_path(hash_value), img_path)
@@ -0,0 +1,337 @@
+# Columnar storage of the metadata of downloaded YFCC100M images (instead of lists of dictionaries in metadata.json)
+# Each downloaded folder has a metadata_columns/ folder with:
+#   columns.json : the number of rows, the column names and the autotag vocabulary (saved last, i.e., marks the folder as complete)
+#   <NAME>.npy : integer columns (e.g., ID, DATE_UPLOADED, LINE_NUM) as int64/int8 arrays
+#   <NAME>_offsets.npy + <NAME>_data.npy : string columns as a pool of utf-8 bytes (row i is data[offsets[i]:offsets[i+1]])
+#   <NAME>_null.npy : (optional) mask of rows with None value in a string column
+#   AUTO_TAG_SCORES_{indptr,indices,scores}.npy : the autotag scores as a sparse (CSR) matrix of size (num_rows x len(vocab))
+# Only the requested columns are loaded (e.g., bucketing only needs ID, DATE_UPLOADED and LINE_NUM)
+# A bucket (see prepare_dataset.save_bucket_dict) refers to the rows of a saved MetadataStore by index:
+#   bucket_<i>.json : a small manifest with the bucket folder, date range, and the locations of the store and the indices
+#   bucket_<i>_indices.npy : the row indices (int64) of the images in this bucket (sorted by upload time)
+import os
+import numpy as np
+
+from utils import load_json, save_as_json_atomic
+
+INT_COLUMNS = {
+    'ID' : 'int64',
+    'DATE_UPLOADED' : 'int64',
+    'LINE_NUM' : 'int64',
+    'IMG_OR_VIDEO' : 'int8',
+    'LINE_IDX' : 'int64', # Only in the ingested shards (see yfcc_ingest.py)
+    'VALID_DATE' : 'int8', # Only in the ingested shards (see yfcc_ingest.py)
+}
+INT_COLUMNS_AS_STR = ['ID', 'DATE_UPLOADED', 'LINE_NUM'] # These are strings in the metadata dictionaries
+AUTO_TAG_COLUMN = 'AUTO_TAG_SCORES'
+
+def get_columns_json_path(columns_folder):
+    return os.path.join(columns_folder, "columns.json")
+
+def has_metadata_columns(columns_folder):
+    return os.path.exists(get_columns_json_path(columns_folder))
+
+def _save_string_pool(columns_folder, name, offsets, data):
+    np.save(os.path.join(columns_folder, f"{name}_offsets.npy"), offsets)
+    np.save(os.path.join(columns_folder, f"{name}_data.npy"), data)
+
+def _save_string_column(columns_folder, name, values):
+    null = np.array([v == None for v in values], dtype=bool)
+    encoded = [b"" if v == None else str(v).encode('utf-8') for v in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(e) for e in encoded])
+    data = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    _save_string_pool(columns_folder, name, offsets, data)
+    if null.any():
+        np.save(os.path.join(columns_folder, f"{name}_null.npy"), null)
+
+def _save_autotag_column(columns_folder, values):
+    vocab = {}
+    indptr = np.zeros(len(values) + 1, dtype=np.int64)
+    indices, scores = [], []
+    for i, tag_scores in enumerate(values):
+        for tag in tag_scores:
+            if not tag in vocab:
+                vocab[tag] = len(vocab)
+            indices.append(vocab[tag])
+            scores.append(tag_scores[tag])
+        indptr[i+1] = len(indices)
+    np.save(os.path.join(columns_folder, f"{AUTO_TAG_COLUMN}_indptr.npy"), indptr)
+    np.save(os.path.join(columns_folder, f"{AUTO_TAG_COLUMN}_indices.npy"), np.array(indices, dtype=np.int32))
+    np.save(os.path.join(columns_folder, f"{AUTO_TAG_COLUMN}_scores.npy"), np.array(scores, dtype=np.float32))
+    return sorted(vocab.keys(), key=lambda tag: vocab[tag])
+
+def save_metadata_columns(columns_folder, metadata_list):
+    """Save a list of metadata dictionaries (see yfcc_download._parse_metadata) in columnar format
+    """
+    if not os.path.exists(columns_folder):
+        os.makedirs(columns_folder)
+    names = []
+    for meta in metadata_list:
+        for name in meta:
+            if not name in names:
+                names.append(name)
+    int_columns, string_columns = [], []
+    autotag_vocab = []
+    for name in names:
+        values = [meta.get(name, None) for meta in metadata_list]
+        if name == AUTO_TAG_COLUMN:
+            autotag_vocab = _save_autotag_column(columns_folder, [v if v else {} for v in values])
+        elif name in INT_COLUMNS:
+            np.save(os.path.join(columns_folder, f"{name}.npy"), np.array([int(v) for v in values], dtype=INT_COLUMNS[name]))
+            int_columns.append(name)
+        else:
+            _save_string_column(columns_folder, name, values)
+            string_columns.append(name)
+    columns_dict = {
+        'num_rows' : len(metadata_list),
+        'int_columns' : int_columns,
+        'string_columns' : string_columns,
+        'has_autotags' : AUTO_TAG_COLUMN in names,
+        'autotag_vocab' : autotag_vocab,
+    }
+    save_as_json_atomic(get_columns_json_path(columns_folder), columns_dict) # commit
+
+class StringColumn():
+    """A memory-mapped pool of utf-8 strings
+    """
+    def __init__(self, offsets, data, null=None):
+        self.offsets = offsets
+        self.data = data
+        self.null = null
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        if type(self.null) != type(None) and self.null[idx]:
+            return None
+        return self.data[self.offsets[idx]:self.offsets[idx+1]].tobytes().decode('utf-8')
+
+    def take(self, indices):
+        """Same as [self[idx] for idx in indices], with the selected strings gathered from the pool at once
+        """
+        indices = np.asarray(indices, dtype=np.int64).reshape(-1)
+        offsets, data = self.take_pool(indices)
+        pool = data.tobytes()
+        offsets = offsets.tolist()
+        values = [pool[offsets[i]:offsets[i+1]].decode('utf-8') for i in range(len(indices))]
+        if type(self.null) != type(None):
+            for i in np.nonzero(np.asarray(self.null)[indices])[0]:
+                values[i] = None
+        return values
+
+    def take_pool(self, indices):
+        """Return (offsets, data) of the selected strings, without decoding them (null is not kept)
+        """
+        indices = np.asarray(indices, dtype=np.int64).reshape(-1)
+        all_offsets = np.asarray(self.offsets)
+        starts = all_offsets[indices]
+        lengths = all_offsets[indices + 1] - starts
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths)
+        positions = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return offsets, np.asarray(self.data)[positions]
+
+def save_column_arrays(columns_folder, int_arrays, string_pools):
+    """Save integer columns (dictionary of numpy arrays) and string columns (dictionary of (offsets, data), see StringColumn.take_pool)
+    in the same format as save_metadata_columns, without building the metadata dictionaries
+    """
+    if not os.path.exists(columns_folder):
+        os.makedirs(columns_folder)
+    num_rows = None
+    for name, array in int_arrays.items():
+        num_rows = len(array)
+        np.save(os.path.join(columns_folder, f"{name}.npy"), np.asarray(array, dtype=INT_COLUMNS[name]))
+    for name, (offsets, data) in string_pools.items():
+        num_rows = len(offsets) - 1
+        _save_string_pool(columns_folder, name, offsets, data)
+    columns_dict = {
+        'num_rows' : num_rows if num_rows != None else 0,
+        'int_columns' : list(int_arrays.keys()),
+        'string_columns' : list(string_pools.keys()),
+        'has_autotags' : False,
+        'autotag_vocab' : [],
+    }
+    save_as_json_atomic(get_columns_json_path(columns_folder), columns_dict) # commit
+
+class MetadataColumns():
+    """Columnar metadata of a single downloaded folder. Columns are loaded lazily (memory-mapped).
+    """
+    def __init__(self, columns_folder):
+        self.columns_folder = columns_folder
+        self.columns_dict = load_json(get_columns_json_path(columns_folder))
+        self.num_rows = self.columns_dict['num_rows']
+        self._columns = {}
+
+    def __len__(self):
+        return self.num_rows
+
+    def column_names(self):
+        names = self.columns_dict['int_columns'] + self.columns_dict['string_columns']
+        if self.columns_dict['has_autotags']:
+            names.append(AUTO_TAG_COLUMN)
+        return names
+
+    def _load(self, file_name):
+        return np.load(os.path.join(self.columns_folder, file_name), mmap_mode='r')
+
+    def get_column(self, name):
+        """Return a numpy array for integer columns, a StringColumn for string columns,
+        or (indptr, indices, scores, vocab) for the autotag scores
+        """
+        if not name in self._columns:
+            if self.num_rows == 0 and name in INT_COLUMNS: # e.g., no image is downloaded in this folder
+                self._columns[name] = np.zeros(0, dtype=INT_COLUMNS[name])
+            elif name in self.columns_dict['int_columns']:
+                self._columns[name] = self._load(f"{name}.npy")
+            elif name in self.columns_dict['string_columns']:
+                null_path = os.path.join(self.columns_folder, f"{name}_null.npy")
+                null = np.load(null_path) if os.path.exists(null_path) else None
+                self._columns[name] = StringColumn(self._load(f"{name}_offsets.npy"), self._load(f"{name}_data.npy"), null=null)
+            elif name == AUTO_TAG_COLUMN and self.columns_dict['has_autotags']:
+                self._columns[name] = (self._load(f"{name}_indptr.npy"),
+                                       self._load(f"{name}_indices.npy"),
+                                       self._load(f"{name}_scores.npy"),
+                                       self.columns_dict['autotag_vocab'])
+            else:
+                raise KeyError(name)
+        return self._columns[name]
+
+    def get_value(self, name, idx):
+        column = self.get_column(name)
+        if name == AUTO_TAG_COLUMN:
+            indptr, indices, scores, vocab = column
+            # str() of a float32 is its shortest repr, i.e., the score as written in the dataset file
+            return {vocab[int(t)] : float(str(s)) for t, s in zip(indices[indptr[idx]:indptr[idx+1]], scores[indptr[idx]:indptr[idx+1]])}
+        elif name in INT_COLUMNS_AS_STR:
+            return str(int(column[idx]))
+        elif name in self.columns_dict['int_columns']:
+            return int(column[idx])
+        else:
+            return column[idx]
+
+    def get_values(self, name, rows):
+        """Same as [self.get_value(name, row) for row in rows], with the column read once
+        """
+        column = self.get_column(name)
+        rows = np.asarray(rows, dtype=np.int64).reshape(-1)
+        if name == AUTO_TAG_COLUMN:
+            return [self.get_value(name, int(row)) for row in rows]
+        elif name in INT_COLUMNS_AS_STR:
+            return [str(v) for v in np.asarray(column[rows]).tolist()]
+        elif name in self.columns_dict['int_columns']:
+            return np.asarray(column[rows]).tolist()
+        else:
+            return column.take(rows)
+
+class MetadataStore():
+    """Wrap around the columnar metadata of all downloaded folders in order to access them as a single table,
+    in the same order as yfcc_download.get_all_metadata()
+    """
+    def __init__(self, columns_folders):
+        self.columns_folders = list(columns_folders)
+        self.folders = [MetadataColumns(columns_folder) for columns_folder in self.columns_folders]
+        self.offsets = np.cumsum([0] + [len(f) for f in self.folders])
+
+    def to_dict(self):
+        return {
+            'columns_folders' : self.columns_folders,
+            'num_rows' : [len(f) for f in self.folders],
+        }
+
+    def save(self, store_location):
+        """Save the list of folders, so the row indices of this store can be resolved later (see load_metadata_store)
+        """
+        save_as_json_atomic(store_location, self.to_dict())
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def load_columns(self, columns):
+        """Return a dictionary of (concatenated) numpy arrays for the integer columns (column projection)
+        """
+        columns_dict = {}
+        for name in columns:
+            assert name in INT_COLUMNS, f"{name} is not an integer column. Use get_records() instead."
+            arrays = [np.asarray(f.get_column(name)) for f in self.folders]
+            columns_dict[name] = np.concatenate(arrays) if len(arrays) > 0 else np.zeros(0, dtype=INT_COLUMNS[name])
+        return columns_dict
+
+    def load_autotags(self):
+        """Return the autotag scores of all images as a sparse (CSR) matrix (indptr, indices, scores) with a global vocab
+        """
+        vocab = {}
+        indptrs, all_indices, all_scores = [np.zeros(1, dtype=np.int64)], [], []
+        for f in self.folders:
+            if len(f) == 0:
+                continue
+            indptr, indices, scores, folder_vocab = f.get_column(AUTO_TAG_COLUMN)
+            for tag in folder_vocab:
+                if not tag in vocab:
+                    vocab[tag] = len(vocab)
+            mapping = np.array([vocab[tag] for tag in folder_vocab], dtype=np.int32)
+            all_indices.append(mapping[np.asarray(indices)] if len(folder_vocab) > 0 else np.zeros(0, dtype=np.int32))
+            all_scores.append(np.asarray(scores))
+            indptrs.append(np.asarray(indptr[1:]) + indptrs[-1][-1])
+        vocab = sorted(vocab.keys(), key=lambda tag: vocab[tag])
+        return np.concatenate(indptrs), np.concatenate(all_indices), np.concatenate(all_scores), vocab
+
+    def get_records(self, indices, columns=None):
+        """Return a list of metadata dictionaries (with only the requested columns, or all if None) of the selected rows
+        """
+        indices = np.asarray(indices, dtype=np.int64).reshape(-1)
+        folder_ids = np.searchsorted(self.offsets, indices, side='right') - 1
+        # Read each column once per folder (for all selected rows of this folder), then build the dictionaries in the order of indices
+        order = np.argsort(folder_ids, kind='stable')
+        starts = np.searchsorted(folder_ids[order], np.arange(len(self.folders) + 1))
+        records = [None] * len(indices)
+        for folder_idx, f in enumerate(self.folders):
+            positions = order[starts[folder_idx]:starts[folder_idx+1]]
+            if len(positions) == 0:
+                continue
+            names = f.column_names() if columns == None else columns
+            rows = indices[positions] - self.offsets[folder_idx]
+            values = [f.get_values(name, rows) for name in names]
+            for position, row_values in zip(positions.tolist(), zip(*values)):
+                records[position] = dict(zip(names, row_values))
+        return records
+
+_METADATA_STORES = {} # Cache of the loaded stores (key is the location)
+
+def load_metadata_store(store_location):
+    if not store_location in _METADATA_STORES:
+        store_dict = load_json(store_location)
+        metadata_store = MetadataStore(store_dict['columns_folders'])
+        if metadata_store.to_dict() != store_dict:
+            # e.g., more images are downloaded in these folders after the buckets are saved
+            raise ValueError(f"The metadata folders listed in {store_location} are changed. Re-run prepare_dataset.save_bucket_dict to recompute the buckets.")
+        _METADATA_STORES[store_location] = metadata_store
+    return _METADATA_STORES[store_location]
+
+def get_bucket_indices_location(bucket_folder, bucket_idx):
+    return os.path.join(bucket_folder, f'bucket_{bucket_idx}_indices.npy')
+
+def load_bucket_indices(bucket_dict_i):
+    return np.load(bucket_dict_i['indices_location'])
+
+def get_bucket_size(bucket_dict_i):
+    if 'all_metadata' in bucket_dict_i: # saved before the buckets refer to a metadata store
+        return len(bucket_dict_i['all_metadata'])
+    return bucket_dict_i['num_images']
+
+def get_bucket_metadata(bucket_dict_i, positions=None, columns=None):
+    """Return the list of metadata dictionaries of a bucket (only the selected positions in the bucket if not None).
+    If columns is not None, only these fields are loaded (e.g., ['IMG_DIR', 'IMG_PATH'] for the image paths).
+    """
+    if 'all_metadata' in bucket_dict_i: # saved before the buckets refer to a metadata store
+        all_metadata = bucket_dict_i['all_metadata']
+        if type(positions) != type(None):
+            all_metadata = [all_metadata[i] for i in positions]
+        if columns == None:
+            return all_metadata
+        return [{name : meta[name] for name in columns} for meta in all_metadata]
+    indices = load_bucket_indices(bucket_dict_i)
+    if type(positions) != type(None):
+        indices = indices[np.asarray(positions, dtype=np.int64)]
+    return load_metadata_store(bucket_dict_i['metadata_store_location']).get_records(indices, columns=columns)
@@ -29,13 +29,25 @@ import moco.builder
 # Added
 import json
 from torchvision.datasets.folder import default_loader
+from metadata_store import get_bucket_metadata
+from image_shards import ImageShardDataset, pack_bucket, get_image_shard_folder, SHUFFLE_BUFFER_SIZE
 
 def get_samples_from_data(data):
     with open(data, 'r') as f:
         bucket_dict = json.load(f)
-    all_metadata = bucket_dict['all_metadata']
+    # Only the image paths are loaded from the metadata store
+    all_metadata = get_bucket_metadata(bucket_dict, columns=['IMG_DIR', 'IMG_PATH'])
     return [os.path.join(meta['IMG_DIR'], meta['IMG_PATH']) for meta in all_metadata]
 
+def get_image_shard_folder_of_data(data):
+    # The bucket json (bucket_<i>.json) is saved in the bucket folder
+    return get_image_shard_folder(os.path.dirname(os.path.abspath(data)))
+
+def pack_data(data):
+    with open(data, 'r') as f:
+        bucket_dict = json.load(f)
+    pack_bucket(bucket_dict, get_image_shard_folder_of_data(data))
+
 def get_yfcc_dataset_for_training(data, transforms):
     samples = get_samples_from_data(data)
     return YFCCDataset(samples, transforms)
@@ -69,6 +81,10 @@ parser.add_argument('-a', '--arch', metavar='ARCH', default='resnet50',
                     help='model architecture: ' +
                         ' | '.join(model_names) +
                         ' (default: resnet50)')
+parser.add_argument('--image-shards', action='store_true',
+                    help='pack the images of the bucket into tar shards (once) and stream them sequentially (see image_shards.py)')
+parser.add_argument('--shuffle-buffer', default=SHUFFLE_BUFFER_SIZE, type=int,
+                    help='the number of samples in the shuffle buffer of each data loading worker (only with --image-shards)')
 parser.add_argument('-j', '--workers', default=32, type=int, metavar='N',
                     help='number of data loading workers (default: 32)')
 parser.add_argument('--epochs', default=200, type=int, metavar='N',
@@ -156,6 +172,10 @@ def main():
 
     args.distributed = args.world_size > 1 or args.multiprocessing_distributed
 
+    if args.image_shards:
+        # Pack once before the processes are spawned
+        pack_data(args.data)
+
     ngpus_per_node = torch.cuda.device_count()
     print(f"ngpus_per_node is {ngpus_per_node}")
     if args.multiprocessing_distributed:
@@ -279,21 +299,36 @@ def main_worker(gpu, ngpus_per_node, args):
             normalize
         ]
 
-    train_dataset = get_yfcc_dataset_for_training(
-        args.data,
-        moco.loader.TwoCropsTransform(transforms.Compose(augmentation)))
-
-    if args.distributed:
-        train_sampler = torch.utils.data.distributed.DistributedSampler(train_dataset)
-    else:
+    if args.image_shards:
+        # The samples are split between the ranks by the dataset itself (no sampler)
+        train_dataset = ImageShardDataset(
+            get_image_shard_folder_of_data(args.data),
+            moco.loader.TwoCropsTransform(transforms.Compose(augmentation)),
+            shuffle=True,
+            shuffle_buffer_size=args.shuffle_buffer,
+            rank=args.rank if args.distributed else 0,
+            world_size=args.world_size if args.distributed else 1,
+            seed=args.seed if args.seed is not None else 0,
+            batch_size=args.batch_size)
         train_sampler = None
+    else:
+        train_dataset = get_yfcc_dataset_for_training(
+            args.data,
+            moco.loader.TwoCropsTransform(transforms.Compose(augmentation)))
+
+        if args.distributed:
+            train_sampler = torch.utils.data.distributed.DistributedSampler(train_dataset)
+        else:
+            train_sampler = None
 
     train_loader = torch.utils.data.DataLoader(
-        train_dataset, batch_size=args.batch_size, shuffle=(train_sampler is None),
+        train_dataset, batch_size=args.batch_size, shuffle=(train_sampler is None and not args.image_shards),
         num_workers=args.workers, pin_memory=True, sampler=train_sampler, drop_last=True)
 
     for epoch in range(args.start_epoch, args.epochs):
-        if args.distributed:
+        if args.image_shards:
+            train_dataset.set_epoch(epoch)
+        elif args.distributed:
             train_sampler.set_epoch(epoch)
         adjust_learning_rate(optimizer, epoch, args)
 
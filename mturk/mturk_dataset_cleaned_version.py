@@ -15,7 +15,7 @@ import random
 
 import numpy as np
 from training_utils import get_imgnet_transforms, get_unnormalize_func
-from utils import save_obj_as_pickle, load_pickle, normalize, divide
+from utils import save_obj_as_pickle, load_pickle, normalize, divide, link_or_copy
 
 import torch
 from torch.utils.data import Dataset
@@ -149,7 +149,7 @@ def gather_new_query_dict(csv_file_dict, query_dict_index_by_ID, samples_per_cla
                 new_name = str(ID) + "." + EXT
                 new_path = os.path.join(image_folder_b_query, new_name)
                 try:
-                    shutil.copy(old_path, new_path)
+                    link_or_copy(old_path, new_path)
                 except:
                     # print(old_path + f" is the same (idx {item_idx})?")
                     import pdb; pdb.set_trace()
@@ -15,7 +15,7 @@ import random
 
 import numpy as np
 from training_utils import get_imgnet_transforms, get_unnormalize_func
-from utils import save_obj_as_pickle, load_pickle, normalize, divide
+from utils import save_obj_as_pickle, load_pickle, normalize, divide, link_or_copy
 
 import torch
 from torch.utils.data import Dataset
@@ -173,7 +173,7 @@ if __name__ == "__main__":
                     new_name = str(ID) + "." + EXT
                     cropped_path = os.path.join(cropped_dir, str(b_idx), query, new_name)
                     original_path = os.path.join(original_dir, str(b_idx), query, new_name)
-                    shutil.copy(old_path, original_path)
+                    link_or_copy(old_path, original_path)
                     img = default_loader(old_path)
                     # max_size, min_size = max(img.size), min(img.size)
                     # if max_size/min_size > 2:
@@ -14,7 +14,8 @@ import shutil
 
 import argparse
 import prepare_dataset
-from utils import divide, normalize, load_json, save_as_json
+from utils import divide, normalize, load_json, save_as_json, link_or_copy
+from metadata_store import get_bucket_metadata
 
 device = "cuda" if torch.cuda.is_available() else "cpu"
 
@@ -58,6 +59,15 @@ def prepare_dataset_folder(concept_group_dict, bucket_indices):
                 os.makedirs(os.path.join(save_path, bucket_idx, 'BACKGROUND'))
         print(f"Save dataset folder at {save_path}")
 
+def get_precomputed_retrieval_func(results):
+    """Return a retrieval_func (same signature as KNearestFaissFeatureChunks.grab_top_query_indices)
+    that looks up the results of KNearestFaissFeatureChunks.grab_top_bottom_query_indices
+    """
+    def retrieval_func(query, start_idx=0, end_idx=2000):
+        D, indices, text_feature = results[query]
+        return D[start_idx:end_idx], indices[start_idx:end_idx], text_feature
+    return retrieval_func
+
 def retrieve_examples(prompts, # a dictionary of key (label) and value (prompt)
                       retrieval_func,
                       clip_features_normalized_paths,
@@ -75,7 +85,7 @@ def retrieve_examples(prompts, # a dictionary of key (label) and value (prompt)
             # D is cosine scores
             D, indices, text_feature = retrieval_func(prompt, end_idx=nn_size)
             # selected_clip_features = faiss_utils.aggregate_for_numpy(clip_features_normalized_paths, indices)
-            selected_metadata = [bucket_dict_b_idx['all_metadata'][i] for i in indices]
+            selected_metadata = get_bucket_metadata(bucket_dict_b_idx, positions=indices)
             for d_idx, unique_idx in enumerate(indices):
                 if unique_idx in indices_dict:
                     indices_dict[unique_idx]['D'].append(D[d_idx])
@@ -121,7 +131,7 @@ def retrieve_examples(prompts, # a dictionary of key (label) and value (prompt)
             prompt = prompts[label]
             D, indices, text_feature = retrieval_func(prompt, end_idx=class_size)
             # selected_clip_features = faiss_utils.aggregate_for_numpy(clip_features_normalized_paths, indices)
-            selected_metadata = [bucket_dict_b_idx['all_metadata'][i] for i in indices]
+            selected_metadata = get_bucket_metadata(bucket_dict_b_idx, positions=indices)
             for d_idx, unique_idx in enumerate(indices):
                 if unique_idx in indices_dict:
                     indices_dict[unique_idx]['D'].append(D[d_idx])
@@ -254,7 +264,9 @@ if __name__ == '__main__':
         k_nearest_func = prepare_dataset.get_knearest_models_func(
                              bucket_dict,
                              cg['CLIP_MODEL'],
-                             device=device
+                             device=device,
+                             index_type=cg.get('INDEX_TYPE', None), # Default is exact search
+                             search_param=cg.get('INDEX_SEARCH_PARAM', None)
                          )
 
         for b_idx, folder_path in zip(bucket_indices, folder_paths):
@@ -273,10 +285,16 @@ if __name__ == '__main__':
                 print(f"Starting querying for bucket {b_idx}. Result will be saved at {dataset_dict_i_path}")
             
             k_near_faiss = k_nearest_func(b_idx)
+            # Query all prompts (top and bottom) in a single sweep over the features of this bucket
+            top_results, bottom_results = k_near_faiss.grab_top_bottom_query_indices(
+                list(prompts.values()),
+                end_idx=cg['NUM_OF_IMAGES_PER_CLASS_PER_BUCKET_TO_QUERY'],
+                bottom_end_idx=cg['NUM_OF_IMAGES_PER_CLASS_PER_BUCKET_TO_QUERY'] if cg['BACKGROUND'] else 0,
+            )
 
             positive_dataset_dict_b_idx = retrieve_examples(
                 prompts,
-                k_near_faiss.grab_top_query_indices,
+                get_precomputed_retrieval_func(top_results),
                 clip_features_normalized_paths,
                 bucket_dict[b_idx],
                 allow_overlap=cg['ALLOW_OVERLAP'],
@@ -287,7 +305,7 @@ if __name__ == '__main__':
             if cg['BACKGROUND']:
                 negative_dataset_dict_b_idx = retrieve_examples(
                     prompts,
-                    k_near_faiss.grab_bottom_query_indices,
+                    get_precomputed_retrieval_func(bottom_results),
                     clip_features_normalized_paths,
                     bucket_dict[b_idx],
                     allow_overlap=False,
@@ -323,6 +341,6 @@ if __name__ == '__main__':
                 ID = meta['ID']
                 EXT = meta['EXT']
                 transfer_path = os.path.join(save_folder_path_label, f"{ID}.{EXT}")
-                shutil.copy(original_path, transfer_path)
+                link_or_copy(original_path, transfer_path)
         print(f"Finish transferring images to {save_folder_path}")
     
@@ -33,14 +33,21 @@ import torch
 from torch.utils.data import Dataset
 import sys
 sys.path.append("./CLIP")
-from faiss_utils import KNearestFaissFeatureChunks
+from faiss_utils import KNearestFaissFeatureChunks, INDEX_TYPES, build_faiss_index, save_faiss_index
+from feature_store import FeatureShardStore, FeatureBlockStore, save_manifest
+from image_shards import ImageShardDataset, pack_bucket, get_image_shard_folder
+from metadata_store import get_bucket_indices_location, get_bucket_metadata, get_bucket_size
 import clip
-from yfcc_download import argparser, get_all_metadata, get_save_folder
-from utils import divide, load_json, save_as_json, normalize
+from yfcc_download import argparser, get_metadata_store, get_save_folder
+from utils import load_json, save_as_json, save_numpy_atomic, normalize
 
 MAX_SIZE = 500000 # The maximum number of features to store in a single file. You may adjust it according to your CPU memory.
 BATCH_SIZE = 128 # The batch size used for extracting features. Adjust it according to your GPU memory
-device = "cuda"
+EXTRACTION_BLOCK_SIZE = 10000 # The number of images per saved block of features. At most this many images are re-extracted after a crash.
+EXTRACTION_COLUMNS = ['ID', 'IMG_DIR', 'IMG_PATH'] # The metadata fields needed for feature extraction
+NUM_WORKERS = 8 # The number of worker processes for decoding images (in parallel to the CLIP model)
+PREFETCH_FACTOR = 4 # The number of batches prefetched by each worker
+device = "cuda" if torch.cuda.is_available() else "cpu"
 # MIN_LINE_NUM = 11000000 # Minimal Line Num
 MIN_LINE_NUM = None
 
@@ -55,17 +62,60 @@ argparser.add_argument('--num_of_bucket', default=11, type=int,
 argparser.add_argument("--model_name",
                        default='RN50', choices=clip.available_models(),
                        help="The CLIP model architecture to use")
+argparser.add_argument("--index_type",
+                       default=None, choices=INDEX_TYPES,
+                       help="If set, build and save a faiss index (flat is exact, ivfpq/hnsw are approximate) per bucket next to the CLIP features")
+argparser.add_argument("--index_nlist",
+                       default=None, type=int,
+                       help="The number of inverted lists for ivfpq index (default: 4 x sqrt(bucket size))")
+argparser.add_argument("--index_pq_m",
+                       default=64, type=int,
+                       help="The number of sub-quantizers for ivfpq index (must divide the CLIP feature dim)")
+argparser.add_argument("--index_hnsw_m",
+                       default=32, type=int,
+                       help="The number of neighbors per node for hnsw index")
+argparser.add_argument("--num_workers",
+                       default=NUM_WORKERS, type=int,
+                       help="The number of worker processes for decoding images during CLIP feature extraction (0 means decoding in the main process)")
+argparser.add_argument("--pack_images",
+                       default=False, type=bool,
+                       help="If set to True, pack the images of each bucket into tar shards (see image_shards.py) and extract the CLIP features by streaming the shards")
 
-def get_knearest_models_func(bucket_dict, clip_model_name, device='cpu'):
+def get_knearest_models_func(bucket_dict, clip_model_name, device='cpu', index_type=None, search_param=None):
     """Return a function knearest_func: bucket_index (int) -> KNearestFaissFeatureChunks (for CLIP-based retrieval)
+    If index_type is None, perform exact search over the CLIP features. Otherwise use the saved faiss index
+    of this type (built by running this script with --index_type), which is loaded lazily at first query.
+    The buckets without a saved index fall back to exact search.
+    search_param is the recall/latency knob (nprobe for ivfpq, efSearch for hnsw).
     """
     model, preprocess = clip.load(clip_model_name, device=device)
     def knearest_func(bucket_idx):
-        clip_features_normalized_paths = get_clip_features_normalized_paths(bucket_dict[bucket_idx]['folder_path'], clip_model_name)
-        k_near_faiss = KNearestFaissFeatureChunks(clip_features_normalized_paths, model, preprocess, device=device)
+        folder_path = bucket_dict[bucket_idx]['folder_path']
+        clip_features_normalized_paths = get_clip_features_normalized_paths(folder_path, clip_model_name)
+        feature_store = get_clip_feature_store(folder_path, clip_model_name)
+        if index_type:
+            index_location = get_index_location(folder_path, clip_model_name, index_type)
+            if not os.path.exists(index_location):
+                print(f"Warning: {index_location} not exists (run prepare_dataset.py with --index_type {index_type} to build it). Use exact search for bucket {bucket_idx}.")
+                index_location = None
+        else:
+            index_location = None
+        k_near_faiss = KNearestFaissFeatureChunks(clip_features_normalized_paths, model, preprocess, device=device,
+                                                  feature_store=feature_store, index_location=index_location, search_param=search_param)
         return k_near_faiss
     return knearest_func
 
+def get_clip_feature_store(f_path, model_name, feature_type='normalized'):
+    """Return a FeatureShardStore (memory-mapped) of the clip features of a bucket.
+    Use the saved manifest if exists, otherwise read the shard headers.
+    """
+    main_save_location = get_main_save_location(f_path, model_name)
+    feature_store = FeatureShardStore.from_manifest(main_save_location, feature_type=feature_type)
+    if feature_store == None:
+        chunks, path_dict_list = load_json(main_save_location)
+        feature_store = FeatureShardStore([path_dict[feature_type] for path_dict in path_dict_list])
+    return feature_store
+
 def get_clip_features_normalized_paths(f_path, model_name):
     """A helper function to return paths to normalized ·clip features
     """
@@ -124,6 +174,11 @@ def get_main_save_location(folder_path, model_name):
         folder_path, f"features_{model_name.replace(os.sep, '_')}.json")
     return main_save_location
 
+def get_index_location(folder_path, model_name, index_type):
+    index_location = os.path.join(
+        folder_path, f"features_{model_name.replace(os.sep, '_')}_{index_type}.index")
+    return index_location
+
 
 def _get_date_uploaded(date_uploaded):
     return datetime.utcfromtimestamp(int(date_uploaded))
@@ -131,33 +186,143 @@ def _get_date_uploaded(date_uploaded):
 def _get_date_uploaded_from_str(date_str):
     return parser.isoparse(date_str)
 
-def _divide_meta_list(bucket_dict_i, sub_folder, MAX_SIZE=MAX_SIZE):
-    # Divide the metadata list into chunks with maximum size being MAX_SIZE
+def _get_timestamp_from_str(date_str):
+    # Same as DATE_UPLOADED, i.e., seconds since epoch (UTC)
+    return (_get_date_uploaded_from_str(date_str) - datetime(1970, 1, 1)).total_seconds()
+
+def _argsort_by_upload(date_uploaded_array):
+    # A stable sort, so images uploaded at the same time keep their order in the metadata store
+    return np.argsort(date_uploaded_array, kind='stable')
+
+def get_bucket_indices_by_time(date_uploaded_array, start_timestamps, end_timestamps):
+    """Return a list of index arrays (sorted by upload time), one per [start_timestamps[i], end_timestamps[i]] range
+    """
+    sorted_indices = _argsort_by_upload(date_uploaded_array)
+    sorted_date_uploaded = date_uploaded_array[sorted_indices]
+    starts = np.searchsorted(sorted_date_uploaded, start_timestamps, side='left')
+    ends = np.searchsorted(sorted_date_uploaded, end_timestamps, side='right')
+    return [sorted_indices[start:end] for start, end in zip(starts, ends)]
+
+def _divide_meta_list(meta_list, sub_folder, MAX_SIZE=MAX_SIZE):
+    # Divide the metadata list into chunks of (fixed) size MAX_SIZE, so adding images to the end of a bucket only changes the last chunk
     # Return a list of chunks and save path for each dict
-    meta_list = bucket_dict_i['all_metadata']
-    sub_features_size = math.ceil(len(meta_list) / MAX_SIZE)
-    names = [os.path.join(sub_folder, f'features_{i}') for i in range(sub_features_size)]
-    chunks = divide(meta_list, sub_features_size)
+    chunks = [meta_list[i:i + MAX_SIZE] for i in range(0, len(meta_list), MAX_SIZE)]
+    names = [os.path.join(sub_folder, f'features_{i}') for i in range(len(chunks))]
     assert len(chunks) == len(names)
     return chunks, names
 
+def _get_sub_feature_folder(folder_path, model_name):
+    return os.path.join(folder_path, f"features_{model_name.replace(os.sep, '_')}")
+
+def get_feature_block_folder(folder_path, model_name):
+    """The extracted features (keyed on photo ID) are saved in blocks under this folder
+    """
+    return os.path.join(_get_sub_feature_folder(folder_path, model_name), "blocks")
 
-def _get_sub_feature_paths(bucket_dict_i, folder_path, main_save_location, model_name, MAX_SIZE=MAX_SIZE):
-    sub_folder = os.path.join(folder_path, f"features_{model_name.replace(os.sep, '_')}")
+def _get_sub_feature_paths(meta_list, folder_path, model_name, MAX_SIZE=MAX_SIZE):
+    sub_folder = _get_sub_feature_folder(folder_path, model_name)
     if not os.path.exists(sub_folder):
         os.makedirs(sub_folder)
-    chunks, names = _divide_meta_list(bucket_dict_i, sub_folder, MAX_SIZE=MAX_SIZE)
+    chunks, names = _divide_meta_list(meta_list, sub_folder, MAX_SIZE=MAX_SIZE)
     
     path_dict_list = [{'original': n+"_original.npy",
                        "normalized": n+"_normalized.npy"} for n in names]
-    save_as_json(main_save_location, (chunks, path_dict_list))
     return chunks, path_dict_list
+
+def _get_chunk_ids(chunks):
+    return [[meta['ID'] for meta in chunk] for chunk in chunks]
+
+def _import_saved_shards(block_store, saved_chunks, saved_path_dict_list):
+    # Add the shards saved by a previous run (e.g., before the block store is used) to the block store to avoid re-extraction
+    for ids, path_dict in zip(_get_chunk_ids(saved_chunks), saved_path_dict_list):
+        if not os.path.exists(path_dict['original']) or all(ID in block_store for ID in ids):
+            continue
+        clip_features = np.load(path_dict['original'], mmap_mode='r')
+        if clip_features.shape[0] != len(ids):
+            continue
+        print(f"Import saved features at {path_dict['original']}")
+        block_store.add_block(ids, np.asarray(clip_features))
+
+def _extract_from_image_shards(block_store, image_shard_folder, missing_ids, model, preprocess, block_size=EXTRACTION_BLOCK_SIZE, num_workers=NUM_WORKERS):
+    # The images are read sequentially from the tar shards (only the missing ones are decoded), in the order of the shards
+    loader_kwargs = {}
+    if num_workers > 0:
+        loader_kwargs['prefetch_factor'] = PREFETCH_FACTOR
+    clip_loader = torch.utils.data.DataLoader(
+        ImageShardDataset(image_shard_folder, preprocess, keys=set(missing_ids), return_key=True),
+        batch_size=BATCH_SIZE,
+        num_workers=num_workers,
+        pin_memory=str(device).startswith('cuda'),
+        **loader_kwargs
+    )
+    ids, clip_features = [], []
+    with torch.no_grad():
+        for images, keys in tqdm(clip_loader):
+            clip_features.append(model.encode_image(images.to(device, non_blocking=True)))
+            ids += list(keys)
+            if len(ids) >= block_size:
+                block_store.add_block(ids, torch.cat(clip_features, dim=0).cpu().numpy())
+                ids, clip_features = [], []
+    if len(ids) > 0:
+        block_store.add_block(ids, torch.cat(clip_features, dim=0).cpu().numpy())
+
+def extract_clip_features(bucket_dict_i, folder_path, model_name, model, preprocess, block_size=EXTRACTION_BLOCK_SIZE, num_workers=NUM_WORKERS, image_shard_folder=None, meta_list=None):
+    """Extract the CLIP features of a bucket and save them as shards (with at most MAX_SIZE features) in bucket order.
+    The features are first appended to a FeatureBlockStore keyed on photo ID, so that the extraction resumes from the
+    last saved block after a crash, and only the images not yet extracted are processed when the bucket grows.
+    If image_shard_folder is not None, the images are streamed from the tar shards of this bucket (see image_shards.pack_bucket).
+    meta_list is the metadata of the bucket with EXTRACTION_COLUMNS (loaded from the metadata store if None).
+    Return True if any shard is (re)written.
+    """
+    if meta_list == None:
+        meta_list = get_bucket_metadata(bucket_dict_i, columns=EXTRACTION_COLUMNS)
+    main_save_location = get_main_save_location(folder_path, model_name)
+    saved_chunks, saved_path_dict_list = load_json(main_save_location, default_obj=([], []))
+    block_store = FeatureBlockStore(get_feature_block_folder(folder_path, model_name))
+    _import_saved_shards(block_store, saved_chunks, saved_path_dict_list)
+
+    missing_metadata = {}
+    for meta in meta_list:
+        if not meta['ID'] in block_store:
+            missing_metadata[meta['ID']] = meta
+    missing_metadata = list(missing_metadata.values())
+    print(f"{len(block_store)} images already extracted. Extracting {len(missing_metadata)} images.")
+    if image_shard_folder != None and len(missing_metadata) > 0:
+        _extract_from_image_shards(block_store, image_shard_folder, [meta['ID'] for meta in missing_metadata], model, preprocess,
+                                   block_size=block_size, num_workers=num_workers)
+        missing_metadata = []
+    for i0 in range(0, len(missing_metadata), block_size):
+        block_metadata = missing_metadata[i0:i0 + block_size]
+        clip_loader = get_clip_loader(block_metadata, preprocess, num_workers=num_workers, dataset_class=CLIPDataset)
+        clip_features = get_clip_features(clip_loader, model)
+        block_store.add_block([meta['ID'] for meta in block_metadata], clip_features)
+
+    # Only (re)write the shards with changed images
+    chunks, path_dict_list = _get_sub_feature_paths(meta_list, folder_path, model_name)
+    saved_chunk_ids = _get_chunk_ids(saved_chunks)
+    is_updated = False
+    for i, (ids, path_dict) in enumerate(zip(_get_chunk_ids(chunks), path_dict_list)):
+        if i < len(saved_chunk_ids) and saved_chunk_ids[i] == ids \
+           and os.path.exists(path_dict['normalized']) and os.path.exists(path_dict['original']):
+            print(f"Already exists: {path_dict['normalized']}")
+            continue
+        clip_features = block_store.take(ids)
+        save_numpy_atomic(path_dict['original'], clip_features)
+        print(f"Saved at {path_dict['original']}")
+        
+        clip_features_normalized = normalize(clip_features.astype(np.float32))
+        save_numpy_atomic(path_dict['normalized'], clip_features_normalized)
+        is_updated = True
+
+    save_as_json(main_save_location, (chunks, path_dict_list))
+    save_manifest(main_save_location, path_dict_list)
+    return is_updated
         
 
 class CLIPDataset(Dataset):
     def __init__(self, all_metadata, preprocess, device='cuda'):
         self.all_metadata = all_metadata
-        self.device = device
+        self.device = device # Samples stay on CPU here. They are moved to device once per batch in get_clip_features
         self.preprocess = preprocess
     
     def __len__(self):
@@ -166,33 +331,47 @@ class CLIPDataset(Dataset):
     def __getitem__(self,index):
         meta = self.all_metadata[index]
         path = os.path.join(meta['IMG_DIR'], meta['IMG_PATH'])
-        sample = self.preprocess(Image.open(path)).to(self.device)
+        sample = self.preprocess(Image.open(path))
         return sample
 
-def get_clip_loader(all_metadata, preprocess, batch_size=BATCH_SIZE, num_workers=0, device='cuda', dataset_class=CLIPDataset):
+def get_clip_loader(all_metadata, preprocess, batch_size=BATCH_SIZE, num_workers=NUM_WORKERS, device=device, dataset_class=CLIPDataset):
+    # Images are decoded by parallel workers (prefetching batches while the model runs), and batches are
+    # collated in pinned memory if the model runs on GPU
+    loader_kwargs = {}
+    if num_workers > 0:
+        loader_kwargs['prefetch_factor'] = PREFETCH_FACTOR
     return torch.utils.data.DataLoader(
         dataset_class(all_metadata, preprocess, device=device), 
         batch_size=batch_size, 
         shuffle=False, 
         num_workers=num_workers,
+        pin_memory=str(device).startswith('cuda'),
+        **loader_kwargs
     )
 
-def get_clip_features(clip_loader, model):
+def get_clip_features(clip_loader, model, device=device):
     clip_features = []
     pbar = tqdm(clip_loader)
+    num_images = 0
+    start = time.time()
     with torch.no_grad():
         for batch, images in enumerate(pbar):
+            images = images.to(device, non_blocking=True)
             image_features = model.encode_image(images)
-            clip_features.append(image_features.cpu().numpy())
-    return np.concatenate(clip_features, axis=0)
+            # Stay on device (no synchronization per batch)
+            clip_features.append(image_features)
+            num_images += images.shape[0]
+            pbar.set_postfix(images_per_sec=num_images / (time.time() - start))
+        clip_features = torch.cat(clip_features, dim=0).cpu().numpy()
+    print(f"Extracted the CLIP features of {num_images} images at {num_images / (time.time() - start):.2f} images/sec")
+    return clip_features
 
-def save_bucket_dict(flickr_folder_location, all_metadata, folder_paths, num_of_bucket, split_by_year, split_by_time=None):
+def save_bucket_dict(flickr_folder_location, metadata_store, folder_paths, num_of_bucket, split_by_year, split_by_time=None):
     assert num_of_bucket == len(folder_paths)
-    # Sort images by time, and then split into buckets
-    date_uploaded_list = []
-    for meta in all_metadata:
-        date_uploaded_list.append(meta['DATE_UPLOADED'])
-    indices_sorted_by_upload = [i[0] for i in sorted(enumerate(date_uploaded_list), key=lambda x : x[1])]
+    # Only load the columns needed for bucketing. The full metadata is read per bucket.
+    columns = metadata_store.load_columns(['DATE_UPLOADED', 'LINE_NUM'])
+    date_uploaded_array = columns['DATE_UPLOADED']
+    line_num_array = columns['LINE_NUM']
     
     if split_by_time:
         if not os.path.exists(split_by_time):
@@ -201,75 +380,51 @@ def save_bucket_dict(flickr_folder_location, all_metadata, folder_paths, num_of_
         split_by_time_list = load_json(split_by_time)
         split_by_time_name = _get_split_by_time_name(split_by_time)
         bucket_dict_path = os.path.join(flickr_folder_location, f'bucket_by_{split_by_time_name}.json')
-        chunks_of_indices = []
-        curr_chunk = []
-        bucket_idx = 0
-        end_timestamp = _get_date_uploaded_from_str(split_by_time_list[bucket_idx]['end'])
-        start_timestamp = _get_date_uploaded_from_str(split_by_time_list[bucket_idx]['start'])
-        for sorted_idx in indices_sorted_by_upload:
-            curr_timestamp = _get_date_uploaded(date_uploaded_list[sorted_idx])
-            if curr_timestamp < start_timestamp:
-                continue
-            if curr_timestamp > end_timestamp:
-                bucket_idx += 1
-                chunks_of_indices.append(curr_chunk)
-                curr_chunk = []
-                if len(split_by_time_list) == bucket_idx:
-                    break
-                else:
-                    end_timestamp = _get_date_uploaded_from_str(split_by_time_list[bucket_idx]['end'])
-                    start_timestamp = _get_date_uploaded_from_str(split_by_time_list[bucket_idx]['start'])
-            curr_chunk.append(sorted_idx)
-        if len(curr_chunk) > 0:
-            chunks_of_indices.append(curr_chunk)
-        if not len(chunks_of_indices) == len(split_by_time_list):
-            import pdb; pdb.set_trace()
+        # Bucket i has all images uploaded in [start, end] (both inclusive)
+        start_timestamps = [math.ceil(_get_timestamp_from_str(time_dict['start'])) for time_dict in split_by_time_list]
+        end_timestamps = [math.floor(_get_timestamp_from_str(time_dict['end'])) for time_dict in split_by_time_list]
+        chunks_of_indices = get_bucket_indices_by_time(date_uploaded_array, start_timestamps, end_timestamps)
     elif split_by_year:
         bucket_dict_path = os.path.join(flickr_folder_location, f'bucket_by_year.json')
-        chunks_of_indices = []
-        curr_chunk = []
-        year_idx = 2004
-        for sorted_idx in indices_sorted_by_upload:
-            if _get_date_uploaded(date_uploaded_list[sorted_idx]).year < year_idx:
-                continue
-            if _get_date_uploaded(date_uploaded_list[sorted_idx]).year > year_idx:
-                year_idx += 1
-                chunks_of_indices.append(curr_chunk)
-                curr_chunk = []
-            if not _get_date_uploaded(date_uploaded_list[sorted_idx]).year == year_idx:
-                import pdb; pdb.set_trace()
-            curr_chunk.append(sorted_idx)
-        chunks_of_indices.append(curr_chunk)
+        year_timestamps = [int(_get_timestamp_from_str(f"{year_idx}-01-01")) for year_idx in range(2004, 2016)]
+        chunks_of_indices = get_bucket_indices_by_time(date_uploaded_array, year_timestamps[:-1], [t - 1 for t in year_timestamps[1:]])
     else:
         bucket_dict_path = os.path.join(flickr_folder_location, f'bucket_{num_of_bucket}.json')
-        chunks_of_indices = divide(indices_sorted_by_upload, num_of_bucket)
+        chunks_of_indices = np.array_split(_argsort_by_upload(date_uploaded_array), num_of_bucket)
     
+    # The buckets refer to the rows of the metadata store by index
+    metadata_store_location = bucket_dict_path[:-len(".json")] + "_metadata_store.json"
+    is_store_changed = load_json(metadata_store_location) != metadata_store.to_dict()
+    if is_store_changed:
+        print(f"Save the metadata store at {metadata_store_location}. All buckets will be recomputed.")
+        metadata_store.save(metadata_store_location)
+
     bucket_dict = {}
     for i, chunk in enumerate(chunks_of_indices):
         bucket_dict_i_path = os.path.join(folder_paths[i], f'bucket_{i}.json')
         if MIN_LINE_NUM:
             print(f"Before filtering by MIN_LINE_NUM: chunk size = {len(chunk)}")
-            chunk = [i for i in chunk if int(all_metadata[i]['LINE_NUM']) > MIN_LINE_NUM]
+            chunk = chunk[line_num_array[chunk] > MIN_LINE_NUM]
             print(f"After filtering by MIN_LINE_NUM: chunk size = {len(chunk)}")
-        meta_list = [all_metadata[i] for i in chunk]
-        date_uploaded_list_i = [date_uploaded_list[i] for i in chunk]
-        if os.path.exists(bucket_dict_i_path):
+        if os.path.exists(bucket_dict_i_path) and not is_store_changed:
             bucket_dict[i] = load_json(bucket_dict_i_path)
         else:
+            indices_location = get_bucket_indices_location(folder_paths[i], i)
+            save_numpy_atomic(indices_location, chunk)
             bucket_dict[i] = {
-                'indices' : chunk,
-                'all_metadata' : meta_list,
                 'folder_path' : folder_paths[i],
-                'min_date': str(_get_date_uploaded(date_uploaded_list_i[0])),
-                'max_date': str(_get_date_uploaded(date_uploaded_list_i[-1])),
-                'date_uploaded_list' : date_uploaded_list_i
+                'num_images' : len(chunk),
+                'min_date': str(_get_date_uploaded(date_uploaded_array[chunk[0]])),
+                'max_date': str(_get_date_uploaded(date_uploaded_array[chunk[-1]])),
+                'metadata_store_location' : metadata_store_location,
+                'indices_location' : indices_location,
             }
             save_as_json(bucket_dict_i_path, bucket_dict[i])
         min_date, max_date = bucket_dict[i]['min_date'], bucket_dict[i]['max_date']
         date_str = f"For bucket {i}: Date range from {min_date} to {max_date}"
         print(date_str)
-        line_num_list = [int(meta['LINE_NUM']) for meta in meta_list]
-        min_line, max_line = min(line_num_list), max(line_num_list)
+        line_num_list = line_num_array[chunk]
+        min_line, max_line = line_num_list.min(), line_num_list.max()
         print(f"For bucket {i}: Line number range from {min_line} to {max_line}")
     # if not os.path.exists(bucket_dict_path):    
     save_as_json(bucket_dict_path, bucket_dict)
@@ -294,20 +449,20 @@ if __name__ == '__main__':
                                  args.max_aspect_ratio
                              )
     
-    all_metadata = get_all_metadata(flickr_folder_location)
+    metadata_store = get_metadata_store(flickr_folder_location)
     end = time.time()
-    print(f"{end - start} seconds are used to load all {len(all_metadata)} images")
-    print(f"Size of dataset is {len(all_metadata)}")
+    print(f"{end - start} seconds are used to load all {len(metadata_store)} images")
+    print(f"Size of dataset is {len(metadata_store)}")
     
     # Save each bucket into a json object
     folder_paths = get_bucket_folder_paths(flickr_folder_location, args.num_of_bucket, args.split_by_year, args.split_by_time)
-    bucket_dict_path, bucket_dict = save_bucket_dict(flickr_folder_location, all_metadata, folder_paths, args.num_of_bucket, args.split_by_year, args.split_by_time)
+    bucket_dict_path, bucket_dict = save_bucket_dict(flickr_folder_location, metadata_store, folder_paths, args.num_of_bucket, args.split_by_year, args.split_by_time)
     # If you want to load the bucket_dict, use load_bucket_dict(flickr_folder_location, args.num_of_bucket, args.split_by_year)
     
     length_of_dataset = 0
     for i in bucket_dict:
-        print(f"{i}-th bucket has {len(bucket_dict[i]['all_metadata'])} images")
-        length_of_dataset += len(bucket_dict[i]['all_metadata'])
+        print(f"{i}-th bucket has {get_bucket_size(bucket_dict[i])} images")
+        length_of_dataset += get_bucket_size(bucket_dict[i])
     print(f"{end - start} seconds are used to load all {length_of_dataset} images")
 
     # Extract and save the CLIP features
@@ -317,24 +472,26 @@ if __name__ == '__main__':
     for i, folder_path in enumerate(folder_paths):
         main_save_location = get_main_save_location(folder_path, args.model_name)
         print(main_save_location)
-        chunks, path_dict_list = _get_sub_feature_paths(
-            bucket_dict[i], folder_path, main_save_location, model_name=args.model_name)
-        # import pdb; pdb.set_trace()
-        for chunk, path_dict in zip(chunks, path_dict_list):
-            if os.path.exists(path_dict['normalized']) and os.path.exists(path_dict['original']):
-                print(f"Already exists: {path_dict['normalized']}")
-                continue
+        # The metadata of the bucket is loaded once for packing and extraction
+        meta_list = get_bucket_metadata(bucket_dict[i], columns=EXTRACTION_COLUMNS)
+        image_shard_folder = None
+        if args.pack_images:
+            image_shard_folder = get_image_shard_folder(folder_path)
+            pack_bucket(bucket_dict[i], image_shard_folder, meta_list=meta_list)
+        is_updated = extract_clip_features(bucket_dict[i], folder_path, args.model_name, model, preprocess, num_workers=args.num_workers, image_shard_folder=image_shard_folder, meta_list=meta_list)
+
+        if args.index_type:
+            index_location = get_index_location(folder_path, args.model_name, args.index_type)
+            if os.path.exists(index_location) and not is_updated:
+                print(f"Already exists: {index_location}")
             else:
-                print(f"Save to {path_dict['normalized']}")
-            clip_loader = get_clip_loader(chunk, preprocess, dataset_class=CLIPDataset)
-            clip_features = get_clip_features(clip_loader, model)
-            
-            with open(path_dict['original'], 'wb') as f:
-                np.save(f, clip_features)
-            print(f"Saved at {path_dict['original']}")
-            
-            clip_features_normalized = normalize(clip_features.astype(np.float32))
-            with open(path_dict['normalized'], 'wb') as f:
-                np.save(f, clip_features_normalized)
+                index = build_faiss_index(
+                    get_clip_feature_store(folder_path, args.model_name),
+                    args.index_type,
+                    nlist=args.index_nlist,
+                    pq_m=args.index_pq_m,
+                    hnsw_m=args.index_hnsw_m
+                )
+                save_faiss_index(index, index_location)
 
     print(f"Finished extracting the CLIP features. You should replace the bucket_dict_path in CLIP-PromptEngineering.ipynb with {bucket_dict_path} to use this dataset.")
\ No newline at end of file
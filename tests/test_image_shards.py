@@ -0,0 +1,114 @@
+import os
+import sys
+import json
+import numpy as np
+import pytest
+import torch
+import torchvision.transforms as transforms
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from image_shards import ImageShardDataset, pack_image_shards, get_shards_json_location
+
+def _make_fake_shard_folder(folder, shard_sizes):
+    # Only shards.json is needed to compute the sample ranges
+    os.makedirs(folder, exist_ok=True)
+    shards_dict = {
+        'shards' : [{'path' : os.path.join(folder, f"shard_{i:05d}.tar"), 'num_samples' : n} for i, n in enumerate(shard_sizes)],
+        'num_samples' : sum(shard_sizes),
+        'has_labels' : False,
+    }
+    with open(get_shards_json_location(folder), 'w') as f:
+        json.dump(shards_dict, f)
+    return folder
+
+def _get_batches_per_rank(folder, world_size, num_workers, batch_size):
+    batches_per_rank = []
+    for rank in range(world_size):
+        dataset = ImageShardDataset(folder, None, shuffle=True, rank=rank, world_size=world_size, batch_size=batch_size)
+        ranges = [dataset._get_worker_range(rank, w, num_workers) for w in range(num_workers)]
+        for start, end in ranges:
+            assert (end - start) % batch_size == 0
+        batches_per_rank.append(sum((end - start) // batch_size for start, end in ranges))
+    return batches_per_rank
+
+def test_equal_batches_per_rank(tmp_path):
+    folder = _make_fake_shard_folder(str(tmp_path / 'shards'), [10000] * 30 + [4670])
+    batches_per_rank = _get_batches_per_rank(folder, 8, 4, 40)
+    assert len(set(batches_per_rank)) == 1
+    assert batches_per_rank[0] == (304670 // 8) // 40
+
+def test_no_idle_worker_with_few_shards(tmp_path):
+    folder = _make_fake_shard_folder(str(tmp_path / 'shards'), [10000] * 18)
+    for rank in range(8):
+        dataset = ImageShardDataset(folder, None, rank=rank, world_size=8, batch_size=32)
+        ranges = [dataset._get_worker_range(rank, w, 4) for w in range(4)]
+        assert all(end - start > 0 for start, end in ranges)
+        # Only the last partial batch of the rank is skipped
+        assert 180000 // 8 - sum(end - start for start, end in ranges) < 32
+
+def _pack_small_images(folder, num_samples, samples_per_shard):
+    image_folder = os.path.join(folder, 'images')
+    os.makedirs(image_folder)
+    samples = []
+    for i in range(num_samples):
+        path = os.path.join(image_folder, f"{i}.png")
+        Image.fromarray(np.full((4, 4, 3), i % 256, dtype=np.uint8)).save(path)
+        samples.append((f"{i:05d}", path, i))
+    pack_image_shards(samples, os.path.join(folder, 'shards'), samples_per_shard=samples_per_shard)
+    return os.path.join(folder, 'shards')
+
+def test_resume_with_changed_samples(tmp_path):
+    # A crash before shards.json is saved, then the samples change before the resume
+    shard_folder = _pack_small_images(str(tmp_path), 10, 4)
+    os.remove(get_shards_json_location(shard_folder))
+    image_folder = os.path.join(str(tmp_path), 'images')
+    samples = [(f"{i:05d}", os.path.join(image_folder, f"{9 - i}.png"), 9 - i) for i in range(10)]
+    pack_image_shards(samples, shard_folder, samples_per_shard=4)
+    dataset = ImageShardDataset(shard_folder, transforms.ToTensor())
+    assert [int(label) for _, label in dataset] == list(range(9, -1, -1))
+    assert [int(image[0, 0, 0] * 255) for image, _ in dataset] == list(range(9, -1, -1))
+
+def test_dataloader_batches_per_rank(tmp_path):
+    shard_folder = _pack_small_images(str(tmp_path), 61, 7)
+    world_size, batch_size = 3, 4
+    batches_per_rank, all_labels = [], []
+    for rank in range(world_size):
+        dataset = ImageShardDataset(shard_folder, transforms.ToTensor(), shuffle=True, shuffle_buffer_size=5,
+                                    rank=rank, world_size=world_size, batch_size=batch_size)
+        loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, num_workers=2, drop_last=True)
+        batches = [labels for _, labels in loader]
+        assert len(batches) == len(loader)
+        batches_per_rank.append(len(batches))
+        all_labels += [int(label) for labels in batches for label in labels]
+    assert len(set(batches_per_rank)) == 1
+    assert len(all_labels) == len(set(all_labels))
+
+def test_shard_loader_batches_per_rank(tmp_path):
+    from training_utils import make_shard_loader
+    shard_folder = _pack_small_images(str(tmp_path), 50, 6)
+    batches_per_rank, all_labels = [], []
+    for rank in range(4):
+        loader = make_shard_loader(shard_folder, transforms.ToTensor(), shuffle=True, batch_size=3, num_workers=2,
+                                   rank=rank, world_size=4, seed=1, drop_last=True)
+        loader.dataset.set_epoch(1)
+        batches = [labels for _, labels in loader]
+        assert len(batches) == len(loader)
+        batches_per_rank.append(len(batches))
+        all_labels += [int(label) for labels in batches for label in labels]
+    assert batches_per_rank == [(50 // 4) // 3] * 4
+    assert len(all_labels) == len(set(all_labels))
+
+def test_keys_read_once(tmp_path):
+    shard_folder = _pack_small_images(str(tmp_path), 23, 5)
+    keys = set(f"{i:05d}" for i in range(23))
+    read_keys = []
+    for rank in range(2):
+        dataset = ImageShardDataset(shard_folder, transforms.ToTensor(), keys=keys, return_key=True, rank=rank, world_size=2)
+        loader = torch.utils.data.DataLoader(dataset, batch_size=4, num_workers=3)
+        read_keys += [key for _, batch_keys in loader for key in batch_keys]
+    assert sorted(read_keys) == sorted(keys)
+
+def test_unpacked_folder(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        ImageShardDataset(str(tmp_path / 'shards'), None)
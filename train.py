@@ -1,5 +1,6 @@
 import training_utils
 from utils import load_pickle, save_obj_as_pickle
+from feature_store import FeatureBlockStore, has_split_arrays, save_split_arrays, load_split_arrays
 import random
 import argparse
 from tqdm import tqdm
@@ -8,11 +9,15 @@ import time
 import numpy as np
 import torch
 import os
+import tempfile
 
 NEGATIVE_LABEL = "NEGATIVE"
 
 device = "cuda" if torch.cuda.is_available() else "cpu"
 
+CNN_FEATURE_BATCH_SIZE = 256 # The batch size to extract the features of a frozen CNN (not the training batch size)
+CNN_FEATURE_BLOCK_SIZE = 10000 # The number of extracted features saved at once (i.e., lost at most after a crash)
+
 MODE_DICT = {
     'default': {
         'VAL_SET_RATIO': 0.1,
@@ -191,64 +196,116 @@ def split_dataset(query_dict, mode):
 
     return dataset_dict
 
-def make_features_dict(dataset_dict, train_mode):
-    features_dict = {}  # Saved the features of splitted dataset
+def make_features_dict(dataset_dict, train_mode, feature_store_folder=None):
+    # feature_store_folder is where the features of cnn_feature train modes are kept (see get_cnn_feature_store_folder)
+    # If None, they are extracted in a temporary folder, i.e., only used by this run
     feature_name, feature_extractor = make_feature_extractor(train_mode)
+    if feature_extractor != None and feature_store_folder == None:
+        with tempfile.TemporaryDirectory() as tmp_folder:
+            return _make_features_dict(dataset_dict, feature_name, feature_extractor, tmp_folder)
+    return _make_features_dict(dataset_dict, feature_name, feature_extractor, feature_store_folder)
+
+def _make_features_dict(dataset_dict, feature_name, feature_extractor, feature_store_folder):
+    features_dict = {}  # Saved the features of splitted dataset
+    feature_store = None
+    if feature_extractor != None:
+        feature_store = extract_cnn_features(dataset_dict, feature_extractor, feature_store_folder)
     for b_idx in dataset_dict:
         print(f"<<<<<<<<<<<First store features for bucket {b_idx}")
-        features_dict[b_idx] = extract_features(dataset_dict[b_idx], feature_name, feature_extractor)
+        features_dict[b_idx] = extract_features(dataset_dict[b_idx], feature_name, feature_store=feature_store)
     return features_dict
 
-def extract_features(dataset_dict_i, feature_name, feature_extractor, batch_size=64):
-    # batch size here is simply used to extract the features, not for final training purposes
+def get_cnn_feature_store_folder(folder_path, train_mode):
+    # Keyed on the backbone and the transform (center crop, as in make_image_loader with fixed_crop), so all datasets, splits and seeds share it.
+    # Return None for a randomly initialized backbone (a new network every run), whose features must not be reused by other runs.
+    pretrained_weight = TRAIN_MODES_CATEGORY[train_mode].pretrained_weight
+    if pretrained_weight == None:
+        return None
+    return os.path.join(folder_path, 'cnn_features', f"resnet50_{pretrained_weight}_center_crop_224")
+
+def extract_cnn_features(dataset_dict, feature_extractor, feature_store_folder, batch_size=CNN_FEATURE_BATCH_SIZE, block_size=CNN_FEATURE_BLOCK_SIZE):
+    """Extract the features of all images of dataset_dict that are not yet in the FeatureBlockStore at feature_store_folder
+    (keyed on photo ID), with a single batched no_grad pass over these images, and return the store
+    """
+    feature_store = FeatureBlockStore(feature_store_folder)
+    missing_metadata = {}
+    for b_idx in dataset_dict:
+        for query in dataset_dict[b_idx]:
+            for k_name in dataset_dict[b_idx][query]:
+                for meta in dataset_dict[b_idx][query][k_name]['metadata']:
+                    if not meta.metadata.ID in feature_store:
+                        missing_metadata[meta.metadata.ID] = meta
+    missing_metadata = list(missing_metadata.values())
+    print(f"{len(feature_store)} images already extracted at {feature_store_folder}. Extracting {len(missing_metadata)} images.")
+    feature_extractor = feature_extractor.to(device).eval()
+    for i0 in range(0, len(missing_metadata), block_size):
+        block_metadata = missing_metadata[i0:i0 + block_size]
+        loader = training_utils.make_image_loader([(meta, 0) for meta in block_metadata], batch_size, shuffle=False, fixed_crop=True)
+        outputs = []
+        with torch.no_grad():
+            for inputs, _ in tqdm(loader):
+                # Stay on device (no synchronization per batch)
+                outputs.append(feature_extractor(inputs.to(device, non_blocking=True)))
+        feature_store.add_block([meta.metadata.ID for meta in block_metadata], torch.cat(outputs, dim=0).cpu().numpy())
+    return feature_store
+
+def extract_features(dataset_dict_i, feature_name, feature_store=None):
+    # If feature_store is not None, the features of the images are looked up by photo ID (see extract_cnn_features)
     all_query = sorted(list(dataset_dict_i.keys()))
     features_dict_i = {}
-    if feature_extractor == None:
-        for k_name in dataset_dict_i[all_query[0]]:
-            items = []
+    for k_name in dataset_dict_i[all_query[0]]:
+        items = []
+        if feature_store == None:
             for q_idx, query in enumerate(all_query):
                 items += [(f, q_idx)
                           for f in dataset_dict_i[query][k_name][feature_name]]
-            features_dict_i[k_name] = items
-    else:
-        feature_extractor = feature_extractor.cuda()
-        for k_name in dataset_dict_i[all_query[0]]:
-            items = []
+        else:
+            ids, labels = [], []
             for q_idx, query in enumerate(all_query):
-                items += [(f, q_idx)
-                          for f in dataset_dict_i[query][k_name]['metadata']]
-            loader = training_utils.make_image_loader(items, batch_size, shuffle=False, fixed_crop=True)
-            extracted_items = []
-            for inputs, labels in tqdm(loader):
-                inputs = inputs.cuda()
-                outputs = feature_extractor(inputs)
-                for output, label in zip(outputs, labels):
-                    extracted_items.append((output.cpu(), int(label)))
-                    assert int(label) == items[len(extracted_items)-1][1]
-            features_dict_i[k_name] = extracted_items
+                ids += [meta.metadata.ID for meta in dataset_dict_i[query][k_name]['metadata']]
+                labels += [q_idx for _ in dataset_dict_i[query][k_name]['metadata']]
+            # Rows of a single dense array
+            items = list(zip(feature_store.take(ids), labels))
+        features_dict_i[k_name] = items
     return features_dict_i
 
-def get_loader_func(train_mode, batch_size):
+def get_split_arrays_folder(exp_result_save_path, mode, train_mode, seed_str):
+    return os.path.join(exp_result_save_path, f"split_arrays_{dataset_str(mode)}_{train_mode}_{seed_str}")
+
+def uses_split_arrays(train_mode):
+    return TRAIN_MODES_CATEGORY[train_mode].feature_type in ['clip', 'cnn_feature']
+
+def load_features_index(split_arrays_folder):
+    """Return (feature_arrays, features_dict) from the arrays saved by feature_store.save_split_arrays.
+    feature_arrays is (features, labels) on device, and features_dict[b_idx][split] is the list of row indices of this split,
+    so the loaders built from features_dict (with feature_arrays) are index views of the same features.
+    """
+    features, labels, ranges = load_split_arrays(split_arrays_folder)
+    feature_arrays = (torch.from_numpy(features).to(device), torch.from_numpy(labels).to(device))
+    features_dict = {b_idx: {split: list(range(*ranges[b_idx][split])) for split in ranges[b_idx]} for b_idx in ranges}
+    return feature_arrays, features_dict
+
+def get_loader_func(train_mode, batch_size, feature_arrays=None):
+    # If feature_arrays is not None, then items are the row indices of feature_arrays (see load_features_index)
     assert train_mode in TRAIN_MODES_CATEGORY.keys()
     feature_type = TRAIN_MODES_CATEGORY[train_mode].feature_type
-    if feature_type == 'clip':
-        return lambda items, is_train_mode: training_utils.make_numpy_loader(items, batch_size, shuffle=is_train_mode)
+    if feature_type in ['clip', 'cnn_feature']:
+        # The features fit in memory, so batches are sliced from a single tensor (no DataLoader)
+        return lambda items, is_train_mode: training_utils.make_feature_loader(items, batch_size, shuffle=is_train_mode, feature_arrays=feature_arrays)
     elif feature_type == 'image':
         # always do center cropping
         return lambda items, is_train_mode: training_utils.make_image_loader(items, batch_size, shuffle=is_train_mode, fixed_crop=True)
-    elif feature_type == 'cnn_feature':
-        return lambda items, is_train_mode: training_utils.make_tensor_loader(items, batch_size, shuffle=is_train_mode)
     else:
         raise NotImplementedError()
 
-def get_all_loaders_from_features_dict(all_features_dict, train_mode, hyperparameter, excluded_bucket_idx=0):
+def get_all_loaders_from_features_dict(all_features_dict, train_mode, hyperparameter, excluded_bucket_idx=0, feature_arrays=None):
     all_bucket = sorted(list(all_features_dict.keys()))
     print(f"Excluding {excluded_bucket_idx} from the loaders")
     features_dict = {k: all_features_dict[k]
                      for k in all_bucket if k != excluded_bucket_idx}
     loaders_dict = {}
 
-    loader_func = get_loader_func(train_mode, hyperparameter.batch_size)
+    loader_func = get_loader_func(train_mode, hyperparameter.batch_size, feature_arrays=feature_arrays)
 
     for k_name in features_dict[list(features_dict.keys())[0]]:
         items = []
@@ -262,10 +319,10 @@ def get_all_loaders_from_features_dict(all_features_dict, train_mode, hyperparam
         loaders_dict[k_name] = loader
     return loaders_dict
 
-def get_loaders_from_features_dict(features_dict, train_mode, hyperparameter, excluded_bucket_idx=0):
+def get_loaders_from_features_dict(features_dict, train_mode, hyperparameter, excluded_bucket_idx=0, feature_arrays=None):
     loaders_dict = {}  # Saved the splitted loader for each bucket
 
-    loader_func = get_loader_func(train_mode, hyperparameter.batch_size)
+    loader_func = get_loader_func(train_mode, hyperparameter.batch_size, feature_arrays=feature_arrays)
 
     for b_idx in features_dict:
         if type(excluded_bucket_idx) == int and b_idx == excluded_bucket_idx:
@@ -281,7 +338,7 @@ def get_loaders_from_features_dict(features_dict, train_mode, hyperparameter, ex
             loaders_dict[b_idx][k_name] = loader
     return loaders_dict
 
-def get_cumulative_loaders_from_features_dict(features_dict, train_mode, hyperparameter, excluded_bucket_idx=0):
+def get_cumulative_loaders_from_features_dict(features_dict, train_mode, hyperparameter, excluded_bucket_idx=0, feature_arrays=None):
     all_bucket = sorted(list(features_dict.keys()))
     print(f"Excluding {excluded_bucket_idx} from the cumulative loaders")
     if type(excluded_bucket_idx) == int:
@@ -289,7 +346,7 @@ def get_cumulative_loaders_from_features_dict(features_dict, train_mode, hyperpa
                         for k in all_bucket if k != excluded_bucket_idx}
     cumulative_loaders_dict = {}
 
-    loader_func = get_loader_func(train_mode, hyperparameter.batch_size)
+    loader_func = get_loader_func(train_mode, hyperparameter.batch_size, feature_arrays=feature_arrays)
 
     for b_idx in all_bucket:
         cumulative_loaders_dict[b_idx] = {}
@@ -402,7 +459,7 @@ def train(loaders,
           epochs=150, lr=0.1, weight_decay=1e-5, step_size=60,
           finetuned_model=None):
     if finetuned_model == None:
-        network = make_model(train_mode, output_size).cuda()
+        network = make_model(train_mode, output_size).to(device)
         print("Retraining..")
     else:
         network = finetuned_model
@@ -419,6 +476,10 @@ def train(loaders,
     else:
         phases = ['train', 'test']
 
+    for phase in phases:
+        if isinstance(loaders[phase], training_utils.FeatureLoader):
+            loaders[phase].to(device)
+
     # Save best training loss model
     best_result = {'best_loss': None, 'best_acc': 0, 'best_epoch': None, 'best_network': None}
 
@@ -440,8 +501,8 @@ def train(loaders,
                 inputs, labels = data
                 count += inputs.size(0)
 
-                inputs = inputs.cuda()
-                labels = labels.cuda()
+                inputs = inputs.to(device)
+                labels = labels.to(device)
 
                 if phase == 'train':
                     optimizer.zero_grad()
@@ -459,7 +520,7 @@ def train(loaders,
                         optimizer.step()
 
                 # statistics
-                running_loss += loss.item() * inputs.size(0)
+                running_loss += loss.detach() * inputs.size(0)
                 running_corrects += torch.sum(preds == labels.data)
 
             avg_loss = float(running_loss)/count
@@ -493,6 +554,186 @@ def train(loaders,
     return network, acc_result, best_result, avg_results
     # acc_result is {'train': best_val_epoch_train_acc, 'val': best_val_acc, 'test': test_acc}
 
+class BatchedHeads():
+    """N linear or MLP networks (see make_model) stacked into batched weights, so they are evaluated together with bmm.
+    The weights of layer l have shape (N, in, out) and the biases (N, 1, out).
+    """
+    def __init__(self, networks):
+        if isinstance(networks[0], MLP):
+            layers = [[network.fc1, network.fc2] for network in networks]
+        else:
+            layers = [[network] for network in networks]
+        self.weights = [torch.stack([layer[l].weight.detach().t() for layer in layers]).to(device).requires_grad_()
+                        for l in range(len(layers[0]))]
+        self.biases = [torch.stack([layer[l].bias.detach().unsqueeze(0) for layer in layers]).to(device).requires_grad_()
+                       for l in range(len(layers[0]))]
+        self.layers = layers
+
+    def parameters(self):
+        return self.weights + self.biases
+
+    def get_state(self):
+        return [p.detach().clone() for p in self.parameters()]
+
+    def __call__(self, inputs):
+        # inputs is (N, batch size, in)
+        outputs = inputs
+        for l, (weight, bias) in enumerate(zip(self.weights, self.biases)):
+            if l > 0:
+                outputs = torch.relu(outputs)
+            outputs = torch.baddbmm(bias, outputs, weight)
+        return outputs
+
+    def load_into_networks(self, state):
+        num_layers = len(self.weights)
+        for i, layers in enumerate(self.layers):
+            for l, layer in enumerate(layers):
+                layer.weight.data.copy_(state[l][i].t())
+                layer.bias.data.copy_(state[num_layers + l][i, 0])
+
+def _stack_split(loaders_list, phase):
+    # The features of the split of all models on device, the row indices of each model's split and their sizes
+    features, labels, indices_list = training_utils.stack_feature_loaders([loaders[phase] for loaders in loaders_list])
+    sizes = torch.tensor([len(indices) for indices in indices_list])
+    return features.to(device), labels.to(device), [indices.to(device) for indices in indices_list], sizes
+
+def _get_index_matrix(indices_list, sizes, shuffle):
+    # Row i has the (shuffled) row indices of model i's samples, padded to the largest split (mask is False on padding)
+    max_size = int(sizes.max())
+    index_matrix = torch.zeros((len(indices_list), max_size), dtype=torch.long, device=device)
+    for i, indices in enumerate(indices_list):
+        if shuffle:
+            indices = indices[torch.randperm(len(indices)).to(device)]
+        index_matrix[i, :len(indices)] = indices
+    mask = torch.arange(max_size).unsqueeze(0) < sizes.unsqueeze(1)
+    return index_matrix, mask.to(device)
+
+def can_train_batched(loaders_list, train_mode):
+    network_name = HYPER_DICT[TRAIN_MODES_CATEGORY[train_mode].network_type].network_name
+    if not network_name in ['linear', 'mlp']:
+        return False
+    phases = [phase for phase in ['train', 'val', 'test'] if phase in loaders_list[0]]
+    for loaders in loaders_list:
+        for phase in phases:
+            if not phase in loaders or not isinstance(loaders[phase], training_utils.FeatureLoader) or len(loaders[phase].indices) == 0:
+                return False
+    return True
+
+def train_batched(loaders_list,
+                  train_mode, output_size,
+                  epochs=150, lr=0.1, weight_decay=1e-5, step_size=60,
+                  momentum=0.9, gamma=0.1):
+    """Train a linear/MLP model from scratch for each loaders dict of loaders_list (FeatureLoader only), all in lockstep.
+    Each model sees its own shuffled batches, and the padded part of a batch (or a model whose epoch is over) is masked,
+    so every model follows the same SGD (momentum, weight decay, StepLR) updates as in train().
+    Return a list of (network, acc_result, best_result, avg_results) as train().
+    """
+    num_models = len(loaders_list)
+    print(f"Training {num_models} models in lockstep..")
+    networks = [make_model(train_mode, output_size).to(device) for _ in range(num_models)]
+    heads = BatchedHeads(networks)
+    momentum_buffers = [torch.zeros_like(p) for p in heads.parameters()]
+    batch_size = loaders_list[0]['train'].batch_size
+
+    if 'val' in loaders_list[0]:
+        phases = ['train', 'val', 'test']
+    else:
+        phases = ['train', 'test']
+    splits = {phase: _stack_split(loaders_list, phase) for phase in phases}
+    avg_results = [{phase: {'loss_per_epoch': [], 'acc_per_epoch': []} for phase in phases}
+                   for _ in range(num_models)]
+
+    # Save best training loss model
+    best_loss = torch.full((num_models,), float('inf'), dtype=torch.float64, device=device)
+    best_epoch = [None for _ in range(num_models)]
+    best_state = heads.get_state()
+
+    for epoch in range(0, epochs):
+        epoch_lr = lr * gamma ** (epoch // step_size)
+        for phase in phases:
+            features, labels, indices_list, sizes = splits[phase]
+            indices, mask = _get_index_matrix(indices_list, sizes, phase == 'train')
+            running_loss = torch.zeros(num_models, dtype=torch.float64, device=device)
+            running_corrects = torch.zeros(num_models, dtype=torch.float64, device=device)
+
+            for i0 in range(0, indices.shape[1], batch_size):
+                batch_indices = indices[:, i0:i0 + batch_size]
+                batch_mask = mask[:, i0:i0 + batch_size].float()
+                batch_labels = labels[batch_indices]
+                counts = batch_mask.sum(1)
+
+                with torch.set_grad_enabled(phase == 'train'):
+                    outputs = heads(features[batch_indices])
+                    log_probability = torch.nn.functional.log_softmax(outputs, dim=2)
+                    losses = -(log_probability.gather(2, batch_labels.unsqueeze(2)).squeeze(2) * batch_mask).sum(1)
+
+                    if phase == 'train':
+                        # The sum of the mean loss of each model, so the gradient of a model only depends on its own batch
+                        loss = (losses / counts.clamp(min=1)).sum()
+                        grads = torch.autograd.grad(loss, heads.parameters())
+                        with torch.no_grad():
+                            for p, grad, buf in zip(heads.parameters(), grads, momentum_buffers):
+                                is_active = (counts > 0).view(-1, *[1] * (p.dim() - 1))
+                                buf.copy_(torch.where(is_active, momentum * buf + grad + weight_decay * p, buf))
+                                p.sub_(epoch_lr * buf * is_active)
+
+                # statistics
+                running_loss += losses.detach()
+                running_corrects += ((outputs.argmax(2) == batch_labels).float() * batch_mask).sum(1)
+
+            avg_loss = (running_loss / sizes.to(device)).tolist()
+            avg_acc = (running_corrects / sizes.to(device)).tolist()
+            for i in range(num_models):
+                avg_results[i][phase]['loss_per_epoch'].append(avg_loss[i])
+                avg_results[i][phase]['acc_per_epoch'].append(avg_acc[i])
+            if phase == 'train':
+                is_best = running_loss / sizes.to(device) < best_loss
+                best_loss = torch.where(is_best, running_loss / sizes.to(device), best_loss)
+                for state, p in zip(best_state, heads.parameters()):
+                    state[is_best] = p.detach()[is_best]
+                for i in torch.nonzero(is_best.cpu()).flatten().tolist():
+                    best_epoch[i] = epoch
+
+            print(f"Epoch {epoch}: Average {phase} Loss {np.mean(avg_loss)}, Accuracy {np.mean(avg_acc):.2%} (mean of {num_models} models)")
+
+    heads.load_into_networks(best_state)
+    results = []
+    for i, network in enumerate(networks):
+        best_result = {'best_loss': avg_results[i]['train']['loss_per_epoch'][best_epoch[i]],
+                       'best_acc': avg_results[i]['train']['acc_per_epoch'][best_epoch[i]],
+                       'best_epoch': best_epoch[i],
+                       'best_network': copy.deepcopy(network.state_dict())}
+        acc_result = {set_name: avg_results[i][set_name]['acc_per_epoch']
+                      [best_epoch[i]] for set_name in phases}
+        print(f"Model {i}: Test Accuracy (for best training loss model at epoch {best_epoch[i]}): {acc_result['test']:.2%}")
+        results.append((network, acc_result, best_result, avg_results[i]))
+    return results
+
+def train_buckets(loaders_dict, train_mode, output_size):
+    """Train a model from scratch on each bucket of loaders_dict and return {b_idx: (network, acc_result, best_result, avg_results)}.
+    Linear/MLP models on precomputed features are trained all at once with train_batched().
+    """
+    sorted_buckets = sorted(list(loaders_dict.keys()))
+    loaders_list = [loaders_dict[b_idx] for b_idx in sorted_buckets]
+    hyperparameter = HYPER_DICT[TRAIN_MODES_CATEGORY[train_mode].network_type]
+    if can_train_batched(loaders_list, train_mode):
+        results = train_batched(loaders_list,
+                                train_mode,
+                                output_size,
+                                epochs=hyperparameter.epochs,
+                                lr=hyperparameter.lr,
+                                weight_decay=hyperparameter.weight_decay,
+                                step_size=hyperparameter.step)
+    else:
+        results = [train(loaders,
+                         train_mode,
+                         output_size,
+                         epochs=hyperparameter.epochs,
+                         lr=hyperparameter.lr,
+                         weight_decay=hyperparameter.weight_decay,
+                         step_size=hyperparameter.step) for loaders in loaders_list]
+    return {b_idx: result for b_idx, result in zip(sorted_buckets, results)}
+
 def test(test_loader, network, train_mode, save_loc=None, class_names=None):
     # class_names should be sorted!!
     # If class_names != None, then return avg_acc, per_class_acc_dict
@@ -505,7 +746,9 @@ def test(test_loader, network, train_mode, save_loc=None, class_names=None):
     else:
         per_class_acc_dict = None
 
-    network = network.cuda().eval()
+    network = network.to(device).eval()
+    if isinstance(test_loader, training_utils.FeatureLoader):
+        test_loader.to(device)
     running_corrects = 0.
     count = 0
 
@@ -515,8 +758,8 @@ def test(test_loader, network, train_mode, save_loc=None, class_names=None):
         inputs, labels = data
         count += inputs.size(0)
 
-        inputs = inputs.cuda()
-        labels = labels.cuda()
+        inputs = inputs.to(device)
+        labels = labels.to(device)
 
         with torch.set_grad_enabled(False):
             outputs = network(inputs)
@@ -525,9 +768,11 @@ def test(test_loader, network, train_mode, save_loc=None, class_names=None):
         # statistics
         running_corrects += torch.sum(preds == labels.data)
         if per_class_acc_dict != None:
-            for label_i, pred_i in zip(labels.data, preds):
-                per_class_acc_dict[int(label_i)]['corrects'] += int(pred_i == label_i)
-                per_class_acc_dict[int(label_i)]['counts'] += 1
+            corrects = torch.bincount(labels, weights=(preds == labels).float(), minlength=len(class_names)).tolist()
+            counts = torch.bincount(labels, minlength=len(class_names)).tolist()
+            for idx in per_class_acc_dict:
+                per_class_acc_dict[idx]['corrects'] += corrects[idx]
+                per_class_acc_dict[idx]['counts'] += counts[idx]
         # pbar.set_postfix(acc=float(running_corrects)/count)
 
     avg_acc = float(running_corrects)/count
@@ -542,6 +787,47 @@ def test(test_loader, network, train_mode, save_loc=None, class_names=None):
     else:
         return avg_acc
 
+class BucketsTestSet():
+    """The phase split (e.g., 'test' or 'all') of every bucket of loaders_dict, to test a model on all buckets at once.
+    If all loaders are FeatureLoader, the features are concatenated once, so testing a model is one forward pass
+    and the per-bucket, per-class counts are computed with a single bincount. Otherwise it falls back to test() per bucket.
+    """
+    def __init__(self, loaders_dict, phase, eval_batch_size=8192):
+        self.sorted_buckets = sorted(list(loaders_dict.keys()))
+        self.loaders = {b_idx: loaders_dict[b_idx][phase] for b_idx in self.sorted_buckets}
+        self.eval_batch_size = eval_batch_size
+        self.is_stacked = all(isinstance(loader, training_utils.FeatureLoader) and len(loader.indices) > 0
+                              for loader in self.loaders.values())
+        if self.is_stacked:
+            features, labels, indices_list = training_utils.stack_feature_loaders([self.loaders[b_idx] for b_idx in self.sorted_buckets])
+            self.features = features.to(device)
+            self.rows = torch.cat(indices_list).to(device)
+            self.labels = labels.to(device)[self.rows]
+            sizes = torch.tensor([len(indices) for indices in indices_list])
+            self.bucket_indices = torch.repeat_interleave(torch.arange(len(self.sorted_buckets)), sizes).to(device)
+
+    def test(self, network, train_mode, class_names):
+        """Return {b_idx: (avg_acc, per_class_acc_dict)} as test(network, class_names=class_names) on each bucket
+        """
+        if not self.is_stacked:
+            return {b_idx: test(self.loaders[b_idx], network, train_mode, class_names=class_names) for b_idx in self.sorted_buckets}
+        assert sorted(class_names) == class_names
+        network = network.to(device).eval()
+        with torch.no_grad():
+            preds = torch.cat([network(self.features[self.rows[i0:i0 + self.eval_batch_size]]).argmax(1)
+                               for i0 in range(0, len(self.labels), self.eval_batch_size)])
+        num_classes = len(class_names)
+        bins = self.bucket_indices * num_classes + self.labels
+        minlength = len(self.sorted_buckets) * num_classes
+        corrects = torch.bincount(bins, weights=(preds == self.labels).float(), minlength=minlength).view(-1, num_classes).tolist()
+        counts = torch.bincount(bins, minlength=minlength).view(-1, num_classes).tolist()
+        results = {}
+        for i, b_idx in enumerate(self.sorted_buckets):
+            per_class_acc_dict = {class_name: {'corrects': float(corrects[i][idx]), 'counts': float(counts[i][idx])}
+                                  for idx, class_name in enumerate(class_names)}
+            results[b_idx] = (sum(corrects[i]) / sum(counts[i]), per_class_acc_dict)
+        return results
+
 def avg_per_class_accuracy(per_class_accuracy_dict):
     total_count = 0.
     total_per_class_acc = 0.
@@ -607,24 +893,20 @@ def run_single(loaders_dict, all_query, train_mode):
     only_positive_accuracy_test = np.zeros((all_bucket, all_bucket))
     avg_per_class_accuracy_test = np.zeros((all_bucket, all_bucket))
     b1_b2_per_class_accuracy_dict = {}
+    trained_models = train_buckets(loaders_dict, train_mode, len(all_query))
+    buckets_test_set = BucketsTestSet(loaders_dict, 'test')
     for b1 in sorted_buckets:
         b1_b2_per_class_accuracy_dict[b1] = {}
-        single_model, single_accuracy_b1, best_result, avg_results = train(loaders_dict[b1],
-                                                                           train_mode,
-                                                                           len(all_query),
-                                                                           epochs=HYPER_DICT[TRAIN_MODES_CATEGORY[train_mode].network_type].epochs,
-                                                                           lr=HYPER_DICT[TRAIN_MODES_CATEGORY[train_mode].network_type].lr,
-                                                                           weight_decay=HYPER_DICT[TRAIN_MODES_CATEGORY[train_mode].network_type].weight_decay,
-                                                                           step_size=HYPER_DICT[TRAIN_MODES_CATEGORY[train_mode].network_type].step)
+        single_model, single_accuracy_b1, best_result, avg_results = trained_models[b1]
         result_single_dict['models'][b1] = single_model
         result_single_dict['accuracy'][b1] = single_accuracy_b1
         result_single_dict['best_result_single'][b1] = best_result
         result_single_dict['avg_results_single'][b1] = avg_results
+        test_results_b1 = buckets_test_set.test(single_model, train_mode, all_query)
         for b2 in sorted_buckets:
             # if b1 == b2:
             #     import pdb; pdb.set_trace() # TODO
-            test_loader_b2 = loaders_dict[b2]['test']
-            single_accuracy_b1_b2, per_class_accuracy_b1_b2 = test(test_loader_b2, single_model, train_mode, class_names=all_query)
+            single_accuracy_b1_b2, per_class_accuracy_b1_b2 = test_results_b1[b2]
             b1_b2_per_class_accuracy_dict[b1][b2] = per_class_accuracy_b1_b2
             b1_idx = bucket_index_to_index[b1]
             b2_idx = bucket_index_to_index[b2]
@@ -658,6 +940,7 @@ def run_single_finetune(loaders_dict, all_query, train_mode):
     avg_per_class_accuracy_test = np.zeros((all_bucket, all_bucket))
     b1_b2_per_class_accuracy_dict = {}
     single_model = None
+    buckets_test_set = BucketsTestSet(loaders_dict, 'test')
     for b1 in sorted_buckets:
         b1_b2_per_class_accuracy_dict[b1] = {}
         single_model, single_accuracy_b1, best_result, avg_results = train(loaders_dict[b1],
@@ -672,9 +955,9 @@ def run_single_finetune(loaders_dict, all_query, train_mode):
         result_single_finetune_dict['accuracy'][b1] = single_accuracy_b1
         result_single_finetune_dict['best_result_single'][b1] = best_result
         result_single_finetune_dict['avg_results_single'][b1] = avg_results
+        test_results_b1 = buckets_test_set.test(single_model, train_mode, all_query)
         for b2 in sorted_buckets:
-            test_loader_b2 = loaders_dict[b2]['test']
-            single_accuracy_b1_b2, per_class_accuracy_b1_b2 = test(test_loader_b2, single_model, train_mode, class_names=all_query)
+            single_accuracy_b1_b2, per_class_accuracy_b1_b2 = test_results_b1[b2]
             b1_b2_per_class_accuracy_dict[b1][b2] = per_class_accuracy_b1_b2
             b1_idx = bucket_index_to_index[b1]
             b2_idx = bucket_index_to_index[b2]
@@ -735,60 +1018,52 @@ if __name__ == '__main__':
     ############### Create Features
     features_dict_path = os.path.join(exp_result_save_path,
                                       f"features_dict_{dataset_str(args.mode)}_{args.train_mode}_{seed_str}.pickle")
-    if os.path.exists(features_dict_path):
+    split_arrays_folder = get_split_arrays_folder(exp_result_save_path, args.mode, args.train_mode, seed_str)
+    if uses_split_arrays(args.train_mode) and has_split_arrays(split_arrays_folder):
+        print(f"{split_arrays_folder} already exists.")
+    elif os.path.exists(features_dict_path):
         print(f"{features_dict_path} already exists.")
         features_dict = load_pickle(features_dict_path)
     else:
-        features_dict = make_features_dict(dataset_dict, args.train_mode)
-        save_obj_as_pickle(features_dict_path, features_dict)
-
-    ############### Create DataLoaders
-    all_loaders_dict_path = os.path.join(exp_result_save_path,
-                                         f"all_loaders_dict_{dataset_str(args.mode)}_{args.train_mode}_{seed_str}_ex_{excluded_bucket_idx}.pickle")
-    if os.path.exists(all_loaders_dict_path):
-        print(f"{all_loaders_dict_path} already exists.")
-        all_loaders_dict = load_pickle(all_loaders_dict_path)
-    else:
-        all_loaders_dict = get_all_loaders_from_features_dict(
-                               features_dict,
-                               args.train_mode,
-                               HYPER_DICT[TRAIN_MODES_CATEGORY[args.train_mode].network_type],
-                               excluded_bucket_idx=excluded_bucket_idx
-                           )
-        save_obj_as_pickle(all_loaders_dict_path, all_loaders_dict)
-
-    loaders_dict_path = os.path.join(exp_result_save_path,
-                                     f"loaders_dict_{dataset_str(args.mode)}_{args.train_mode}_{seed_str}_ex_{excluded_bucket_idx}.pickle")
-
-    if os.path.exists(loaders_dict_path):
-        print(f"{loaders_dict_path} already exists.")
-        loaders_dict = load_pickle(loaders_dict_path)
-    else:
-        loaders_dict = get_loaders_from_features_dict(
+        features_dict = make_features_dict(dataset_dict, args.train_mode,
+                                           feature_store_folder=get_cnn_feature_store_folder(folder_path, args.train_mode))
+        if not uses_split_arrays(args.train_mode):
+            save_obj_as_pickle(features_dict_path, features_dict)
+
+    feature_arrays = None
+    if uses_split_arrays(args.train_mode):
+        # Each bucket and split is saved once as a range of rows, and the loaders are index views of these rows
+        if not has_split_arrays(split_arrays_folder):
+            save_split_arrays(split_arrays_folder, features_dict)
+        feature_arrays, features_dict = load_features_index(split_arrays_folder)
+
+    ############### Create DataLoaders (cheap to build, so they are not saved)
+    all_loaders_dict = get_all_loaders_from_features_dict(
                            features_dict,
                            args.train_mode,
                            HYPER_DICT[TRAIN_MODES_CATEGORY[args.train_mode].network_type],
-                           excluded_bucket_idx=excluded_bucket_idx
+                           excluded_bucket_idx=excluded_bucket_idx,
+                           feature_arrays=feature_arrays
                        )
-        save_obj_as_pickle(loaders_dict_path, loaders_dict)
+
+    loaders_dict = get_loaders_from_features_dict(
+                       features_dict,
+                       args.train_mode,
+                       HYPER_DICT[TRAIN_MODES_CATEGORY[args.train_mode].network_type],
+                       excluded_bucket_idx=excluded_bucket_idx,
+                       feature_arrays=feature_arrays
+                   )
 
     if not use_val_set(args.mode):
         print("Since not using a validation set, we can perform cumulative learning experiment")
-        cumulative_loaders_dict_path = os.path.join(exp_result_save_path,
-                                                    f"cumulative_loaders_dict_{dataset_str(args.mode)}_{args.train_mode}_{seed_str}_ex_{excluded_bucket_idx}.pickle")
+        cumulative_loaders_dict = get_cumulative_loaders_from_features_dict(
+                                      features_dict,
+                                      args.train_mode,
+                                      HYPER_DICT[TRAIN_MODES_CATEGORY[args.train_mode].network_type],
+                                      excluded_bucket_idx=excluded_bucket_idx,
+                                      feature_arrays=feature_arrays
+                                  )
 
-        if os.path.exists(cumulative_loaders_dict_path):
-            print(f"{cumulative_loaders_dict_path} already exists.")
-            cumulative_loaders_dict = load_pickle(cumulative_loaders_dict_path)
-        else:
-            cumulative_loaders_dict = get_cumulative_loaders_from_features_dict(
-                                        features_dict,
-                                        args.train_mode,
-                                        HYPER_DICT[TRAIN_MODES_CATEGORY[args.train_mode].network_type],
-                                        excluded_bucket_idx=excluded_bucket_idx
-                                    )
-            save_obj_as_pickle(cumulative_loaders_dict_path, cumulative_loaders_dict)
-        
         ############### Run Cumulative (Retrain) Experiment
         results_dict_cumulative_retrain_path = os.path.join(exp_result_save_path,
                                                             f"results_dict_cumulative_retrain_{dataset_str(args.mode)}_{args.train_mode}_{seed_str}_ex_{excluded_bucket_idx}.pickle")
@@ -1,5 +1,6 @@
 import training_utils
 from utils import load_pickle, save_obj_as_pickle
+from feature_store import has_split_arrays, save_split_arrays
 import random
 import argparse
 from tqdm import tqdm
@@ -11,8 +12,8 @@ import os
 
 from train import NEGATIVE_LABEL, device, MODE_DICT, HyperParameter, HYPER_DICT, TrainMode, TRAIN_MODES_CATEGORY
 from train import make_dataset_dict, split_dataset, get_seed_str, use_val_set, dataset_str, make_features_dict, extract_features, argparser
-from train import get_loader_func, get_all_loaders_from_features_dict, get_loaders_from_features_dict
-from train import MLP, make_feature_extractor, make_cnn_model, get_input_size, make_model, train, test
+from train import get_split_arrays_folder, uses_split_arrays, load_features_index, get_loader_func, get_all_loaders_from_features_dict, get_loaders_from_features_dict
+from train import MLP, make_feature_extractor, make_cnn_model, get_input_size, make_model, train, train_buckets, test, BucketsTestSet
 from train import avg_per_class_accuracy, only_positive_accuracy
 
 ALPHA_VALUE_DICT = {
@@ -25,7 +26,7 @@ argparser.add_argument("--alpha_value_mode",
                     #    default='dynamic',
                        help="Whether alpha is growing as stream is moving")
 
-def get_cumulative_loaders_from_features_dict(features_dict, train_mode, hyperparameter, excluded_bucket_idx=0):
+def get_cumulative_loaders_from_features_dict(features_dict, train_mode, hyperparameter, excluded_bucket_idx=0, feature_arrays=None):
     all_bucket = sorted(list(features_dict.keys()))
     print(f"Excluding {excluded_bucket_idx} from the cumulative loaders")
     if type(excluded_bucket_idx) == int:
@@ -33,7 +34,7 @@ def get_cumulative_loaders_from_features_dict(features_dict, train_mode, hyperpa
                         for k in all_bucket if k != excluded_bucket_idx}
     cumulative_loaders_dict = {}
 
-    loader_func = get_loader_func(train_mode, hyperparameter.batch_size)
+    loader_func = get_loader_func(train_mode, hyperparameter.batch_size, feature_arrays=feature_arrays)
 
     for b_idx in all_bucket:
         cumulative_loaders_dict[b_idx] = {}
@@ -86,23 +87,21 @@ def run_single(loaders_dict, all_query, train_mode):
     avg_per_class_accuracy_all = np.zeros((all_bucket, all_bucket))
     b1_b2_per_class_accuracy_dict_all = {}
     b1_b2_per_class_accuracy_dict = {}
+    trained_models = train_buckets(loaders_dict, train_mode, len(all_query))
+    buckets_test_set = BucketsTestSet(loaders_dict, 'test')
+    buckets_all_set = BucketsTestSet(loaders_dict, 'all')
     for b1 in sorted_buckets:
         b1_b2_per_class_accuracy_dict[b1] = {}
         b1_b2_per_class_accuracy_dict_all[b1] = {}
-        single_model, single_accuracy_b1, best_result, avg_results = train(loaders_dict[b1],
-                                                                           train_mode,
-                                                                           len(all_query),
-                                                                           epochs=HYPER_DICT[TRAIN_MODES_CATEGORY[train_mode].network_type].epochs,
-                                                                           lr=HYPER_DICT[TRAIN_MODES_CATEGORY[train_mode].network_type].lr,
-                                                                           weight_decay=HYPER_DICT[TRAIN_MODES_CATEGORY[train_mode].network_type].weight_decay,
-                                                                           step_size=HYPER_DICT[TRAIN_MODES_CATEGORY[train_mode].network_type].step)
+        single_model, single_accuracy_b1, best_result, avg_results = trained_models[b1]
         result_single_dict['models'][b1] = single_model
         result_single_dict['accuracy'][b1] = single_accuracy_b1
         result_single_dict['best_result_single'][b1] = best_result
         result_single_dict['avg_results_single'][b1] = avg_results
+        test_results_b1 = buckets_test_set.test(single_model, train_mode, all_query)
+        all_results_b1 = buckets_all_set.test(single_model, train_mode, all_query)
         for b2 in sorted_buckets:
-            test_loader_b2 = loaders_dict[b2]['test']
-            single_accuracy_b1_b2, per_class_accuracy_b1_b2 = test(test_loader_b2, single_model, train_mode, class_names=all_query)
+            single_accuracy_b1_b2, per_class_accuracy_b1_b2 = test_results_b1[b2]
             b1_b2_per_class_accuracy_dict[b1][b2] = per_class_accuracy_b1_b2
             b1_idx = bucket_index_to_index[b1]
             b2_idx = bucket_index_to_index[b2]
@@ -110,8 +109,7 @@ def run_single(loaders_dict, all_query, train_mode):
             avg_per_class_accuracy_test[b1_idx][b2_idx] = avg_per_class_accuracy(per_class_accuracy_b1_b2)
             single_accuracy_test[b1_idx][b2_idx] = single_accuracy_b1_b2
             print(f"Train {b1}, test on {b2}: {single_accuracy_b1_b2:.4%} (per sample), {only_positive_accuracy_test[b1_idx][b2_idx]:.4%} (pos only), {avg_per_class_accuracy_test[b1_idx][b2_idx]:.4%} (per class avg)")
-            all_loader_b2 = loaders_dict[b2]['all']
-            single_accuracy_b1_b2_on_all, per_class_accuracy_b1_b2_on_all = test(all_loader_b2, single_model, train_mode, class_names=all_query)
+            single_accuracy_b1_b2_on_all, per_class_accuracy_b1_b2_on_all = all_results_b1[b2]
             b1_b2_per_class_accuracy_dict_all[b1][b2] = per_class_accuracy_b1_b2_on_all
             only_positive_accuracy_all[b1_idx][b2_idx] = only_positive_accuracy(per_class_accuracy_b1_b2_on_all)
             avg_per_class_accuracy_all[b1_idx][b2_idx] = avg_per_class_accuracy(per_class_accuracy_b1_b2_on_all)
@@ -156,6 +154,8 @@ def run_single_finetune(loaders_dict, all_query, train_mode):
     b1_b2_per_class_accuracy_dict_all = {}
     b1_b2_per_class_accuracy_dict = {}
     single_model = None
+    buckets_test_set = BucketsTestSet(loaders_dict, 'test')
+    buckets_all_set = BucketsTestSet(loaders_dict, 'all')
     for b1 in sorted_buckets:
         b1_b2_per_class_accuracy_dict[b1] = {}
         b1_b2_per_class_accuracy_dict_all[b1] = {}
@@ -171,9 +171,10 @@ def run_single_finetune(loaders_dict, all_query, train_mode):
         result_single_finetune_dict['accuracy'][b1] = single_accuracy_b1
         result_single_finetune_dict['best_result_single'][b1] = best_result
         result_single_finetune_dict['avg_results_single'][b1] = avg_results
+        test_results_b1 = buckets_test_set.test(single_model, train_mode, all_query)
+        all_results_b1 = buckets_all_set.test(single_model, train_mode, all_query)
         for b2 in sorted_buckets:
-            test_loader_b2 = loaders_dict[b2]['test']
-            single_accuracy_b1_b2, per_class_accuracy_b1_b2 = test(test_loader_b2, single_model, train_mode, class_names=all_query)
+            single_accuracy_b1_b2, per_class_accuracy_b1_b2 = test_results_b1[b2]
             b1_b2_per_class_accuracy_dict[b1][b2] = per_class_accuracy_b1_b2
             b1_idx = bucket_index_to_index[b1]
             b2_idx = bucket_index_to_index[b2]
@@ -181,8 +182,7 @@ def run_single_finetune(loaders_dict, all_query, train_mode):
             avg_per_class_accuracy_test[b1_idx][b2_idx] = avg_per_class_accuracy(per_class_accuracy_b1_b2)
             single_accuracy_test[b1_idx][b2_idx] = single_accuracy_b1_b2
             print(f"Train {b1}, test on {b2}: {single_accuracy_b1_b2:.4%} (per sample), {only_positive_accuracy_test[b1_idx][b2_idx]:.4%} (pos only), {avg_per_class_accuracy_test[b1_idx][b2_idx]:.4%} (per class avg)")
-            all_loader_b2 = loaders_dict[b2]['all']
-            single_accuracy_b1_b2_on_all, per_class_accuracy_b1_b2_on_all = test(all_loader_b2, single_model, train_mode, class_names=all_query)
+            single_accuracy_b1_b2_on_all, per_class_accuracy_b1_b2_on_all = all_results_b1[b2]
             b1_b2_per_class_accuracy_dict_all[b1][b2] = per_class_accuracy_b1_b2_on_all
             only_positive_accuracy_all[b1_idx][b2_idx] = only_positive_accuracy(per_class_accuracy_b1_b2_on_all)
             avg_per_class_accuracy_all[b1_idx][b2_idx] = avg_per_class_accuracy(per_class_accuracy_b1_b2_on_all)
@@ -199,7 +199,7 @@ def run_single_finetune(loaders_dict, all_query, train_mode):
     return result_single_finetune_dict
 
 
-def get_singlememory_loaders_from_features_dict(alpha_value_mode, alpha_value, features_dict, train_mode, hyperparameter, excluded_bucket_idx=0):
+def get_singlememory_loaders_from_features_dict(alpha_value_mode, alpha_value, features_dict, train_mode, hyperparameter, excluded_bucket_idx=0, feature_arrays=None):
     # TODO: Single memory + All loaders
     all_bucket = sorted(list(features_dict.keys()))
     print(f"Excluding {excluded_bucket_idx} from the cumulative loaders")
@@ -207,7 +207,7 @@ def get_singlememory_loaders_from_features_dict(alpha_value_mode, alpha_value, f
         features_dict = {k: features_dict[k]
                          for k in all_bucket if k != excluded_bucket_idx}
     single_buffer_loaders_dict = {}
-    loader_func = get_loader_func(train_mode, hyperparameter.batch_size)
+    loader_func = get_loader_func(train_mode, hyperparameter.batch_size, feature_arrays=feature_arrays)
 
     train_buffer = [] # buffer is cap at size 1 bucket
     n = 0. # number of seen examples in the stream
@@ -310,33 +310,35 @@ if __name__ == '__main__':
     ############### Create Features
     features_dict_path = os.path.join(exp_result_save_path,
                                       f"features_dict_{dataset_str(args.mode)}_{args.train_mode}_{seed_str}.pickle")
-    if os.path.exists(features_dict_path):
+    split_arrays_folder = get_split_arrays_folder(exp_result_save_path, args.mode, args.train_mode, seed_str)
+    if uses_split_arrays(args.train_mode) and has_split_arrays(split_arrays_folder):
+        print(f"{split_arrays_folder} already exists.")
+    elif os.path.exists(features_dict_path):
         print(f"{features_dict_path} already exists.")
         features_dict = load_pickle(features_dict_path)
     else:
         import pdb; pdb.set_trace()
 
+    feature_arrays = None
+    if uses_split_arrays(args.train_mode):
+        if not has_split_arrays(split_arrays_folder):
+            save_split_arrays(split_arrays_folder, features_dict)
+        feature_arrays, features_dict = load_features_index(split_arrays_folder)
+
     if use_val_set(args.mode):
         import pdb; pdb.set_trace()
 
     for alpha_value in ALPHA_VALUE_DICT[args.alpha_value_mode]:
         print(f"Generate loader for alpha value {alpha_value} in mode {args.alpha_value_mode}")        
-        alpha_loaders_dict_path = os.path.join(exp_result_save_path,
-                                               f"alpha_loaders_dict_{dataset_str(args.mode)}_singlememory_{args.alpha_value_mode}_{alpha_value}_{args.train_mode}_{seed_str}_ex_{excluded_bucket_idx}.pickle")
-        
-        if os.path.exists(alpha_loaders_dict_path):
-            print(f"{alpha_loaders_dict_path} already exists.")
-            alpha_loaders_dict = load_pickle(alpha_loaders_dict_path)
-        else:
-            alpha_loaders_dict = get_singlememory_loaders_from_features_dict(
-                                     args.alpha_value_mode,
-                                     alpha_value,
-                                     features_dict,
-                                     args.train_mode,
-                                     HYPER_DICT[TRAIN_MODES_CATEGORY[args.train_mode].network_type],
-                                     excluded_bucket_idx=excluded_bucket_idx
-                                 )
-            save_obj_as_pickle(alpha_loaders_dict_path, alpha_loaders_dict)
+        alpha_loaders_dict = get_singlememory_loaders_from_features_dict(
+                                 args.alpha_value_mode,
+                                 alpha_value,
+                                 features_dict,
+                                 args.train_mode,
+                                 HYPER_DICT[TRAIN_MODES_CATEGORY[args.train_mode].network_type],
+                                 excluded_bucket_idx=excluded_bucket_idx,
+                                 feature_arrays=feature_arrays
+                             )
         
         ############### Run Alpha weighting (Retrain) Experiment
         results_dict_alpha_retrain_path = os.path.join(exp_result_save_path,
@@ -362,20 +364,13 @@ if __name__ == '__main__':
         
     # exit(0) # No longer needed because we have online.py
     #### Rerun the rest for testing all loader
-    loaders_dict_path = os.path.join(exp_result_save_path,
-                                     f"loaders_dict_{dataset_str(args.mode)}_{args.train_mode}_{seed_str}_ex_{excluded_bucket_idx}.pickle")
-
-    if os.path.exists(loaders_dict_path):
-        print(f"{loaders_dict_path} already exists.")
-        loaders_dict = load_pickle(loaders_dict_path)
-    else:
-        loaders_dict = get_loaders_from_features_dict(
-                           features_dict,
-                           args.train_mode,
-                           HYPER_DICT[TRAIN_MODES_CATEGORY[args.train_mode].network_type],
-                           excluded_bucket_idx=excluded_bucket_idx
-                       )
-        save_obj_as_pickle(loaders_dict_path, loaders_dict)
+    loaders_dict = get_loaders_from_features_dict(
+                       features_dict,
+                       args.train_mode,
+                       HYPER_DICT[TRAIN_MODES_CATEGORY[args.train_mode].network_type],
+                       excluded_bucket_idx=excluded_bucket_idx,
+                       feature_arrays=feature_arrays
+                   )
 
     ############### Run Single Bucket Experiment
     results_dict_single_path = os.path.join(exp_result_save_path,
@@ -399,20 +394,13 @@ if __name__ == '__main__':
     else:
         print(results_dict_single_finetune_path + " already exists")
 
-    cumulative_loaders_dict_path = os.path.join(exp_result_save_path,
-                                                f"cumulative_loaders_dict_with_all_{dataset_str(args.mode)}_{args.train_mode}_{seed_str}_ex_{excluded_bucket_idx}.pickle")
-
-    if os.path.exists(cumulative_loaders_dict_path):
-        print(f"{cumulative_loaders_dict_path} already exists.")
-        cumulative_loaders_dict = load_pickle(cumulative_loaders_dict_path)
-    else:
-        cumulative_loaders_dict = get_cumulative_loaders_from_features_dict(
-                                    features_dict,
-                                    args.train_mode,
-                                    HYPER_DICT[TRAIN_MODES_CATEGORY[args.train_mode].network_type],
-                                    excluded_bucket_idx=excluded_bucket_idx
-                                )
-        save_obj_as_pickle(cumulative_loaders_dict_path, cumulative_loaders_dict)
+    cumulative_loaders_dict = get_cumulative_loaders_from_features_dict(
+                                features_dict,
+                                args.train_mode,
+                                HYPER_DICT[TRAIN_MODES_CATEGORY[args.train_mode].network_type],
+                                excluded_bucket_idx=excluded_bucket_idx,
+                                feature_arrays=feature_arrays
+                            )
     
     ############### Run Cumulative (Retrain) Experiment
     results_dict_cumulative_retrain_path = os.path.join(exp_result_save_path,
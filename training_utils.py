@@ -18,6 +18,7 @@ import copy
 
 from torch.utils.data import Dataset
 from torchvision.datasets.folder import default_loader
+from image_shards import ImageShardDataset
 import os
 
 class SimpleDataset(Dataset):
@@ -77,6 +78,71 @@ def make_tensor_loader(items, batch_size, shuffle=False, num_workers=4):
         num_workers=num_workers,
     )
 
+class FeatureLoader():
+    """Iterate over (features, labels) batches of precomputed features (e.g., CLIP features) without a DataLoader.
+    The loader is a view (indices) of the rows of a contiguous feature tensor (which may be shared by many loaders),
+    and each epoch iterates over the indices (or a random permutation of them if shuffle), so no worker process
+    or per-sample collation is needed. Call to(device) to keep the features on the training device.
+    """
+    def __init__(self, features, labels, batch_size, shuffle=False, indices=None):
+        self.features = features
+        self.labels = labels
+        if type(indices) == type(None):
+            indices = torch.arange(len(labels))
+        self.indices = indices.to(labels.device)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def to(self, device):
+        # No copy if already on device, so the loaders sharing the features still share them
+        self.features = self.features.to(device)
+        self.labels = self.labels.to(device)
+        self.indices = self.indices.to(device)
+        return self
+
+    def __len__(self):
+        return (len(self.indices) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        indices = self.indices
+        if self.shuffle:
+            indices = indices[torch.randperm(len(indices)).to(indices.device)]
+        for i0 in range(0, len(indices), self.batch_size):
+            batch_indices = indices[i0:i0 + self.batch_size]
+            yield self.features[batch_indices], self.labels[batch_indices]
+
+def make_feature_loader(items, batch_size, shuffle=False, feature_arrays=None):
+    """items is a list of (feature, label), or a list of row indices of feature_arrays = (features, labels) if not None
+    """
+    if feature_arrays != None:
+        features, labels = feature_arrays
+        return FeatureLoader(features, labels, batch_size, shuffle=shuffle, indices=torch.tensor(items, dtype=torch.long))
+    if len(items) > 0:
+        features = torch.stack([torch.as_tensor(feature) for feature, _ in items]).float()
+    else:
+        features = torch.zeros((0, 0))
+    labels = torch.tensor([int(label) for _, label in items], dtype=torch.long)
+    return FeatureLoader(features, labels, batch_size, shuffle=shuffle)
+
+def stack_feature_loaders(loaders):
+    """Return (features, labels, list of the row indices of each loader) with the features of all loaders.
+    The features shared by several loaders (e.g., the cumulative loaders) are only included once.
+    """
+    offsets = {}
+    all_features, all_labels, all_indices = [], [], []
+    num_rows = 0
+    for loader in loaders:
+        key = id(loader.features)
+        if not key in offsets:
+            offsets[key] = num_rows
+            all_features.append(loader.features)
+            all_labels.append(loader.labels)
+            num_rows += len(loader.labels)
+        all_indices.append(loader.indices + offsets[key])
+    if len(all_features) == 1:
+        return all_features[0], all_labels[0], all_indices
+    return torch.cat(all_features), torch.cat(all_labels), all_indices
+
 def make_image_loader(items, batch_size, shuffle=False, fixed_crop=False, num_workers=4):
     # items = [(os.path.join(m['IMG_DIR'], m['IMG_PATH']), l) for m, l in items]
     # import pdb; pdb.set_trace()
@@ -155,6 +221,17 @@ def make_loader(dataset, transform, shuffle=False, batch_size=256, num_workers=0
         num_workers=num_workers,
     )
 
+def make_shard_loader(shard_folder, transform, shuffle=False, batch_size=256, num_workers=0, rank=0, world_size=1, seed=0, drop_last=False):
+    # Stream the images packed by image_shards.pack_labeled_images (sequential reads, shuffled with a buffer)
+    # For distributed training, each rank reads its own part of the samples (no sampler). With drop_last=True all ranks run the same number of batches.
+    # Call loader.dataset.set_epoch(epoch) before each epoch to reshuffle the shards.
+    return torch.utils.data.DataLoader(
+        ImageShardDataset(shard_folder, transform, shuffle=shuffle, rank=rank, world_size=world_size, seed=seed, batch_size=batch_size),
+        batch_size=batch_size,
+        num_workers=num_workers,
+        drop_last=drop_last,
+    )
+
 def make_clip_loader(dataset, shuffle=False, batch_size=256, num_workers=0):
     return torch.utils.data.DataLoader(
         CLIPDataset(dataset), 
@@ -2,6 +2,7 @@ import pickle
 import os
 import numpy as np
 import json
+import shutil
 
 def makedirs(path):
     if not os.path.exists(path):
@@ -27,6 +28,51 @@ def save_as_json(json_location, obj):
     with open(json_location, "w+") as f:
         json.dump(obj, f)
 
+def save_as_json_atomic(json_location, obj):
+    """Save via a temporary file + rename, so a crash never leaves a partially written file at json_location
+    """
+    tmp_location = json_location + ".tmp"
+    with open(tmp_location, "w+") as f:
+        json.dump(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_location, json_location)
+
+def save_numpy_atomic(numpy_location, matrix):
+    """Save a numpy array via a temporary file + rename (same as save_as_json_atomic)
+    """
+    tmp_location = numpy_location + ".tmp"
+    with open(tmp_location, 'wb') as f:
+        np.save(f, matrix)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_location, numpy_location)
+
+def save_bytes_atomic(file_location, content, fsync=True):
+    """Save bytes via a temporary file + rename (same as save_as_json_atomic).
+    If fsync is False, a crash of the process still never leaves a partially written file (but a power loss might).
+    """
+    tmp_location = file_location + ".tmp"
+    with open(tmp_location, 'wb') as f:
+        f.write(content)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp_location, file_location)
+
+def link_or_copy(src_location, file_location):
+    """Hardlink src_location at file_location (replaced if exists), or copy it if hardlinks are not supported (e.g., another file system).
+    The linked files share the same content, so they must never be modified in place.
+    """
+    tmp_location = file_location + ".tmp"
+    try:
+        if os.path.lexists(tmp_location):
+            os.remove(tmp_location)
+        os.link(src_location, tmp_location)
+        os.replace(tmp_location, file_location)
+    except OSError:
+        shutil.copyfile(src_location, file_location)
+
 def load_json(json_location, default_obj=None):
     if os.path.exists(json_location):
         try:
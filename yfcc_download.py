@@ -5,7 +5,11 @@
 from io import BytesIO
 import os
 import re
-from urllib.parse import unquote_plus
+import struct
+import math
+import bisect
+import numpy as np
+from urllib.parse import unquote_plus, urlparse
 import time
 import logging
 import argparse
@@ -13,14 +17,17 @@ import time
 from PIL import Image
 import subprocess
 import requests
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
 from datetime import datetime
 from dateutil import parser
 import shutil
 import random
 import imagesize
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from utils import save_as_json, load_json
+import queue
+from utils import save_as_json, save_as_json_atomic, load_json, save_bytes_atomic, link_or_copy
+from image_store import ImageStore, get_image_store_folder
+from metadata_store import MetadataStore, save_metadata_columns, has_metadata_columns
 import threading
 import sys
 import time
@@ -54,6 +61,18 @@ argparser.add_argument("--use_valid_date",
 argparser.add_argument("--max_workers",
                         type=int, default=128,
                         help="The number of parallel workers for image download.")
+argparser.add_argument("--ingest_workers",
+                        type=int, default=8,
+                        help="The number of processes parsing the dataset files into shards (see yfcc_ingest.py).")
+argparser.add_argument("--max_connections_per_host",
+                        type=int, default=32,
+                        help="The maximum number of concurrent downloads (pooled keep-alive connections) per Flickr farm host.")
+argparser.add_argument("--connect_timeout",
+                        type=float, default=5,
+                        help="Timeout (in seconds) for connecting to a Flickr server.")
+argparser.add_argument("--read_timeout",
+                        type=float, default=30,
+                        help="Timeout (in seconds) between bytes received from a Flickr server.")
 
 # The index of metadata field for dataset file
 IDX_LIST = [
@@ -114,13 +133,16 @@ def _parse_autotags(line):
     else:
         tags = entries[1].split(",")
         if len(tags) > 0:
-            tag_scores = {t.split(":")[0] : float(t.split(":")[1]) for t in tags}
+            tag_scores = {}
+            for t in tags:
+                tag, _, score = t.partition(":")
+                tag_scores[tag] = float(score)
         else:
             tag_scores = {}
     return entries[0], tag_scores
 
-def _parse_metadata(data, autotag, line_num, hash_dict, save_folder, exif_line=None):
-    """Parse the metadata and return MetadataObject
+def _parse_record(data, autotag, line_num, exif_line=None):
+    """Parse the lines of an image in the dataset files (without the fields of the downloaded image)
     """
     metadata = {}
 
@@ -142,49 +164,423 @@ def _parse_metadata(data, autotag, line_num, hash_dict, save_folder, exif_line=N
         assert metadata['ID'] == exif_ID, "EXIF ID != Photo ID"
     else:
         exif_number = None
-    
-    hash_value = hash_dict[metadata['ID']]
-    img_dir = os.path.abspath(save_folder)
-    img_path = f"{metadata['ID']}.{metadata['EXT']}"
 
     metadata['AUTO_TAG_SCORES'] = autotag_scores
     metadata['LINE_NUM'] = line_number
     metadata['EXIF'] = exif_number
+    return metadata
+
+def _add_image_fields(metadata, hash_value, save_folder):
+    img_dir = os.path.abspath(save_folder)
+    img_path = f"{metadata['ID']}.{metadata['EXT']}"
+
     metadata['HASH_VALUE'] = hash_value
     metadata['IMG_DIR'] = img_dir
     metadata['IMG_PATH'] = img_path
-
     return metadata
 
-def fetch_and_save_image(img_path, url, MIN_EDGE=0, MAX_ASPECT_RATIO=None, MAX_NUM_OF_TRAILS=3, MIN_IMAGE_SIZE=2100):
-    """Return true if image is valid and successfully downloaded
+def _parse_metadata(data, autotag, line_num, hash_value, save_folder, exif_line=None):
+    """Parse the metadata and return MetadataObject
+    """
+    metadata = _parse_record(data, autotag, line_num, exif_line=exif_line)
+    return _add_image_fields(metadata, hash_value, save_folder)
+
+# The download status of an image (saved in the status log of each folder)
+STATUS_OK = 'ok' # Downloaded
+STATUS_FILTERED = 'filtered' # Not a valid image (will not be downloaded again)
+STATUS_FAILED = 'failed' # The download failed (will be retried when the script is rerun)
+
+HEADER_CHUNK_SIZE = 4096 # Bytes read at a time until the image size is parsed
+MAX_HEADER_SIZE = 131072 # Give up parsing the image size from the header after this many bytes (and check the full image instead)
+BODY_CHUNK_SIZE = 65536
+QUEUE_SIZE_PER_WORKER = 4 # The number of lines waiting in the download queue per worker
+
+STATS_INTERVAL = 60 # Print the one-line summary and save the download stats every this many seconds
+LATENCY_BUCKETS = [0.01, 0.03, 0.1, 0.3, 1., 3., 10., 30.] # Upper bounds (in seconds) of the latency histograms (the last bucket is unbounded)
+
+JPEG_SOF_MARKERS = [0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF]
+
+def get_image_size_from_header(header):
+    """Return (width, height) parsed from the first bytes of a JPEG (SOF segment), PNG (IHDR chunk) or GIF file,
+    or None if not found in header (more bytes are needed, or not a supported format)
+    """
+    if header[:8] == b'\x89PNG\r\n\x1a\n':
+        if len(header) >= 24 and header[12:16] == b'IHDR':
+            return struct.unpack('>II', header[16:24])
+        return None
+    if header[:6] in [b'GIF87a', b'GIF89a']:
+        if len(header) >= 10:
+            return struct.unpack('<HH', header[6:10])
+        return None
+    if header[:2] == b'\xff\xd8':
+        i = 2
+        while i + 4 <= len(header):
+            if header[i] != 0xFF:
+                return None # Not a valid JPEG marker
+            marker = header[i+1]
+            if marker == 0xFF: # Fill byte
+                i += 1
+                continue
+            if marker == 0x01 or 0xD0 <= marker <= 0xD8: # Markers without a segment
+                i += 2
+                continue
+            if marker in JPEG_SOF_MARKERS:
+                if i + 9 > len(header):
+                    return None
+                height, width = struct.unpack('>HH', header[i+5:i+9])
+                return width, height
+            segment_length = struct.unpack('>H', header[i+2:i+4])[0]
+            i += 2 + segment_length
+    return None
+
+def is_valid_image_size(width, height, MIN_EDGE=0, MAX_ASPECT_RATIO=None):
+    if width < MIN_EDGE or height < MIN_EDGE:
+        return False
+    if min(width, height) == 0:
+        return False
+    ratio = max(width, height) / min(width, height)
+    if MAX_ASPECT_RATIO and ratio > MAX_ASPECT_RATIO:
+        return False
+    return True
+
+def get_farm(url):
+    """Return the Flickr farm of a download url (e.g., farm3 for farm3.staticflickr.com), or the host if not a farm
+    """
+    host = urlparse(url).netloc
+    match = re.match(r"^(farm\d+)\.", host)
+    return match.group(1) if match else host
+
+class DownloadStats():
+    """Thread-safe counters and latency histograms of the download stages per Flickr farm:
+    fetch (HTTP), validate (image size check), write (save to disk) and reuse (from a save folder with looser filters).
+    Also counts the final status of every image and the reasons of filtered/failed images
+    (the fetch errors, e.g., ReadTimeout or http_503, are counted per trial).
     """
-    trials = 0
-    max_trails = MAX_NUM_OF_TRAILS
-    sleep_time = 1
-    while True:
-        try:
-            response = requests.get(url)
-            img = Image.open(BytesIO(response.content))
-            if img.size[0] < MIN_EDGE or img.size[1] < MIN_EDGE:
-                return False
-            max_edge = max(img.size[0], img.size[1])
-            min_edge = min(img.size[0], img.size[1])
-            ratio = max_edge / min_edge
-            if MAX_ASPECT_RATIO and ratio > MAX_ASPECT_RATIO:
-                return False
-            img.save(img_path)
-            if os.path.getsize(img_path) < MIN_IMAGE_SIZE:
-                return False
-            return True
-        except:
-            if trials < max_trails:
-                time.sleep(sleep_time)
-                trials += 1
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.stages = {} # key is (stage, farm), value is a dict of count, total seconds and histogram
+        self.statuses = {} # key is (status, farm), value is count
+        self.reasons = {} # key is (reason, farm), value is count
+
+    def observe(self, stage, farm, seconds):
+        with self.lock:
+            if not (stage, farm) in self.stages:
+                self.stages[(stage, farm)] = {'count' : 0, 'seconds' : 0., 'histogram' : [0 for _ in range(len(LATENCY_BUCKETS) + 1)]}
+            stage_dict = self.stages[(stage, farm)]
+            stage_dict['count'] += 1
+            stage_dict['seconds'] += seconds
+            stage_dict['histogram'][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def count_status(self, status, farm):
+        with self.lock:
+            self.statuses[(status, farm)] = self.statuses.get((status, farm), 0) + 1
+
+    def count_reason(self, reason, farm):
+        with self.lock:
+            self.reasons[(reason, farm)] = self.reasons.get((reason, farm), 0) + 1
+
+    def _total(self, counts):
+        # Sum over the farms
+        total = {}
+        for (key, _), count in counts.items():
+            total[key] = total.get(key, 0) + count
+        return total
+
+    def to_dict(self):
+        with self.lock:
+            stage_dict = {}
+            for (stage, farm), farm_dict in sorted(self.stages.items()):
+                if not stage in stage_dict:
+                    stage_dict[stage] = {'count' : 0, 'seconds' : 0., 'histogram' : [0 for _ in range(len(LATENCY_BUCKETS) + 1)], 'farms' : {}}
+                stage_dict[stage]['count'] += farm_dict['count']
+                stage_dict[stage]['seconds'] += farm_dict['seconds']
+                stage_dict[stage]['histogram'] = [a + b for a, b in zip(stage_dict[stage]['histogram'], farm_dict['histogram'])]
+                stage_dict[stage]['farms'][farm] = dict(farm_dict)
+            farm_dict = {}
+            for name, counts in [('statuses', self.statuses), ('reasons', self.reasons)]:
+                for (key, farm), count in sorted(counts.items()):
+                    if not farm in farm_dict:
+                        farm_dict[farm] = {'statuses' : {}, 'reasons' : {}}
+                    farm_dict[farm][name][key] = count
+            return {
+                'elapsed_seconds' : time.time() - self.start_time,
+                'latency_buckets' : LATENCY_BUCKETS,
+                'statuses' : self._total(self.statuses),
+                'reasons' : self._total(self.reasons),
+                'stages' : stage_dict,
+                'farms' : farm_dict,
+            }
+
+    def get_summary_str(self):
+        stats_dict = self.to_dict()
+        elapsed = stats_dict['elapsed_seconds']
+        statuses = stats_dict['statuses']
+        num_finished = sum(statuses.values())
+        info_str = f"{elapsed:.0f}s: {num_finished} images ({num_finished / max(elapsed, 1e-6):.1f}/s)"
+        info_str += " | " + ", ".join(f"{status} {count}" for status, count in sorted(statuses.items()))
+        info_str += " | " + ", ".join(f"{stage} {1000 * stage_dict['seconds'] / max(stage_dict['count'], 1):.1f}ms"
+                                      for stage, stage_dict in stats_dict['stages'].items())
+        if len(stats_dict['reasons']) > 0:
+            reason, count = max(stats_dict['reasons'].items(), key=lambda item: item[1])
+            info_str += f" | top reason {reason} ({count})"
+        return info_str
+
+    def save(self, stats_location):
+        save_as_json_atomic(stats_location, self.to_dict())
+
+class ImageFetcher():
+    """Download with pooled keep-alive connections (a requests.Session per host, e.g., farm1.staticflickr.com),
+    connect/read timeouts, retries with exponential backoff (with jitter), and a limit of concurrent downloads per host.
+    Thread-safe, so a single fetcher is shared by all download workers.
+    """
+    def __init__(self,
+                 max_connections_per_host=32,
+                 connect_timeout=5,
+                 read_timeout=30,
+                 max_num_of_trials=3,
+                 backoff_base=0.5, # Sleep up to backoff_base * 2^trial seconds before retrying
+                 backoff_max=30,
+                 stats=None): # DownloadStats (optional) to count the fetch errors
+        self.stats = stats
+        self.max_connections_per_host = max_connections_per_host
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_num_of_trials = max_num_of_trials
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.lock = threading.Lock()
+        self.sessions = {} # key is host, value is requests.Session
+        self.semaphores = {} # key is host, value is threading.BoundedSemaphore
+        self.start_time = time.time()
+        self.num_of_images = 0
+        self.num_of_bytes = 0
+        self.num_of_rejected = 0 # Rejected by is_valid_header() before the full download
+
+    def _get_host(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            if not host in self.sessions:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_connections_per_host)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self.sessions[host] = session
+                self.semaphores[host] = threading.BoundedSemaphore(self.max_connections_per_host)
+        return host
+
+    def _count_reason(self, reason, url):
+        if self.stats != None:
+            self.stats.count_reason(reason, get_farm(url))
+
+    def backoff_time(self, trial):
+        # Full jitter, so the retries of workers failing at the same time are spread out
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** trial))
+
+    def _read(self, response, content_length, is_valid_header=None):
+        # Return the body, or None if rejected by is_valid_header(header, content_length) after reading only the header
+        # is_valid_header returns True/False, or None if more bytes are needed
+        if is_valid_header == None:
+            return response.content
+        header = b""
+        is_finished = True
+        for chunk in response.iter_content(HEADER_CHUNK_SIZE):
+            header += chunk
+            decision = is_valid_header(header, content_length)
+            if decision == False:
+                response.close()
+                return None
+            elif decision == True:
+                is_finished = False
+                break
+        if is_finished:
+            return header
+        return header + b"".join(response.iter_content(BODY_CHUNK_SIZE))
+
+    def get(self, url, is_valid_header=None):
+        """Return (status, response body). The body is None unless status is STATUS_OK.
+        STATUS_FILTERED if the image does not exist (e.g., 404) or is rejected by is_valid_header, and
+        STATUS_FAILED if the download failed after all trials (worth retrying later).
+        If is_valid_header is not None, the body is streamed and the download stops early
+        once is_valid_header(first bytes, Content-Length) returns False.
+        """
+        host = self._get_host(url)
+        for trial in range(self.max_num_of_trials + 1):
+            if trial > 0:
+                time.sleep(self.backoff_time(trial - 1))
+            try:
+                with self.semaphores[host]:
+                    response = self.sessions[host].get(url, timeout=self.timeout, stream=is_valid_header != None)
+                    if response.status_code == 200:
+                        content_length = response.headers.get('Content-Length')
+                        content_length = int(content_length) if content_length != None and content_length.isdigit() else None
+                        content = self._read(response, content_length, is_valid_header=is_valid_header)
+                    else:
+                        response.close()
+            except requests.RequestException as e:
+                self._count_reason(type(e).__name__, url)
                 continue
-            else:
-                return False
-          
+            if response.status_code == 200:
+                if content == None:
+                    with self.lock:
+                        self.num_of_rejected += 1
+                    self._count_reason('rejected_header', url)
+                    return STATUS_FILTERED, None
+                if content_length != None and len(content) != content_length:
+                    self._count_reason('truncated', url)
+                    continue # Truncated body (the bytes are saved without decoding, so it must be complete)
+                with self.lock:
+                    self.num_of_images += 1
+                    self.num_of_bytes += len(content)
+                return STATUS_OK, content
+            self._count_reason(f"http_{response.status_code}", url)
+            if response.status_code != 429 and response.status_code < 500:
+                return STATUS_FILTERED, None # e.g., 404 for deleted photos. Retrying will not help.
+        return STATUS_FAILED, None
+
+    def images_per_sec(self):
+        return self.num_of_images / (time.time() - self.start_time)
+
+    def get_info_str(self):
+        elapsed = time.time() - self.start_time
+        return (f"{self.num_of_images} images ({self.num_of_bytes / 2**20:.1f} MB) in {elapsed:.1f} seconds = {self.images_per_sec():.2f} images/sec"
+                f" ({self.num_of_rejected} images rejected from the header)")
+
+def _count_lines(file_location, buffer_size=2**24):
+    num_lines = 0
+    with open(file_location, 'rb') as f:
+        while True:
+            buffer = f.read(buffer_size)
+            if not buffer:
+                return num_lines
+            num_lines += buffer.count(b"\n")
+
+class HashColumn():
+    """The MD5 hashes of yfcc100m_hash (line-aligned with yfcc100m_dataset) as a memory-mapped (num_lines x 16) uint8 array,
+    along with the photo IDs to check the alignment. Built once next to the hash file, and nothing is loaded afterwards.
+    """
+    def __init__(self, hash_file, block_size=1000000):
+        self.hash_location = hash_file + "_md5.npy"
+        self.ids_location = hash_file + "_ids.npy"
+        if not os.path.exists(self.hash_location) or not os.path.exists(self.ids_location):
+            self._build(hash_file, block_size=block_size)
+        self.hashes = np.load(self.hash_location, mmap_mode='r')
+        self.ids = np.load(self.ids_location, mmap_mode='r')
+        print(f"Load {len(self.ids)} hashes at {self.hash_location}")
+
+    def _build(self, hash_file, block_size=1000000):
+        num_lines = _count_lines(hash_file)
+        hash_tmp_location = self.hash_location + ".tmp"
+        ids_tmp_location = self.ids_location + ".tmp"
+        hashes = np.lib.format.open_memmap(hash_tmp_location, mode='w+', dtype=np.uint8, shape=(num_lines, 16))
+        ids = np.lib.format.open_memmap(ids_tmp_location, mode='w+', dtype=np.int64, shape=(num_lines,))
+        with open(hash_file, 'r') as hash_f:
+            i0 = 0
+            block_ids, block_hashes = [], []
+            for hash_line in tqdm(hash_f, total=num_lines):
+                hash_id, hash_value = hash_line.strip().split("\t")
+                block_ids.append(int(hash_id))
+                block_hashes.append(bytes.fromhex(hash_value))
+                if len(block_ids) == block_size:
+                    ids[i0:i0 + len(block_ids)] = block_ids
+                    hashes[i0:i0 + len(block_ids)] = np.frombuffer(b"".join(block_hashes), dtype=np.uint8).reshape(-1, 16)
+                    i0 += len(block_ids)
+                    block_ids, block_hashes = [], []
+            if len(block_ids) > 0:
+                ids[i0:i0 + len(block_ids)] = block_ids
+                hashes[i0:i0 + len(block_ids)] = np.frombuffer(b"".join(block_hashes), dtype=np.uint8).reshape(-1, 16)
+        hashes.flush()
+        ids.flush()
+        del hashes, ids
+        os.replace(hash_tmp_location, self.hash_location)
+        os.replace(ids_tmp_location, self.ids_location)
+        print(f"Saved {num_lines} hashes at {self.hash_location}")
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get(self, line_idx, ID=None):
+        """Return the MD5 hash (hex string) of the line_idx-th image
+        """
+        if ID != None:
+            assert self.ids[line_idx] == int(ID), "HASH ID != Photo ID"
+        return self.hashes[line_idx].tobytes().hex()
+
+def fetch_and_save_image(img_path, url, MIN_EDGE=0, MAX_ASPECT_RATIO=None, MAX_NUM_OF_TRAILS=3, MIN_IMAGE_SIZE=2100, fetcher=None, stats=None, image_store=None, hash_value=None):
+    """Return STATUS_OK if image is valid and successfully downloaded,
+    STATUS_FILTERED if image is invalid, and STATUS_FAILED if the download failed
+    The latency of each stage and the reasons of filtered/failed images are added to stats (DownloadStats) if not None.
+    If image_store (ImageStore) is not None, the image is saved in the store (indexed by hash_value, i.e., HASH_VALUE, if not None) and img_path is a hardlink to it.
+    """
+    if fetcher == None:
+        fetcher = ImageFetcher(max_num_of_trials=MAX_NUM_OF_TRAILS)
+    farm = get_farm(url)
+    def observe(stage, start_time):
+        if stats != None:
+            stats.observe(stage, farm, time.time() - start_time)
+    def count_reason(reason):
+        if stats != None:
+            stats.count_reason(reason, farm)
+    def is_valid_header(header, content_length):
+        # Reject by Content-Length and by the image size in the header before downloading the rest
+        if content_length != None and content_length < MIN_IMAGE_SIZE:
+            return False
+        image_size = get_image_size_from_header(header)
+        if image_size == None:
+            return None if len(header) < MAX_HEADER_SIZE else True
+        return is_valid_image_size(image_size[0], image_size[1], MIN_EDGE=MIN_EDGE, MAX_ASPECT_RATIO=MAX_ASPECT_RATIO)
+    start_time = time.time()
+    status, content = fetcher.get(url, is_valid_header=is_valid_header)
+    observe('fetch', start_time)
+    if status != STATUS_OK:
+        return status
+    start_time = time.time()
+    if len(content) < MIN_IMAGE_SIZE:
+        count_reason('too_small')
+        return STATUS_FILTERED
+    try:
+        image_size = get_image_size_from_header(content)
+        if image_size == None:
+            # Not parsed from the header. PIL only reads the header here (the pixels are not decoded).
+            image_size = Image.open(BytesIO(content)).size
+        if not is_valid_image_size(image_size[0], image_size[1], MIN_EDGE=MIN_EDGE, MAX_ASPECT_RATIO=MAX_ASPECT_RATIO):
+            count_reason('invalid_size')
+            return STATUS_FILTERED
+    except:
+        count_reason('undecodable')
+        return STATUS_FILTERED
+    finally:
+        observe('validate', start_time)
+    # Save the downloaded bytes (no re-encoding). They only match HASH_VALUE if the original size is downloaded.
+    # No fsync per image (too slow for 100M images). The status log is fsynced in batches after the images are saved.
+    start_time = time.time()
+    try:
+        if image_store != None:
+            image_store.link(image_store.put(content, key=hash_value), img_path)
+        else:
+            save_bytes_atomic(img_path, content, fsync=False)
+    except OSError as e:
+        count_reason(f"write_{type(e).__name__}")
+        return STATUS_FAILED
+    finally:
+        observe('write', start_time)
+    return STATUS_OK
+
+def check_image_file(img_path, MIN_EDGE=0, MAX_ASPECT_RATIO=None, MIN_IMAGE_SIZE=2100):
+    """Return STATUS_OK if a saved image is valid, otherwise STATUS_FILTERED (only the header is read)
+    """
+    if os.path.getsize(img_path) < MIN_IMAGE_SIZE:
+        return STATUS_FILTERED
+    try:
+        with open(img_path, 'rb') as f:
+            image_size = get_image_size_from_header(f.read(MAX_HEADER_SIZE))
+        if image_size == None:
+            image_size = Image.open(img_path).size
+        if not is_valid_image_size(image_size[0], image_size[1], MIN_EDGE=MIN_EDGE, MAX_ASPECT_RATIO=MAX_ASPECT_RATIO):
+            return STATUS_FILTERED
+    except:
+        return STATUS_FILTERED
+    return STATUS_OK
+
 def get_flickr_image_folder(folder_location, idx):
     folder = os.path.join(folder_location, str(idx))
     return os.path.join(folder, "images")
@@ -193,12 +589,24 @@ def get_flickr_metadata_json_path(folder_location, idx):
     folder = os.path.join(folder_location, str(idx))
     return os.path.join(folder, "metadata.json")
 
+def get_flickr_metadata_columns_path(folder_location, idx):
+    folder = os.path.join(folder_location, str(idx))
+    return os.path.join(folder, "metadata_columns")
+
+def get_flickr_status_log_path(folder_location, idx):
+    folder = os.path.join(folder_location, str(idx))
+    return os.path.join(folder, "status.log")
+
 def get_flickr_folder_dict(idx, folder_location, num_images=10000):
     flickr_folder_dict = {
         'folder' : os.path.join(folder_location, str(idx)),
         'num_images' : num_images,
         'image_folder' : get_flickr_image_folder(folder_location, idx),
         'metadata_location' : get_flickr_metadata_json_path(folder_location, idx),
+        'metadata_columns_location' : get_flickr_metadata_columns_path(folder_location, idx),
+        'status_log_location' : get_flickr_status_log_path(folder_location, idx),
+        'is_complete' : False, # True once the metadata of all images of this folder is saved
+        'num_failed' : 0, # The number of images that failed to download (retried when the script is rerun)
     }
     if not os.path.exists(flickr_folder_dict['image_folder']):
         print(f"make dir at {flickr_folder_dict['image_folder']}")
@@ -206,9 +614,74 @@ def get_flickr_folder_dict(idx, folder_location, num_images=10000):
     
     return flickr_folder_dict 
 
+def _get_metadata_columns_location(flickr_folder):
+    # Folders downloaded before the columnar store was added do not have this key
+    return flickr_folder.get('metadata_columns_location', os.path.join(flickr_folder['folder'], "metadata_columns"))
+
+def _get_status_log_location(flickr_folder):
+    # Folders downloaded before the status logs were added do not have this key
+    return flickr_folder.get('status_log_location', os.path.join(flickr_folder['folder'], "status.log"))
+
+class DownloadStatusLog():
+    """An append-only log of the download status (one "ID\tstatus" line per image) of a folder.
+    The lines are flushed and fsynced in batches (every sync_every lines or sync_interval seconds),
+    so a crash loses at most the last batch, and these images are downloaded again.
+    """
+    def __init__(self, log_location, sync_every=1000, sync_interval=10.):
+        self.log_location = log_location
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.lock = threading.Lock()
+        self.num_of_unsynced = 0
+        self.last_sync_time = time.time()
+        self.f = None
+
+    def load(self, truncate=True):
+        """Return a dictionary with key ID and value status (the last one if an ID is logged multiple times)
+        """
+        statuses = {}
+        if not os.path.exists(self.log_location):
+            return statuses
+        with open(self.log_location, 'rb') as f:
+            data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data) and truncate:
+            # The last line was partially written before a crash
+            with open(self.log_location, 'r+b') as f:
+                f.truncate(end)
+        for line in data[:end].decode('utf-8').splitlines():
+            ID, status = line.split("\t")
+            statuses[ID] = status
+        return statuses
+
+    def append(self, ID, status):
+        with self.lock:
+            if self.f == None:
+                self.f = open(self.log_location, 'a')
+            self.f.write(f"{ID}\t{status}\n")
+            self.num_of_unsynced += 1
+            if self.num_of_unsynced >= self.sync_every or time.time() - self.last_sync_time >= self.sync_interval:
+                self._sync()
+
+    def _sync(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.num_of_unsynced = 0
+        self.last_sync_time = time.time()
+
+    def close(self):
+        with self.lock:
+            if self.f != None:
+                self._sync()
+                self.f.close()
+                self.f = None
+
 def get_main_folder_json_location(save_folder):
     return os.path.join(save_folder, "all_folders.json")
 
+def get_download_stats_location(save_folder):
+    return os.path.join(save_folder, "download_stats.json")
+
 def _get_info_str(size_option,
                   min_size,
                   use_valid_date,
@@ -245,10 +718,85 @@ def get_save_folder(img_dir,
     save_folder = os.path.join(img_dir, f'images{info_str}')
     return save_folder
     
+SAVE_FOLDER_PATTERN = re.compile(r"^images(_minbyte_(\d+))?(_valid_uploaded_date)?(_minedge_(\d+))?(_maxratio_([0-9.]+))?$")
+
+def get_looser_save_folders(img_dir,
+                            size_option,
+                            min_size,
+                            use_valid_date,
+                            min_edge,
+                            max_aspect_ratio):
+    """Return the other save folders under img_dir (see get_save_folder) with looser filters,
+    i.e., all valid images of this save folder are also valid in these folders
+    """
+    save_folder = get_save_folder(img_dir, size_option, min_size, use_valid_date, min_edge, max_aspect_ratio)
+    looser_save_folders = []
+    if not os.path.exists(img_dir):
+        return looser_save_folders
+    for folder_name in sorted(os.listdir(img_dir)):
+        match = SAVE_FOLDER_PATTERN.match(folder_name)
+        other_save_folder = os.path.join(img_dir, folder_name)
+        if match == None or os.path.abspath(other_save_folder) == os.path.abspath(save_folder):
+            continue
+        if not os.path.exists(get_main_folder_json_location(other_save_folder)):
+            continue
+        other_min_size = int(match.group(2)) if match.group(2) else 0
+        other_use_valid_date = match.group(3) != None
+        other_min_edge = int(match.group(5)) if match.group(5) else 0
+        other_max_aspect_ratio = float(match.group(7)) if match.group(7) else 0
+        if other_min_size > min_size or other_min_edge > min_edge:
+            continue
+        if other_use_valid_date and not use_valid_date:
+            continue
+        if other_max_aspect_ratio != 0 and (max_aspect_ratio == 0 or other_max_aspect_ratio < max_aspect_ratio):
+            continue
+        looser_save_folders.append(other_save_folder)
+    return looser_save_folders
+
+class DownloadedImages():
+    """The download status of the images in another save folder, read from its status logs (the other download may still be running).
+    Only the logs of the last max_cached_folders folders are kept in memory, since the images are processed in line order.
+    """
+    def __init__(self, save_folder, max_cached_folders=4):
+        self.save_folder = save_folder
+        self.flickr_folders = {int(k) : v for k, v in load_json(get_main_folder_json_location(save_folder), default_obj={}).items()}
+        if len(self.flickr_folders) > 0:
+            self.chunk_size = self.flickr_folders[min(self.flickr_folders.keys())]['num_images']
+        else:
+            self.chunk_size = None
+        self.max_cached_folders = max_cached_folders
+        self.lock = threading.Lock()
+        self._statuses = {}
+
+    def _get_statuses(self, folder_idx):
+        with self.lock:
+            if not folder_idx in self._statuses:
+                if len(self._statuses) >= self.max_cached_folders:
+                    del self._statuses[min(self._statuses.keys())]
+                if folder_idx in self.flickr_folders:
+                    status_log = DownloadStatusLog(_get_status_log_location(self.flickr_folders[folder_idx]))
+                    self._statuses[folder_idx] = status_log.load(truncate=False)
+                else:
+                    self._statuses[folder_idx] = {}
+            return self._statuses[folder_idx]
+
+    def get(self, line_idx, ID, img_name):
+        """Return (status, img_path) of the image in this save folder, or (None, None) if it was not downloaded (or failed)
+        """
+        if self.chunk_size == None:
+            return None, None
+        folder_idx = int(line_idx / self.chunk_size)
+        status = self._get_statuses(folder_idx).get(ID, None)
+        if status == STATUS_OK:
+            return status, os.path.join(self.flickr_folders[folder_idx]['image_folder'], img_name)
+        elif status == STATUS_FILTERED:
+            return status, None
+        return None, None
+
 class FlickrDownloader():
     """
-    Parse Flickr dataset files, in order to download images
-    Only download images that pass the is_valid() test
+    Download the candidate images (see yfcc_ingest.get_candidate_index) that pass the image-level filters.
+    Images already downloaded in save folders with looser filters are hardlinked instead of downloaded again.
     """
     def __init__(self, args):
         self.chunk_size = args.chunk_size
@@ -272,123 +820,268 @@ class FlickrDownloader():
 
         self.main_folder_json_location = get_main_folder_json_location(self.save_folder)
         
-        self.flickr_folders = load_json(self.main_folder_json_location, default_obj={})
+        # The keys are folder indices (saved as strings in json)
+        self.flickr_folders = {int(k) : v for k, v in load_json(self.main_folder_json_location, default_obj={}).items()}
 
         self.metadata_dir = args.metadata_dir
         self.data_file = os.path.join(args.metadata_dir, 'yfcc100m', 'yfcc100m_dataset')
         self.auto_file = os.path.join(args.metadata_dir, 'yfcc100m', 'yfcc100m_autotags-v1')
         self.exif_file = os.path.join(args.metadata_dir, 'yfcc100m', 'yfcc100m_exif')
         self.hash_file = os.path.join(args.metadata_dir, 'yfcc100m', 'yfcc100m_hash')
-        self.hash_json_location = os.path.join(args.metadata_dir, 'yfcc100m', 'yfcc100m_hash.json')
         self.lines_file = os.path.join(args.metadata_dir, 'yfcc100m', 'yfcc100m_lines')
 
+        self.ingest_workers = args.ingest_workers
+        self.looser_downloads = [DownloadedImages(save_folder) for save_folder in get_looser_save_folders(
+            args.img_dir,
+            self.size_option,
+            self.min_size,
+            self.use_valid_date,
+            self.min_edge,
+            self.max_aspect_ratio
+        )]
+        for downloaded in self.looser_downloads:
+            print(f"Reuse the images downloaded at {downloaded.save_folder}")
+        self.num_reused = 0
+        self.image_store = ImageStore(get_image_store_folder(args.img_dir), index_name=self.size_option)
         self.max_workers = args.max_workers
+        self.stats = DownloadStats()
+        self.stats_location = get_download_stats_location(self.save_folder)
+        self.fetcher = ImageFetcher(
+            max_connections_per_host=args.max_connections_per_host,
+            connect_timeout=args.connect_timeout,
+            read_timeout=args.read_timeout,
+            stats=self.stats,
+        )
     
-    def is_valid(self, metadata):
-        if self.use_valid_date:
-            if date_taken(metadata) == None or date_taken(metadata) >= date_uploaded(metadata):
-                return False
-        if metadata['IMG_OR_VIDEO'] == 0:
-            return True
-        return False
+    def _is_finished_folder(self, folder_idx):
+        if not folder_idx in self.flickr_folders:
+            return False
+        flickr_folder = self.flickr_folders[folder_idx]
+        # Folders saved before the status logs were added are complete once the metadata is saved
+        is_complete = flickr_folder.get('is_complete', os.path.exists(flickr_folder['metadata_location']))
+        return is_complete and flickr_folder.get('num_failed', 0) == 0
+
+    def _reuse_file(self, src_path, img_path):
+        status = check_image_file(
+            src_path,
+            MIN_EDGE=self.min_edge,
+            MIN_IMAGE_SIZE=self.min_size,
+            MAX_ASPECT_RATIO=self.max_aspect_ratio,
+        )
+        if status == STATUS_OK:
+            link_or_copy(src_path, img_path)
+        return status
+
+    def reuse_one(self, line_idx, ID, img_path, hash_value=None):
+        """Return the status of an image already in the image store (e.g., a re-upload of the same image) or
+        in the save folders with looser filters (hardlinked to img_path if valid), or None if it was not downloaded before
+        """
+        img_name = os.path.basename(img_path)
+        start_time = time.time()
+        stored_hash_value = self.image_store.resolve(hash_value)
+        if stored_hash_value != None:
+            status = self._reuse_file(self.image_store.get_path(stored_hash_value), img_path)
+            self.stats.observe('reuse', 'store', time.time() - start_time)
+            return status
+        for downloaded in self.looser_downloads:
+            status, other_img_path = downloaded.get(line_idx, ID, img_name)
+            if status == STATUS_FILTERED:
+                return status # The filters of this folder are tighter
+            if status == STATUS_OK and os.path.exists(other_img_path):
+                status = self._reuse_file(other_img_path, img_path)
+                self.stats.observe('reuse', 'looser', time.time() - start_time)
+                return status
+        return None
 
-    def fetch_one(self, metadata):
+    def fetch_one(self, img_path, url, hash_value=None):
         fetch_success = fetch_and_save_image(
-            os.path.join(metadata['IMG_DIR'], metadata['IMG_PATH']),
-            metadata['DOWNLOAD_URL'],
+            img_path,
+            url,
             MIN_EDGE=self.min_edge,
             MIN_IMAGE_SIZE=self.min_size,
             MAX_ASPECT_RATIO=self.max_aspect_ratio,
+            fetcher=self.fetcher,
+            stats=self.stats,
+            image_store=self.image_store,
+            hash_value=hash_value,
         )
         return fetch_success
 
     def fetch_images(self):
         if len(self.flickr_folders) > 0:
             print("Continue fetching images")
-            last_index = max(self.flickr_folders.keys()) * self.chunk_size
         else:
             print("Start fetching images")
-            last_index = 0
 
-        if os.path.exists(self.hash_json_location):
-            hash_dict = load_json(self.hash_json_location)
-            print(f"Load Hash dictionary at {self.hash_json_location}")
-        else:
-            hash_dict = {}
-            with open(self.hash_file, 'r') as hash_f:
-                for hash_line in tqdm(hash_f):
-                    hash_id, hash_value = hash_line.strip().split("\t")
-                    hash_dict[hash_id] = hash_value
-                    # print(hash_id)
-            save_as_json(self.hash_json_location, hash_dict)
-            print(f"Saved Hash dictionary at {self.hash_json_location}")
-
-                
-        with open(self.data_file, "r") as f, \
-             open(self.auto_file, "r") as auto_f, \
-             open(self.lines_file, "r") as line_f, \
-             open(self.exif_file, 'r') as exif_f:
-
-            zip_object = zip(f, auto_f, line_f, exif_f)
-            zip_index = list(range(len(hash_dict.keys())))
-            metadata_lists = {} # list of metadata
-            metadata_counts = {} # list of counts of downloaded (or attempted) metadata
-
-            lock = threading.Lock()
-            
-            def download_image(i, data_line, auto_line, line_num, exif_line, lock, metadata_lists, metadata_counts):
+        hash_column = HashColumn(self.hash_file)
+        # The dataset files are parsed into shards and filtered into a candidate index once, by a process pool
+        from yfcc_ingest import ingest_yfcc, get_candidate_index, get_num_lines
+        candidates = get_candidate_index(self.metadata_dir, use_valid_date=self.use_valid_date, num_workers=self.ingest_workers)
+        num_lines = get_num_lines(self.metadata_dir)
+        # The row indices of all shards are the line indices
+        all_records = MetadataStore(ingest_yfcc(self.metadata_dir, num_workers=self.ingest_workers))
+
+        def get_record(i, folder_idx):
+            meta = all_records.get_records([i])[0]
+            for name in ['LINE_IDX', 'VALID_DATE']:
+                del meta[name]
+            return _add_image_fields(meta, hash_column.get(i, meta['ID']), get_flickr_image_folder(self.save_folder, folder_idx))
+
+        metadata_lists = {} # list of metadata
+        metadata_counts = {} # list of counts of downloaded (or attempted) metadata
+        failed_counts = {} # list of counts of failed downloads
+        status_logs = {} # DownloadStatusLog of the folders in progress
+
+        lock = threading.Lock()
+
+        def open_folder(folder_idx):
+            # Return the saved status of the images in this folder
+            if not folder_idx in self.flickr_folders:
+                self.flickr_folders[folder_idx] = get_flickr_folder_dict(folder_idx, self.save_folder, num_images=self.chunk_size)
+            status_logs[folder_idx] = DownloadStatusLog(_get_status_log_location(self.flickr_folders[folder_idx]))
+            metadata_lists[folder_idx] = []
+            metadata_counts[folder_idx] = 0
+            failed_counts[folder_idx] = 0
+            return status_logs[folder_idx].load()
+
+        def save_folder(folder_idx):
+            print(f"Save the metadata list (successfully download ({len(metadata_lists[folder_idx])}), failed ({failed_counts[folder_idx]})) for {folder_idx * self.chunk_size} to {(1+folder_idx) * self.chunk_size} images at {self.flickr_folders[folder_idx]['image_folder']}")
+            status_logs[folder_idx].close()
+            save_as_json(self.flickr_folders[folder_idx]['metadata_location'], metadata_lists[folder_idx])
+            save_metadata_columns(_get_metadata_columns_location(self.flickr_folders[folder_idx]), metadata_lists[folder_idx])
+            self.flickr_folders[folder_idx]['is_complete'] = True
+            self.flickr_folders[folder_idx]['num_failed'] = failed_counts[folder_idx]
+            save_as_json(self.main_folder_json_location, self.flickr_folders)
+            print(f"Updated at {self.main_folder_json_location}")
+            for state in [metadata_lists, metadata_counts, failed_counts, status_logs]:
+                del state[folder_idx]
+
+        def count_images(folder_idx, num_images):
+            # Must be called with lock
+            metadata_counts[folder_idx] += num_images
+            if metadata_counts[folder_idx] == self.chunk_size:
+                save_folder(folder_idx)
+
+        def finish_image(folder_idx, ID, status, meta=None, is_logged=False):
+            # Must be called with lock
+            if not is_logged:
+                status_logs[folder_idx].append(ID, status)
+            if status == STATUS_OK:
+                metadata_lists[folder_idx].append(meta)
+            elif status == STATUS_FAILED:
+                failed_counts[folder_idx] += 1
+            count_images(folder_idx, 1)
+
+        def download_image(i, ID, url, ext):
+            folder_idx = int(i / self.chunk_size)
+            farm = get_farm(url)
+            meta = None
+            try:
+                img_path = os.path.join(get_flickr_image_folder(self.save_folder, folder_idx), f"{ID}.{ext}")
+                hash_value = hash_column.get(i, ID)
+                status = self.reuse_one(i, ID, img_path, hash_value=hash_value)
+                if status == None:
+                    status = self.fetch_one(img_path, url, hash_value=hash_value)
+                else:
+                    farm = 'reused'
+                    with lock:
+                        self.num_reused += 1
+                if status == STATUS_OK:
+                    meta = get_record(i, folder_idx)
+            except Exception as e:
+                print(f"Line {i} (ID {ID}): {type(e).__name__}: {e}")
+                self.stats.count_reason(f"exception_{type(e).__name__}", farm)
+                status = STATUS_FAILED
+            self.stats.count_status(status, farm)
+            with lock:
+                finish_image(folder_idx, ID, status, meta=meta)
+
+        # Workers pull records from a bounded queue. The reader blocks when the queue is full (backpressure),
+        # so the memory stays flat and no worker waits at chunk boundaries.
+        # download_image marks the images that fail to download as STATUS_FAILED. Any other error (e.g., saving a folder)
+        # is kept in worker_errors and re-raised by the reader, and the workers keep draining the queue so it never blocks.
+        work_queue = queue.Queue(maxsize=self.max_workers * QUEUE_SIZE_PER_WORKER)
+        worker_errors = []
+        def worker():
+            while True:
+                item = work_queue.get()
+                if item == None:
+                    return
+                if len(worker_errors) > 0:
+                    continue
                 try:
-                    folder_idx = int(i / self.chunk_size)
-                    
+                    download_image(*item)
+                except Exception as e:
+                    print(f"Worker failed at line {item[0]} (ID {item[1]}): {type(e).__name__}: {e}")
                     with lock:
-                        if not folder_idx in self.flickr_folders:
-                            self.flickr_folders[folder_idx] = get_flickr_folder_dict(folder_idx, self.save_folder, num_images=self.chunk_size)
-                    
-                    meta = _parse_metadata(data_line, auto_line, line_num, hash_dict, get_flickr_image_folder(self.save_folder, folder_idx), exif_line=None)
-                    if self.is_valid(meta):
-                        fetch_success = self.fetch_one(meta)
-                        if fetch_success:
-                            with lock:
-                                if not folder_idx in metadata_lists:
-                                    metadata_lists[folder_idx] = []
-                                metadata_lists[folder_idx].append(meta)
-                    
+                        worker_errors.append(e)
+
+        # Print a one-line summary and save the stats (download_stats.json next to all_folders.json) periodically
+        is_done = threading.Event()
+        def report_stats():
+            while not is_done.wait(STATS_INTERVAL):
+                print(self.stats.get_summary_str())
+                self.stats.save(self.stats_location)
+
+        workers = [threading.Thread(target=worker, daemon=True) for _ in range(self.max_workers)]
+        for w in workers:
+            w.start()
+        reporter = threading.Thread(target=report_stats, daemon=True)
+        reporter.start()
+        # Resume from the status logs: skip the complete folders (without failed images), and
+        # only download the candidates without a status or with STATUS_FAILED in the other folders.
+        # The lines that are not candidates (videos, invalid dates) are counted without a status.
+        line_indices = np.asarray(candidates.get_column('LINE_IDX'))
+        ids = candidates.get_column('ID')
+        urls = candidates.get_column('DOWNLOAD_URL')
+        exts = candidates.get_column('EXT')
+        num_folders = int(math.ceil(num_lines / self.chunk_size))
+        folder_starts = np.searchsorted(line_indices, np.arange(num_folders + 1) * self.chunk_size)
+        for folder_idx in range(num_folders):
+            if len(worker_errors) > 0:
+                break
+            if self._is_finished_folder(folder_idx):
+                continue
+            with lock:
+                saved_statuses = open_folder(folder_idx)
+                num_lines_in_folder = min(self.chunk_size, num_lines - folder_idx * self.chunk_size)
+                num_candidates = int(folder_starts[folder_idx + 1] - folder_starts[folder_idx])
+                count_images(folder_idx, num_lines_in_folder - num_candidates)
+            for row in range(folder_starts[folder_idx], folder_starts[folder_idx + 1]):
+                i = int(line_indices[row])
+                ID = str(int(ids[row]))
+                saved_status = saved_statuses.get(ID, None)
+                if saved_status == STATUS_OK:
+                    meta = get_record(i, folder_idx)
                     with lock:
-                        if not folder_idx in metadata_counts:
-                            metadata_counts[folder_idx] = 0
-                        metadata_counts[folder_idx] += 1
-                            
-                        if metadata_counts[folder_idx] == self.chunk_size:
-                            assert folder_idx in self.flickr_folders
-                            print(f"Save the metadata list (successfully download ({len(metadata_lists[folder_idx])})) for {folder_idx * self.chunk_size} to {(1+folder_idx) * self.chunk_size} images at {self.flickr_folders[folder_idx]['image_folder']}")
-                            save_as_json(self.flickr_folders[folder_idx]['metadata_location'], metadata_lists[folder_idx])
-                            save_as_json(self.main_folder_json_location, self.flickr_folders)
-                            print(f"Updated at {self.main_folder_json_location}")
-                            metadata_lists[folder_idx] = None
-                            del metadata_lists[folder_idx]
-                except Exception as e:
-                    print(e)
-                return
-
-            from iteration_utilities import grouper
-            chunk_idx = 0
-            images_per_chunk = 1000000
-            for chunk in grouper(enumerate(zip_object), images_per_chunk):
-                with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-                    results = []
-                    for i, (data_line, auto_line, line_num, exif_line) in chunk:
-                        if i < last_index:
-                            continue
-                        else:
-                            results += [executor.submit(download_image, i, data_line, auto_line, line_num, exif_line, lock, metadata_lists, metadata_counts)]
-                        # executor.submit(download_image, i, data_line, auto_line, line_num, exif_line, lock, metadata_lists, metadata_counts).result()
-                    for cur_result in as_completed(results):
-                    # for cur_result in tqdm(as_completed(results), total=len(results)):
-                        cur_result.result()
-                    print(f"Finish the {chunk_idx+1} chunk = {(chunk_idx+1)*images_per_chunk} images.")
-                    chunk_idx += 1
-
-            print(f"Finished all media objects.")
+                        finish_image(folder_idx, ID, saved_status, meta=meta, is_logged=True)
+                elif saved_status == STATUS_FILTERED:
+                    with lock:
+                        finish_image(folder_idx, ID, saved_status, is_logged=True)
+                elif len(worker_errors) > 0:
+                    break
+                else:
+                    work_queue.put((i, ID, urls[row], exts[row]))
+            print(f"Scheduled {min((folder_idx + 1) * self.chunk_size, num_lines)} images. Downloaded {self.fetcher.get_info_str()}, reused {self.num_reused}")
+        for _ in workers:
+            work_queue.put(None)
+        for w in workers:
+            w.join()
+        is_done.set()
+        reporter.join()
+        if len(worker_errors) > 0:
+            # The status logs keep the finished images, so the download resumes from here
+            print(f"{len(worker_errors)} worker error(s). Stop fetching images.")
+            raise worker_errors[0]
+        print(self.stats.get_summary_str())
+        self.stats.save(self.stats_location)
+        print(f"Saved the download stats at {self.stats_location}")
+        # The last folder has less than chunk_size images
+        for folder_idx in list(metadata_counts.keys()):
+            save_folder(folder_idx)
+        print(f"Downloaded {self.fetcher.get_info_str()}, reused {self.num_reused}")
+
+        print(f"Finished all media objects.")
 
 def _metadata_of_single_folder(flickr_folder):
     if os.path.exists(flickr_folder['metadata_location']):
@@ -397,7 +1090,7 @@ def _metadata_of_single_folder(flickr_folder):
 
 def _metadata_of_all_folders(flickr_folder_dicts):
     all_metadata_lists = [_metadata_of_single_folder(flickr_folder_dicts[f_idx])
-                          for f_idx in sorted(flickr_folder_dicts.keys())]
+                          for f_idx in sorted(flickr_folder_dicts.keys(), key=int)]
     all_metadata = []
     for lst in all_metadata_lists:
         if lst:
@@ -409,6 +1102,26 @@ def get_all_metadata(save_folder):
     flickr_folder_dicts = load_json(main_folder_json_location, default_obj={})
     return _metadata_of_all_folders(flickr_folder_dicts)
 
+def _metadata_columns_of_single_folder(flickr_folder):
+    # Folders downloaded before the columnar store was added only have metadata.json
+    columns_location = _get_metadata_columns_location(flickr_folder)
+    if not has_metadata_columns(columns_location):
+        metadata_list = _metadata_of_single_folder(flickr_folder)
+        if metadata_list == None:
+            return None
+        print(f"Convert {flickr_folder['metadata_location']} to columnar format at {columns_location}")
+        save_metadata_columns(columns_location, metadata_list)
+    return columns_location
+
+def get_metadata_store(save_folder):
+    """Return a MetadataStore of all downloaded folders (same order as get_all_metadata())
+    """
+    main_folder_json_location = get_main_folder_json_location(save_folder)
+    flickr_folder_dicts = load_json(main_folder_json_location, default_obj={})
+    columns_locations = [_metadata_columns_of_single_folder(flickr_folder_dicts[f_idx])
+                         for f_idx in sorted(flickr_folder_dicts.keys(), key=int)]
+    return MetadataStore([location for location in columns_locations if location != None])
+
 if __name__ == "__main__":
     args = argparser.parse_args()
     flickr_downloader = FlickrDownloader(args)
@@ -0,0 +1,221 @@
+# Parse the YFCC100M dataset files (yfcc100m_dataset, yfcc100m_autotags-v1, yfcc100m_lines, yfcc100m_exif) into columnar shards
+# with a process pool, so the download stage (yfcc_download.py) only consumes parsed and pre-filtered records.
+# The four files are line-aligned, so each shard (SHARD_SIZE consecutive lines) is located by the byte offset of its first line in each file.
+# The shards are saved under <metadata_dir>/yfcc100m/ingested/:
+#   shards.json : the line range and byte offsets of each shard
+#   shard_<k>/ : the parsed metadata of the lines in this shard (see metadata_store.py), with two extra integer columns
+#                LINE_IDX (the line index in the dataset files) and VALID_DATE (1 if the image is taken before uploaded)
+#   candidates<info_str>/ : the candidate index, i.e., LINE_IDX, ID, DOWNLOAD_URL and EXT of the images that pass the
+#                           metadata-level filters (photos only, and valid dates if use_valid_date)
+# The shards do not depend on the download options, so they are parsed once for all runs of yfcc_download.py.
+# The candidate index only depends on use_valid_date, so runs with other image-level filters (e.g., min_edge) start fetching immediately.
+# Example: python yfcc_ingest.py --metadata_dir ./ --ingest_workers 32 --use_valid_date True
+import os
+import math
+from datetime import datetime, timezone
+from multiprocessing import Pool
+import numpy as np
+from tqdm import tqdm
+
+from utils import load_json, save_as_json_atomic
+from metadata_store import save_metadata_columns, has_metadata_columns, save_column_arrays, MetadataColumns
+from yfcc_download import argparser, _parse_record, date_taken
+
+LINE_FILES = ['yfcc100m_dataset', 'yfcc100m_autotags-v1', 'yfcc100m_lines', 'yfcc100m_exif']
+SHARD_SIZE = 100000 # The number of lines per shard. Each worker holds the parsed metadata of a shard in memory.
+DATE_BLOCK_SIZE = 10000 # The number of dates parsed at once by numpy
+INVALID_TIMESTAMP = np.iinfo(np.int64).max # For DATE_TAKEN that can not be parsed (never before DATE_UPLOADED)
+
+def get_ingest_folder(metadata_dir):
+    return os.path.join(metadata_dir, 'yfcc100m', 'ingested')
+
+def get_shards_json_location(ingest_folder):
+    return os.path.join(ingest_folder, 'shards.json')
+
+def get_shard_folder(ingest_folder, shard_idx):
+    return os.path.join(ingest_folder, f'shard_{shard_idx:05d}')
+
+def get_candidate_folder(ingest_folder, use_valid_date):
+    info_str = "_valid_uploaded_date" if use_valid_date else ""
+    return os.path.join(ingest_folder, f'candidates{info_str}')
+
+def get_num_lines(metadata_dir):
+    shards = load_json(get_shards_json_location(get_ingest_folder(metadata_dir)))
+    return shards[-1]['end'] if len(shards) > 0 else 0
+
+def get_candidate_mask(columns, use_valid_date):
+    """Return a boolean mask of the candidates (images to download), given the integer columns of a shard
+    """
+    is_valid = columns['IMG_OR_VIDEO'] == 0
+    if use_valid_date:
+        is_valid = is_valid & (columns['VALID_DATE'] == 1)
+    return is_valid
+
+def _get_line_offsets(file_location, every=SHARD_SIZE, buffer_size=2**24):
+    """Return the byte offsets of the (every * k)-th lines (k = 0, 1, ...) and the number of lines
+    """
+    offsets = [0]
+    num_lines = 0
+    position = 0
+    with open(file_location, 'rb') as f:
+        while True:
+            buffer = f.read(buffer_size)
+            if not buffer:
+                break
+            newlines = np.flatnonzero(np.frombuffer(buffer, dtype=np.uint8) == ord("\n"))
+            # The L-th line starts after the (L-1)-th newline
+            next_line = len(offsets) * every
+            while next_line <= num_lines + len(newlines):
+                offsets.append(position + int(newlines[next_line - num_lines - 1]) + 1)
+                next_line += every
+            num_lines += len(newlines)
+            position += len(buffer)
+            last_byte = buffer[-1:]
+    if position > 0 and last_byte != b"\n":
+        num_lines += 1 # The last line has no newline
+    if len(offsets) > 0 and offsets[-1] == position:
+        offsets.pop() # No line starts at the end of the file
+    return offsets, num_lines
+
+def _get_shards(file_locations, num_workers=4):
+    with Pool(min(num_workers, len(file_locations))) as pool:
+        offsets_and_num_lines = pool.starmap(_get_line_offsets, [(file_location, SHARD_SIZE) for file_location in file_locations])
+    num_lines = offsets_and_num_lines[0][1]
+    # The metadata files are read in parallel line by line, so they must have the same number of lines
+    mismatches = [f"{file_location} has {num_lines_i} lines" for file_location, (_, num_lines_i) in zip(file_locations, offsets_and_num_lines)
+                  if num_lines_i != num_lines]
+    if len(mismatches) > 0:
+        raise ValueError(f"{', '.join(mismatches)}, but {file_locations[0]} has {num_lines} lines.")
+    shards = []
+    for shard_idx in range(len(offsets_and_num_lines[0][0])):
+        shards.append({
+            'shard_idx' : shard_idx,
+            'start' : shard_idx * SHARD_SIZE,
+            'end' : min((shard_idx + 1) * SHARD_SIZE, num_lines),
+            'offsets' : [offsets[shard_idx] for offsets, _ in offsets_and_num_lines],
+        })
+    return shards
+
+def _get_timestamp(date):
+    if date.tzinfo != None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return math.floor((date - datetime(1970, 1, 1)).total_seconds())
+
+def get_date_taken_timestamps(date_taken_list):
+    """Return an int64 array of DATE_TAKEN (seconds since epoch), or INVALID_TIMESTAMP if not a valid date.
+    Dates are parsed by numpy in blocks. Only the blocks with dates numpy can not parse fall back to date_taken().
+    """
+    timestamps = np.full(len(date_taken_list), INVALID_TIMESTAMP, dtype=np.int64)
+    for i0 in range(0, len(date_taken_list), DATE_BLOCK_SIZE):
+        block = date_taken_list[i0:i0 + DATE_BLOCK_SIZE]
+        try:
+            dates = np.array(block, dtype='datetime64[s]')
+            timestamps[i0:i0 + len(block)] = np.where(np.isnat(dates), INVALID_TIMESTAMP, dates.astype(np.int64))
+        except ValueError:
+            for j, date_str in enumerate(block):
+                date = date_taken({'DATE_TAKEN' : date_str})
+                if date != None:
+                    timestamps[i0 + j] = _get_timestamp(date)
+    return timestamps
+
+def _parse_shard(shard, file_locations, shard_folder):
+    records = []
+    files = [open(file_location, 'rb') for file_location in file_locations]
+    try:
+        for f, offset in zip(files, shard['offsets']):
+            f.seek(offset)
+        for line_idx in range(shard['start'], shard['end']):
+            data_line, auto_line, line_num, exif_line = [f.readline().decode('utf-8') for f in files]
+            try:
+                meta = _parse_record(data_line, auto_line, line_num, exif_line=None)
+            except Exception as e:
+                # Keep a placeholder (never downloaded), so the line indices stay aligned
+                print(f"Line {line_idx}: {e}")
+                meta = {'ID' : -1, 'DATE_UPLOADED' : 0, 'LINE_NUM' : -1, 'IMG_OR_VIDEO' : -1}
+            meta['LINE_IDX'] = line_idx
+            records.append(meta)
+    finally:
+        for f in files:
+            f.close()
+    date_uploaded = np.array([int(meta['DATE_UPLOADED']) for meta in records], dtype=np.int64)
+    date_taken_timestamps = get_date_taken_timestamps([meta.get('DATE_TAKEN', '') for meta in records])
+    valid_date = date_taken_timestamps < date_uploaded
+    for meta, is_valid_date in zip(records, valid_date):
+        meta['VALID_DATE'] = int(is_valid_date)
+    save_metadata_columns(shard_folder, records)
+    return len(records)
+
+def _parse_shard_star(args):
+    return _parse_shard(*args)
+
+def _select_candidates(shard_folder, use_valid_date):
+    shard = MetadataColumns(shard_folder)
+    columns = {name : np.asarray(shard.get_column(name)) for name in ['LINE_IDX', 'ID', 'IMG_OR_VIDEO', 'VALID_DATE']}
+    rows = np.flatnonzero(get_candidate_mask(columns, use_valid_date))
+    if len(rows) == 0: # e.g., no column of strings if all lines of this shard failed to parse
+        string_pools = {name : (np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.uint8)) for name in ['DOWNLOAD_URL', 'EXT']}
+    else:
+        string_pools = {name : shard.get_column(name).take_pool(rows) for name in ['DOWNLOAD_URL', 'EXT']}
+    return columns['LINE_IDX'][rows], columns['ID'][rows], string_pools
+
+def _select_candidates_star(args):
+    return _select_candidates(*args)
+
+def _concatenate_pools(pools):
+    offsets = [np.zeros(1, dtype=np.int64)]
+    for pool_offsets, _ in pools:
+        offsets.append(pool_offsets[1:] + offsets[-1][-1])
+    return np.concatenate(offsets), np.concatenate([data for _, data in pools])
+
+def get_candidate_index(metadata_dir, use_valid_date=True, num_workers=8):
+    """Return the candidate index (MetadataColumns sorted by LINE_IDX), and build it (once) if not yet saved
+    """
+    shard_folders = ingest_yfcc(metadata_dir, num_workers=num_workers)
+    candidate_folder = get_candidate_folder(get_ingest_folder(metadata_dir), use_valid_date)
+    if not has_metadata_columns(candidate_folder):
+        print(f"Build the candidate index at {candidate_folder}")
+        line_indices, ids, pools = [], [], {'DOWNLOAD_URL' : [], 'EXT' : []}
+        with Pool(num_workers) as pool:
+            for shard_line_indices, shard_ids, shard_pools in tqdm(pool.imap(_select_candidates_star, [(shard_folder, use_valid_date) for shard_folder in shard_folders]),
+                                                                    total=len(shard_folders)):
+                line_indices.append(shard_line_indices)
+                ids.append(shard_ids)
+                for name in pools:
+                    pools[name].append(shard_pools[name])
+        save_column_arrays(
+            candidate_folder,
+            {'LINE_IDX' : np.concatenate(line_indices), 'ID' : np.concatenate(ids)},
+            {name : _concatenate_pools(pools[name]) for name in pools},
+        )
+    candidates = MetadataColumns(candidate_folder)
+    print(f"{len(candidates)} candidates out of {get_num_lines(metadata_dir)} lines")
+    return candidates
+
+def ingest_yfcc(metadata_dir, num_workers=8):
+    """Parse the dataset files into columnar shards (only the shards not yet saved) and return the shard folders in line order
+    """
+    file_locations = [os.path.join(metadata_dir, 'yfcc100m', file_name) for file_name in LINE_FILES]
+    ingest_folder = get_ingest_folder(metadata_dir)
+    if not os.path.exists(ingest_folder):
+        os.makedirs(ingest_folder)
+    shards_json_location = get_shards_json_location(ingest_folder)
+    shards = load_json(shards_json_location)
+    if shards == None:
+        print(f"Locate the shards of {SHARD_SIZE} lines in {file_locations}")
+        shards = _get_shards(file_locations, num_workers=num_workers)
+        save_as_json_atomic(shards_json_location, shards)
+        print(f"Saved {len(shards)} shards at {shards_json_location}")
+
+    shard_folders = [get_shard_folder(ingest_folder, shard['shard_idx']) for shard in shards]
+    missing = [(shard, file_locations, shard_folder) for shard, shard_folder in zip(shards, shard_folders)
+               if not has_metadata_columns(shard_folder)]
+    if len(missing) > 0:
+        print(f"Parse {len(missing)} (out of {len(shards)}) shards with {num_workers} processes")
+        with Pool(num_workers) as pool:
+            for _ in tqdm(pool.imap_unordered(_parse_shard_star, missing), total=len(missing)):
+                pass
+    return shard_folders
+
+if __name__ == "__main__":
+    args = argparser.parse_args()
+    get_candidate_index(args.metadata_dir, use_valid_date=args.use_valid_date, num_workers=args.ingest_workers)